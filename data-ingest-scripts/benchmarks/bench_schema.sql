@@ -0,0 +1,15 @@
+-- Empties a throwaway benchmark database. The first load recreates every
+-- table through the loaders' schema migrations (pam_schema.py), so the
+-- benchmark measures the schema that ships. Dropping a partitioned table
+-- (history, PSM events) drops its partitions too.
+
+DROP VIEW IF EXISTS pam_account_details;
+
+DROP TABLE IF EXISTS
+    pam_safe_accounts, pam_accounts, pam_safes, pam_platforms,
+    pam_accounts_history, pam_safes_history, pam_platforms_history,
+    pam_kpi_platform_daily, pam_kpi_safe_daily,
+    pam_snapshot_parts, pam_snapshot_keys, pam_snapshot_sweeps,
+    pam_psm_events, pam_psm_hourly,
+    pam_ingest_manifest, pam_ingest_rejects, pam_schema_migrations
+CASCADE;
@@ -0,0 +1,111 @@
+"""
+Measures what a Lambda cold start pays before the first S3 request: the
+interpreter start, importing the loader module and creating the S3 client.
+
+Each sample runs in a fresh interpreter. The "eager" mode reproduces the
+loaders as they were, importing boto3 and creating the S3 and Secrets
+Manager clients at import time; "lazy" imports the module as it is now and
+then creates the S3 client on first use, as the first invocation does.
+
+    pip install boto3 psycopg2-binary
+    python cold_start.py --samples 20
+    python cold_start.py --importtime    # heaviest imports of one lazy run
+
+Run it on a machine close to the Lambda runtime (python3.11, x86_64) for
+comparable numbers; the Lambda REPORT line's "Init Duration" is the
+production counterpart of the "startup" column.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+LAMBDA_DIR = os.path.abspath(os.path.join(HERE, '..', 'lambda-python-scripts'))
+
+_SAMPLE = '''
+import importlib, json, sys, time
+started = time.perf_counter()
+sys.path.insert(0, {lambda_dir!r})
+if {eager!r}:
+    import boto3
+    boto3.client('s3')
+    boto3.client('secretsmanager')
+importlib.import_module({module!r})
+imported = time.perf_counter()
+if not {eager!r}:
+    from aws_clients import get_client
+    get_client('s3')
+ready = time.perf_counter()
+print(json.dumps({{'import': imported - started, 'first_client': ready - imported}}))
+'''
+
+
+def _env():
+    env = dict(os.environ)
+    env.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    env.setdefault('LOG_LEVEL', 'WARNING')
+    env.setdefault('METRICS_ENABLED', 'false')
+    return env
+
+
+def run_sample(module, eager):
+    """
+    Starts one interpreter and returns its timings in seconds, including
+    the whole process wall time as 'startup'.
+    """
+    code = _SAMPLE.format(lambda_dir=LAMBDA_DIR, module=module, eager=eager)
+    started = time.perf_counter()
+    output = subprocess.run([sys.executable, '-c', code], env=_env(), check=True,
+                            stdout=subprocess.PIPE, text=True).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    result['startup'] = time.perf_counter() - started
+    return result
+
+
+def import_profile(module, top):
+    """
+    Returns the top imports by cumulative time from python -X importtime.
+    """
+    code = f"import sys; sys.path.insert(0, {LAMBDA_DIR!r}); import importlib; importlib.import_module({module!r})"
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], env=_env(), check=True,
+                            stderr=subprocess.PIPE, text=True).stderr
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # Only top-level imports; nested ones are included in their parent.
+        if not name.startswith('  '):
+            rows.append((int(cumulative), name.strip()))
+    return sorted(rows, reverse=True)[:top]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--module', default='load-pam-data-to-rds', help='loader module to import')
+    parser.add_argument('--samples', type=int, default=10)
+    parser.add_argument('--modes', default='eager,lazy')
+    parser.add_argument('--importtime', action='store_true', help='print the heaviest imports instead')
+    parser.add_argument('--top', type=int, default=15)
+    args = parser.parse_args()
+
+    if args.importtime:
+        for cumulative, name in import_profile(args.module, args.top):
+            print(f"{cumulative / 1000:>9.1f} ms  {name}")
+        return
+
+    print(f"{'mode':>6} {'import ms':>10} {'client ms':>10} {'startup ms':>11}   (median of {args.samples})")
+    for mode in args.modes.split(','):
+        samples = [run_sample(args.module, mode == 'eager') for _ in range(args.samples)]
+        medians = {name: statistics.median(s[name] for s in samples) * 1000
+                   for name in ('import', 'first_client', 'startup')}
+        print(f"{mode:>6} {medians['import']:>10.1f} {medians['first_client']:>10.1f} {medians['startup']:>11.1f}")
+
+
+if __name__ == '__main__':
+    main()
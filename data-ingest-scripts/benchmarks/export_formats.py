@@ -0,0 +1,77 @@
+"""
+Compares the two export formats the loaders read, without a database:
+the JSON document the exporters wrote so far and the gzip-compressed
+NDJSON parts of Export-PamEntity -Format ndjson.gz.
+
+For each entity and scale the same synthetic records are written in both
+formats; the table shows the bytes transferred from S3 and the time the
+loader takes to read and decode every record from a local copy (median of
+--samples runs), and what NDJSON saves on each.
+
+    python export_formats.py --scales 10k,100k
+
+Parse time here is the "Parse" stage of the loaders' per-file metrics;
+in production the per-file "Read" log line and the TransferSavedBytes
+metric report the same numbers for every file loaded.
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+from synthetic_exports import generate_export, parse_scale
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+LAMBDA_DIR = os.path.join(HERE, '..', 'lambda-python-scripts')
+FORMATS = ['json', 'ndjson.gz']
+ENTITIES = ['platforms', 'safes', 'accounts']
+
+
+def read_seconds(path, records_key):
+    """
+    Returns (seconds, records) for reading every record of an export
+    through the loaders' load_records.
+    """
+    from json_stream import load_records
+    started = time.perf_counter()
+    with open(path, 'rb') as body:
+        count = sum(1 for _ in load_records(body, records_key, object_key=path))
+    return time.perf_counter() - started, count
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scales', default='10k,100k')
+    parser.add_argument('--entities', default=','.join(ENTITIES))
+    parser.add_argument('--samples', type=int, default=3)
+    parser.add_argument('--data-dir', default=os.path.join('/tmp', 'pam-bench'))
+    args = parser.parse_args()
+    sys.path.insert(0, LAMBDA_DIR)
+    os.makedirs(args.data_dir, exist_ok=True)
+
+    print(f"{'scale':>8} {'entity':>10} {'json MB':>8} {'ndjson MB':>10} {'saved':>6} "
+          f"{'json s':>7} {'ndjson s':>9} {'saved':>6}")
+    for scale in args.scales.split(','):
+        count = parse_scale(scale)
+        for entity in [e for e in ENTITIES if e in args.entities.split(',')]:
+            records_key = 'Platforms' if entity == 'platforms' else 'value'
+            sizes, seconds = {}, {}
+            for export_format in FORMATS:
+                path = os.path.join(args.data_dir, f"{entity}-{count}-0.0.{export_format}")
+                if not os.path.exists(path):
+                    generate_export(entity, count, path)
+                sizes[export_format] = os.path.getsize(path)
+                runs = [read_seconds(path, records_key) for _ in range(args.samples)]
+                if any(records != count for _, records in runs):
+                    raise RuntimeError(f"{path} returned the wrong number of records")
+                seconds[export_format] = statistics.median(s for s, _ in runs)
+            json_mb, ndjson_mb = sizes['json'] / 1e6, sizes['ndjson.gz'] / 1e6
+            print(f"{scale:>8} {entity:>10} {json_mb:>8.2f} {ndjson_mb:>10.2f} "
+                  f"{1 - ndjson_mb / json_mb:>6.0%} {seconds['json']:>7.2f} {seconds['ndjson.gz']:>9.2f} "
+                  f"{1 - seconds['ndjson.gz'] / seconds['json']:>6.0%}")
+
+
+if __name__ == '__main__':
+    main()
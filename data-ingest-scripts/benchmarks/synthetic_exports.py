@@ -0,0 +1,205 @@
+"""
+Generates synthetic CyberArk exports shaped like the API responses the
+PowerShell exporters upload (GET /Platforms, /Safes, /Accounts), written
+straight to disk one record at a time so 1M-record files need no memory.
+Paths ending in .ndjson.gz get the compressed NDJSON format instead. Each
+file carries the exporter's metadata as a single-part full export (count,
+exportMode, generation, part, parts), so loads of it are swept like real ones.
+"""
+import argparse
+import gzip
+import json
+import os
+import random
+import string
+
+SCALES = {'1k': 1000, '10k': 10000, '100k': 100000, '1m': 1000000}
+
+SYSTEM_TYPES = ['Windows', 'Unix', 'Database', 'Network Device', 'Cloud Service', 'Application']
+SECRET_TYPES = ['password', 'password', 'password', 'key']
+CPM_NAMES = ['PasswordManager', 'PasswordManager_EU', 'PasswordManager_US', '']
+
+# 2023-01-01 .. 2025-02-01 in epoch seconds.
+_EPOCH_START = 1672531200
+_EPOCH_END = 1738368000
+
+# Start of the export run in epoch seconds (2025-01-01), shared by every
+# part of a run, unless the caller passes its own.
+DEFAULT_GENERATION = 1735689600
+
+
+def parse_scale(value):
+    """
+    Accepts 1k/100k/1m style names or a plain record count.
+    """
+    return SCALES.get(value.lower()) or int(value)
+
+
+def _word(rng, length=8):
+    return ''.join(rng.choices(string.ascii_lowercase, k=length))
+
+
+def _epoch(rng):
+    return rng.randint(_EPOCH_START, _EPOCH_END)
+
+
+def platform_ids(count):
+    return [f"Bench{system.replace(' ', '')}{i:05d}"
+            for i, system in zip(range(count), SYSTEM_TYPES * (count // len(SYSTEM_TYPES) + 1))]
+
+
+def safe_names(count):
+    return [f"BENCH-SAFE-{i:06d}" for i in range(count)]
+
+
+def platform_record(rng, platform_id, index):
+    return {
+        'general': {
+            'id': platform_id,
+            'name': f"Bench platform {index}",
+            'systemType': SYSTEM_TYPES[index % len(SYSTEM_TYPES)],
+            'active': rng.random() > 0.1,
+            'description': f"Synthetic platform {_word(rng, 12)}",
+            'platformBaseID': f"Base{SYSTEM_TYPES[index % len(SYSTEM_TYPES)].replace(' ', '')}",
+            'platformType': rng.choice(['regular', 'group', 'rotationalGroup']),
+        },
+        'credentialsManagement': {
+            'requirePasswordChangeEveryXDays': rng.choice([0, 30, 60, 90, 180]),
+            'requirePasswordVerificationEveryXDays': rng.choice([0, 7, 30]),
+            'automaticReconcileWhenUnsynched': rng.random() > 0.5,
+        },
+        'sessionManagement': {
+            'requirePrivilegedSessionMonitoringAndIsolation': rng.random() > 0.4,
+            'recordAndSaveSessionActivity': rng.random() > 0.3,
+        },
+    }
+
+
+def safe_record(rng, safe_name, index, accounts_per_safe, reject_rate):
+    managing_cpm = rng.choice(CPM_NAMES)
+    if reject_rate and rng.random() < reject_rate:
+        # Longer than pam_safes.managing_cpm allows, so the row is rejected.
+        managing_cpm = 'X' * 300
+    return {
+        'safeUrlId': safe_name,
+        'safeName': safe_name,
+        'safeNumber': index + 2,
+        'description': f"Synthetic safe {_word(rng, 16)}",
+        'location': '\\',
+        'creator': {'id': f"{rng.randint(1, 500)}", 'name': f"admin_{_word(rng, 5)}"},
+        'olacEnabled': rng.random() > 0.9,
+        'managingCPM': managing_cpm,
+        'numberOfVersionsRetention': None,
+        'numberOfDaysRetention': 7,
+        'autoPurgeEnabled': False,
+        'creationTime': _epoch(rng),
+        # The Safes API reports this one in microseconds.
+        'lastModificationTime': _epoch(rng) * 1000000 + rng.randint(0, 999999),
+        'accounts': [
+            {'accountId': f"{index + 2}_{n + 1}", 'accountName': f"acct-{index}-{n}"}
+            for n in range(accounts_per_safe)
+        ],
+    }
+
+
+def account_record(rng, index, safes, platforms):
+    created = _epoch(rng)
+    return {
+        'categoryModificationTime': created,
+        'platformId': rng.choice(platforms),
+        'safeName': rng.choice(safes),
+        'id': f"{rng.randint(2, 9999)}_{index + 1}",
+        'name': f"Operating System-{_word(rng, 6)}-{index:07d}",
+        'address': f"host{index % 5000:04d}.bench.example.com",
+        'userName': f"svc_{_word(rng, 6)}",
+        'secretType': rng.choice(SECRET_TYPES),
+        'platformAccountProperties': {},
+        'secretManagement': {
+            'automaticManagementEnabled': rng.random() > 0.2,
+            'lastModifiedTime': created + rng.randint(0, 86400 * 120),
+        },
+        'createdTime': created,
+    }
+
+
+def export_metadata(count, generation):
+    """
+    The metadata Export-PamEntity writes with a single-part full export.
+    """
+    return {'count': count, 'exportMode': 'full', 'generation': generation, 'part': 1, 'parts': 1}
+
+
+def _write_export(path, records_key, records, metadata):
+    """
+    Writes {"<records_key>": [...], "count": n, ...metadata} compactly, like
+    ConvertTo-Json -Compress, without building the list in memory.
+    """
+    with open(path, 'w', encoding='utf-8') as out:
+        out.write(f'{{"{records_key}":[')
+        for i, record in enumerate(records):
+            if i:
+                out.write(',')
+            out.write(json.dumps(record, separators=(',', ':')))
+        out.write('],' + json.dumps(metadata, separators=(',', ':'))[1:])
+    return os.path.getsize(path)
+
+
+def _write_ndjson(path, records_key, records, metadata):
+    """
+    Writes the gzip-compressed NDJSON format of Export-PamEntity: an
+    {"_export": {...}} header line, then one record per line.
+    """
+    with gzip.open(path, 'wt', encoding='utf-8', compresslevel=6) as out:
+        header = dict({'recordsKey': records_key}, **metadata)
+        out.write(json.dumps({'_export': header}, separators=(',', ':')) + '\n')
+        for record in records:
+            out.write(json.dumps(record, separators=(',', ':')) + '\n')
+    return os.path.getsize(path)
+
+
+def generate_export(entity, count, path, seed=42, reject_rate=0.0, generation=DEFAULT_GENERATION):
+    """
+    Writes a synthetic export of count records for entity ('platforms',
+    'safes' or 'accounts') to path, as generation (the export run's start
+    in epoch seconds). Returns the file size in bytes.
+
+    Related entities share deterministic names, so accounts reference
+    platforms and safes that the other exports at the same scale contain.
+    """
+    rng = random.Random(f"{seed}-{entity}-{count}")
+    write = _write_ndjson if path.endswith('.ndjson.gz') else _write_export
+    metadata = export_metadata(count, generation)
+    platforms = platform_ids(max(count // 1000, 12))
+    safes = safe_names(max(count // 20, 1))
+
+    if entity == 'platforms':
+        ids = platform_ids(count)
+        records = (platform_record(rng, ids[i], i) for i in range(count))
+        return write(path, 'Platforms', records, metadata)
+    if entity == 'safes':
+        names = safe_names(count)
+        records = (safe_record(rng, names[i], i, 5, reject_rate) for i in range(count))
+        return write(path, 'value', records, metadata)
+    if entity == 'accounts':
+        records = (account_record(rng, i, safes, platforms) for i in range(count))
+        return write(path, 'value', records, metadata)
+    raise ValueError(f"Unknown entity: {entity}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('entity', choices=['platforms', 'safes', 'accounts'])
+    parser.add_argument('scale', help='1k, 100k, 1m or a record count')
+    parser.add_argument('path')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--reject-rate', type=float, default=0.0)
+    parser.add_argument('--generation', type=int, default=DEFAULT_GENERATION,
+                        help='export run start in epoch seconds')
+    args = parser.parse_args()
+    size = generate_export(args.entity, parse_scale(args.scale), args.path,
+                           seed=args.seed, reject_rate=args.reject_rate, generation=args.generation)
+    print(f"Wrote {args.path} ({size / 1e6:.1f} MB)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+import json
+import os
+import threading
+import time
+
+from botocore.exceptions import ClientError
+
+from ingest_logging import get_logger
+
+# Seconds a secret fetched from Secrets Manager is reused before it is read
+# again. Cached values survive between warm invocations of the same container.
+SECRET_CACHE_TTL = float(os.environ.get('SECRET_CACHE_TTL_SECONDS', '900'))
+
+logger = get_logger(__name__)
+
+_clients = {}
+_clients_lock = threading.Lock()
+_secrets = {}
+_secrets_lock = threading.Lock()
+
+
+def get_client(service):
+    """
+    Returns the shared boto3 client for service, creating it on first use.
+    boto3 itself is only imported then, so a cold start that finds nothing
+    to do never pays for it. Clients are thread-safe once created; creation
+    is serialized because the default boto3 session is not.
+    """
+    client = _clients.get(service)
+    if client is not None:
+        return client
+    with _clients_lock:
+        if service not in _clients:
+            import boto3
+            started = time.perf_counter()
+            _clients[service] = boto3.client(service)
+            logger.debug(f"Created {service} client in {time.perf_counter() - started:.3f}s")
+        return _clients[service]
+
+
+class LazyClient:
+    """
+    Stands in for a boto3 client at module level: the real client is created
+    by get_client() the first time any of its attributes is used.
+    """
+
+    def __init__(self, service):
+        self._service = service
+
+    def __getattr__(self, name):
+        return getattr(get_client(self._service), name)
+
+
+def lazy_client(service):
+    return LazyClient(service)
+
+
+def get_secret(secret_id, refresh=False):
+    """
+    Returns the parsed SecretString of secret_id, from the cache while it is
+    younger than SECRET_CACHE_TTL_SECONDS. refresh=True always reads it
+    again, e.g. after the database rejected the cached password.
+    """
+    now = time.monotonic()
+    with _secrets_lock:
+        cached = _secrets.get(secret_id)
+        if cached and not refresh and now - cached[1] < SECRET_CACHE_TTL:
+            return cached[0]
+    try:
+        response = get_client('secretsmanager').get_secret_value(SecretId=secret_id)
+    except ClientError as e:
+        logger.error(f"Error retrieving secret: {e}")
+        raise
+    value = json.loads(response['SecretString'])
+    with _secrets_lock:
+        _secrets[secret_id] = (value, now)
+    logger.info(f"Fetched secret {secret_id}.")
+    return value
+
+
+def get_db_password(secret_id, refresh=False):
+    return get_secret(secret_id, refresh=refresh)['password']
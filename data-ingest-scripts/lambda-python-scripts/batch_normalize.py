@@ -0,0 +1,180 @@
+import os
+from datetime import datetime, timedelta
+from itertools import islice
+
+from ingest_logging import RecordLog, get_logger
+
+# numpy is optional: with it epoch columns are converted in bulk, without it
+# value by value. It is available e.g. from the AWS SDK for pandas layer, and
+# imported on first use so invocations with nothing to load skip its import.
+_np = None
+_np_checked = False
+
+# Records normalized together; also bounds the memory of one chunk.
+NORMALIZE_BATCH_SIZE = int(os.environ.get('NORMALIZE_BATCH_SIZE', '5000'))
+
+logger = get_logger(__name__)
+record_log = RecordLog(logger)
+
+_EPOCH = datetime(1970, 1, 1)
+
+# datetime.min and datetime.max in microseconds since the epoch; values
+# outside cannot be represented as Python datetimes.
+_MIN_EPOCH_US = -62135596800000000
+_MAX_EPOCH_US = 253402300799999999
+
+# float64 holds every integer up to 2**53 exactly; larger epochs are
+# converted one by one.
+_MAX_EXACT_FLOAT = 2.0 ** 53
+
+
+def convert_epoch_s_to_datetime(raw_ts):
+    """
+    Converts a Unix epoch in SECONDS (e.g. 1675868057)
+    to a Python datetime object in UTC.
+    Returns None if raw_ts is missing or parsing fails.
+    """
+    if not raw_ts:
+        return None
+    try:
+        epoch_s = int(raw_ts)
+        return _EPOCH + timedelta(seconds=epoch_s)
+    except (ValueError, TypeError, OverflowError, OSError):
+        return None
+
+
+def convert_epoch_us_to_datetime(raw_ts):
+    """
+    Interprets raw_ts as MICROSECONDS since epoch.
+    Example: 1739084217619678 -> ~2025-02-08
+    """
+    if not raw_ts:
+        return None
+    try:
+        epoch_us = int(raw_ts)
+        # Integer microseconds: dividing by 1e6 could round to the next one.
+        return _EPOCH + timedelta(microseconds=epoch_us)
+    except (ValueError, TypeError, OverflowError, OSError) as e:
+        record_log.warning("Error converting microsecond timestamp %s: %s", raw_ts, e)
+        return None
+
+
+def _numpy():
+    global _np, _np_checked
+    if not _np_checked:
+        try:
+            import numpy
+            _np = numpy
+        except ImportError:
+            pass
+        _np_checked = True
+    return _np
+
+
+def _epochs_to_datetimes(values, micros_per_unit, fallback):
+    """
+    Converts a column of epoch values to datetimes in bulk. Missing, zero,
+    non-numeric and out-of-range values become None, like the scalar
+    converters. Falls back to the scalar converter without numpy or when
+    the column holds values numpy cannot parse.
+    """
+    np = _numpy()
+    if np is None:
+        return [fallback(value) for value in values]
+    try:
+        # None becomes NaN; numeric strings are parsed.
+        numbers = np.array(values, dtype='float64')
+    except (TypeError, ValueError):
+        return [fallback(value) for value in values]
+
+    # Whole seconds/microseconds, as int(raw_ts) would give, scaled in
+    # integer arithmetic so both paths give the same microsecond.
+    # Fractional values are left to the scalar converter too, as int()
+    # rejects them in strings.
+    exact = (np.abs(numbers) < _MAX_EXACT_FLOAT) & (numbers == np.trunc(numbers))
+    units = np.where(exact, np.trunc(numbers), 0).astype('int64')
+    valid = (exact & (units != 0)
+             & (units >= _MIN_EPOCH_US // micros_per_unit) & (units <= _MAX_EPOCH_US // micros_per_unit))
+    micros = np.where(valid, units * micros_per_unit, 0)
+    result = micros.astype('datetime64[us]').tolist()
+    # Missing, zero and out-of-range values (rare) go through the scalar
+    # converter, which also logs them.
+    for index in np.flatnonzero(~valid):
+        result[index] = fallback(values[index])
+    return result
+
+
+def epoch_s_column(values):
+    return _epochs_to_datetimes(values, 1000000, convert_epoch_s_to_datetime)
+
+
+def epoch_us_column(values):
+    return _epochs_to_datetimes(values, 1, convert_epoch_us_to_datetime)
+
+
+def none_if_empty_column(values):
+    return [value or None for value in values]
+
+
+class Field:
+    """
+    Declarative field mapping: the value at path (a tuple of keys into the
+    record), or default when a key is missing, optionally passed through a
+    column converter such as epoch_s_column.
+
+    A Field is also a plain extractor, field(record), so it can be used
+    wherever an (column, extractor) pair is expected.
+    """
+
+    def __init__(self, path, default=None, convert=None):
+        self.path = tuple(path) if isinstance(path, (tuple, list)) else (path,)
+        self.default = default
+        self.convert = convert
+
+    def _lookup(self, record):
+        value = record
+        for key in self.path[:-1]:
+            value = value.get(key) if isinstance(value, dict) else None
+        if not isinstance(value, dict):
+            return self.default
+        return value.get(self.path[-1], self.default)
+
+    def values(self, records):
+        """
+        Returns this field's column for a list of records.
+        """
+        if len(self.path) == 1:
+            key, default = self.path[0], self.default
+            column = [record.get(key, default) for record in records]
+        else:
+            column = [self._lookup(record) for record in records]
+        return self.convert(column) if self.convert else column
+
+    def __call__(self, record):
+        return self.values([record])[0]
+
+
+def iter_batches(records, size=None):
+    """
+    Yields lists of up to size records from an iterable of records.
+    """
+    iterator = iter(records)
+    size = size or NORMALIZE_BATCH_SIZE
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def normalize_batch(fields, records):
+    """
+    Normalizes a list of records column by column and returns one row tuple
+    per record, in field order.
+    """
+    columns = [extractor.values(records) for _, extractor in fields]
+    return list(zip(*columns))
+
+
+def is_columnar(fields):
+    return all(isinstance(extractor, Field) for _, extractor in fields)
@@ -0,0 +1,400 @@
+import io
+import json
+import os
+import time
+from collections import namedtuple
+from datetime import date
+
+import psycopg2
+from psycopg2 import sql
+from psycopg2.extras import execute_values
+
+from ingest_logging import get_logger, log_summary
+from ingest_metrics import current_metrics
+
+# Rows sent to RDS per multi-row INSERT into the staging table.
+# Override with the UPSERT_BATCH_SIZE environment variable on the Lambda.
+DEFAULT_BATCH_SIZE = int(os.environ.get('UPSERT_BATCH_SIZE', '5000'))
+
+# 'isolate' rejects bad rows to pam_ingest_rejects and commits the rest;
+# 'fail' aborts the whole file on the first bad row.
+REJECT_MODE = os.environ.get('REJECT_MODE', 'isolate').lower()
+
+# 'copy' stages each batch with COPY ... FROM STDIN, 'insert' with a multi-row
+# INSERT. COPY skips psycopg2's per-value SQL quoting, the main CPU cost of
+# staging; a batch COPY rejects falls back to INSERTs to isolate the bad rows.
+STAGE_METHOD = os.environ.get('STAGE_METHOD', 'copy').lower()
+
+# Past this many rejected rows per table the file is treated as broken.
+MAX_REJECTED_ROWS = int(os.environ.get('MAX_REJECTED_ROWS', '1000'))
+
+# Only errors caused by the data itself are isolated; anything else
+# (lost connection, missing table) aborts the file as before.
+_ROW_ERRORS = (psycopg2.DataError, psycopg2.IntegrityError)
+
+# Backslash escapes of COPY's text format.
+_COPY_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'})
+
+UpsertResult = namedtuple('UpsertResult', ['staged', 'inserted', 'updated', 'unchanged', 'rejected'])
+
+# A surrogate key resolved during the merge: column of the target is set to
+# the same-named column of the table row whose `on` column matches the
+# staged row's, or NULL when there is none.
+KeyLookup = namedtuple('KeyLookup', ['column', 'table', 'on'])
+
+logger = get_logger(__name__)
+
+
+class TooManyRejectsError(Exception):
+    pass
+
+
+def copy_value(value):
+    """
+    Renders one value in COPY text format.
+    """
+    if value is None:
+        return '\\N'
+    if value is True:
+        return 't'
+    if value is False:
+        return 'f'
+    if isinstance(value, str):
+        return value.translate(_COPY_ESCAPES)
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, (dict, list)):
+        return json.dumps(value).translate(_COPY_ESCAPES)
+    return str(value).translate(_COPY_ESCAPES)
+
+
+def reject_row(cursor, table, source_key, record, error):
+    """
+    Writes a rejected record to the pam_ingest_rejects dead-letter table.
+    Runs in the caller's transaction, so rejects commit with the good rows.
+    """
+    cursor.execute("""
+        INSERT INTO pam_ingest_rejects (target_table, source_key, record, error)
+        VALUES (%s, %s, %s, %s)
+    """, (table, source_key, json.dumps(record, default=str), error))
+
+
+class BulkUpsert:
+    """
+    Stages rows into a temporary table in multi-row batches and merges them
+    into the target table with a single INSERT ... SELECT ... ON CONFLICT.
+
+    update_columns defaults to every column not in conflict_columns; pass an
+    empty list to get ON CONFLICT DO NOTHING semantics. source_key names the
+    S3 object the rows came from and is recorded with any rejected rows.
+    lookups are KeyLookups resolving foreign surrogate keys in the merge.
+    """
+
+    def __init__(self, cursor, table, columns, conflict_columns,
+                 update_columns=None, batch_size=None, source_key=None, lookups=()):
+        self.cursor = cursor
+        self.table = table
+        self.columns = list(columns)
+        self.conflict_columns = list(conflict_columns)
+        if update_columns is None:
+            update_columns = [c for c in self.columns if c not in self.conflict_columns]
+        self.update_columns = list(update_columns)
+        self.batch_size = batch_size or DEFAULT_BATCH_SIZE
+        self.source_key = source_key
+        self.lookups = list(lookups)
+        self.isolate_errors = REJECT_MODE == 'isolate'
+        self.stage_table = f"stage_{table}"
+        self.staged_count = 0
+        self.rejected_count = 0
+        self._pending = []
+        self._started = time.monotonic()
+        self._insert_sql = sql.SQL("INSERT INTO {stage} ({cols}) VALUES %s").format(
+            stage=sql.Identifier(self.stage_table),
+            cols=sql.SQL(', ').join(map(sql.Identifier, self.columns))
+        ).as_string(cursor)
+        self._copy_sql = sql.SQL("COPY {stage} ({cols}) FROM STDIN").format(
+            stage=sql.Identifier(self.stage_table),
+            cols=sql.SQL(', ').join(map(sql.Identifier, self.columns))
+        ).as_string(cursor)
+        self._create_stage_table()
+
+    def _create_stage_table(self):
+        # The staging table copies the target column types (so bad values fail
+        # here rather than in the merge) and disappears at commit.
+        self.cursor.execute(
+            sql.SQL("DROP TABLE IF EXISTS {stage}").format(
+                stage=sql.Identifier(self.stage_table)
+            )
+        )
+        self.cursor.execute(
+            sql.SQL(
+                "CREATE TEMP TABLE {stage} ON COMMIT DROP AS "
+                "SELECT {cols} FROM {table} WITH NO DATA"
+            ).format(
+                stage=sql.Identifier(self.stage_table),
+                cols=sql.SQL(', ').join(map(sql.Identifier, self.columns)),
+                table=sql.Identifier(self.table)
+            )
+        )
+        # stage_seq preserves arrival order so the last duplicate key wins.
+        self.cursor.execute(
+            sql.SQL("ALTER TABLE {stage} ADD COLUMN stage_seq bigserial").format(
+                stage=sql.Identifier(self.stage_table)
+            )
+        )
+
+    def add(self, row):
+        self._pending.append(row)
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def extend(self, rows):
+        for row in rows:
+            self.add(row)
+
+    def flush(self):
+        """
+        Sends the pending rows to the staging table in one round trip.
+        """
+        if not self._pending:
+            return
+        rows = self._pending
+        self._pending = []
+        with current_metrics().timer('Stage'):
+            if STAGE_METHOD == 'copy' and self._copy_rows(rows):
+                return
+            self._stage_rows(rows)
+
+    def _copy_rows(self, rows):
+        """
+        Streams rows into the staging table with COPY. Returns False, with the
+        batch rolled back, when a value is rejected so the caller can stage
+        it with INSERTs instead and isolate the offending rows.
+        """
+        buffer = io.StringIO()
+        buffer.writelines('\t'.join([copy_value(value) for value in row]) + '\n' for row in rows)
+        buffer.seek(0)
+        if not self.isolate_errors:
+            self.cursor.copy_expert(self._copy_sql, buffer)
+            self.staged_count += len(rows)
+            return True
+
+        self.cursor.execute("SAVEPOINT bulk_copy")
+        try:
+            self.cursor.copy_expert(self._copy_sql, buffer)
+        except _ROW_ERRORS:
+            self.cursor.execute("ROLLBACK TO SAVEPOINT bulk_copy; RELEASE SAVEPOINT bulk_copy")
+            return False
+        self.cursor.execute("RELEASE SAVEPOINT bulk_copy")
+        self.staged_count += len(rows)
+        return True
+
+    def _stage_rows(self, rows):
+        if not self.isolate_errors:
+            execute_values(self.cursor, self._insert_sql, rows, page_size=len(rows))
+            self.staged_count += len(rows)
+            return
+
+        try:
+            # The savepoint and its release travel in the same round trip as
+            # the insert, so a clean batch costs nothing extra.
+            execute_values(
+                self.cursor,
+                f"SAVEPOINT bulk_stage; {self._insert_sql}; RELEASE SAVEPOINT bulk_stage",
+                rows,
+                page_size=len(rows)
+            )
+            self.staged_count += len(rows)
+        except _ROW_ERRORS as e:
+            self.cursor.execute("ROLLBACK TO SAVEPOINT bulk_stage; RELEASE SAVEPOINT bulk_stage")
+            if len(rows) == 1:
+                self._reject(dict(zip(self.columns, rows[0])), e)
+                return
+            # Bisect so a single bad row costs O(log batch) extra statements.
+            mid = len(rows) // 2
+            self._stage_rows(rows[:mid])
+            self._stage_rows(rows[mid:])
+
+    def _reject(self, record, error):
+        self.rejected_count += 1
+        message = str(error).strip()
+        logger.warning(f"Rejected row for {self.table} from {self.source_key}: {message}")
+        reject_row(self.cursor, self.table, self.source_key, record, message)
+        if self.rejected_count > MAX_REJECTED_ROWS:
+            raise TooManyRejectsError(
+                f"More than {MAX_REJECTED_ROWS} rows rejected for {self.table}; aborting file."
+            )
+
+    def _merge_sql(self, seq_range):
+        cols = sql.SQL(', ').join(map(sql.Identifier, self.columns))
+        conflict_cols = sql.SQL(', ').join(map(sql.Identifier, self.conflict_columns))
+        table = sql.Identifier(self.table)
+        stage = sql.Identifier(self.stage_table)
+
+        # Keys are looked up per distinct row through the parent's unique
+        # index on `on`. They are not part of row_hash, so a key filled in
+        # later updates the row without it counting as a content change.
+        key_columns = [lookup.column for lookup in self.lookups]
+        lookups = sql.SQL('').join(
+            sql.SQL(", (SELECT r.{column} FROM {parent} r WHERE r.{on} = {stage}.{on}) AS {column}").format(
+                column=sql.Identifier(lookup.column),
+                parent=sql.Identifier(lookup.table),
+                on=sql.Identifier(lookup.on),
+                stage=stage
+            )
+            for lookup in self.lookups
+        )
+        target_cols = sql.SQL(', ').join(map(sql.Identifier, self.columns + key_columns))
+
+        if self.update_columns:
+            target_cols = sql.SQL('{cols}, row_hash').format(cols=target_cols)
+            row_hash = sql.SQL(', md5(ROW({cols})::text) AS row_hash').format(cols=cols)
+            conflict_action = sql.SQL(
+                "DO UPDATE SET {assignments}, row_hash = EXCLUDED.row_hash "
+                "WHERE {table}.row_hash IS DISTINCT FROM EXCLUDED.row_hash{key_changed}"
+            ).format(
+                assignments=sql.SQL(', ').join(
+                    sql.SQL("{col} = EXCLUDED.{col}").format(col=sql.Identifier(c))
+                    for c in self.update_columns + key_columns
+                ),
+                table=table,
+                key_changed=sql.SQL('').join(
+                    sql.SQL(" OR {table}.{col} IS DISTINCT FROM EXCLUDED.{col}").format(
+                        table=table, col=sql.Identifier(c)
+                    )
+                    for c in key_columns
+                )
+            )
+        else:
+            row_hash = sql.SQL('')
+            conflict_action = sql.SQL("DO NOTHING")
+        # Every row DO NOTHING returns is an insert; partitioned targets
+        # cannot return xmax.
+        inserted = sql.SQL("(xmax = 0)" if self.update_columns else "true")
+
+        if seq_range:
+            where = sql.SQL("WHERE stage_seq BETWEEN %(lo)s AND %(hi)s ")
+        else:
+            where = sql.SQL('')
+
+        # RETURNING only yields rows that were actually written; xmax = 0
+        # distinguishes fresh inserts from updates of existing rows.
+        return sql.SQL(
+            "WITH src AS ("
+            "SELECT DISTINCT ON ({conflict_cols}) {cols}{lookups}{row_hash} FROM {stage} {where}"
+            "ORDER BY {conflict_cols}, stage_seq DESC"
+            "), merged AS ("
+            "INSERT INTO {table} ({target_cols}) SELECT * FROM src "
+            "ON CONFLICT ({conflict_cols}) {conflict_action} "
+            "RETURNING {inserted} AS inserted"
+            ") "
+            "SELECT (SELECT count(*) FROM src), "
+            "count(*) FILTER (WHERE inserted), "
+            "count(*) FILTER (WHERE NOT inserted) "
+            "FROM merged"
+        ).format(
+            table=table,
+            cols=cols,
+            target_cols=target_cols,
+            lookups=lookups,
+            row_hash=row_hash,
+            conflict_cols=conflict_cols,
+            stage=stage,
+            where=where,
+            conflict_action=conflict_action,
+            inserted=inserted
+        )
+
+    def _merge_range(self, lo, hi):
+        """
+        Merges staged rows with lo <= stage_seq <= hi inside a savepoint,
+        bisecting on failure until the offending rows are isolated.
+        Returns (distinct, inserted, updated) counts.
+        """
+        try:
+            self.cursor.execute("SAVEPOINT bulk_merge")
+            self.cursor.execute(self._merge_sql(seq_range=True), {'lo': lo, 'hi': hi})
+            counts = self.cursor.fetchone()
+            self.cursor.execute("RELEASE SAVEPOINT bulk_merge")
+            return counts
+        except _ROW_ERRORS as e:
+            self.cursor.execute("ROLLBACK TO SAVEPOINT bulk_merge; RELEASE SAVEPOINT bulk_merge")
+            if lo == hi:
+                self.cursor.execute(
+                    sql.SQL("SELECT {cols} FROM {stage} WHERE stage_seq = %s").format(
+                        cols=sql.SQL(', ').join(map(sql.Identifier, self.columns)),
+                        stage=sql.Identifier(self.stage_table)
+                    ),
+                    (lo,)
+                )
+                row = self.cursor.fetchone()
+                if row is not None:
+                    self._reject(dict(zip(self.columns, row)), e)
+                return (0, 0, 0)
+            mid = (lo + hi) // 2
+            first = self._merge_range(lo, mid)
+            second = self._merge_range(mid + 1, hi)
+            return tuple(a + b for a, b in zip(first, second))
+
+    def merge(self):
+        """
+        Flushes any remaining rows and merges the staging table into the target.
+
+        When the upsert updates on conflict, an md5 content hash of each row is
+        stored in the target's row_hash column and rows whose hash did not
+        change are skipped, so unchanged records create no dead tuples.
+        Returns an UpsertResult with staged/inserted/updated/unchanged/rejected counts.
+        """
+        self.flush()
+        if not self.isolate_errors:
+            self.cursor.execute(self._merge_sql(seq_range=False))
+            counts = self.cursor.fetchone()
+        else:
+            try:
+                self.cursor.execute("SAVEPOINT bulk_merge")
+                self.cursor.execute(self._merge_sql(seq_range=False))
+                counts = self.cursor.fetchone()
+                self.cursor.execute("RELEASE SAVEPOINT bulk_merge")
+            except _ROW_ERRORS as e:
+                # Slow path: only taken when some staged row violates a
+                # constraint of the target table (e.g. NOT NULL).
+                logger.warning(f"Merge into {self.table} failed ({str(e).strip()}); isolating bad rows.")
+                self.cursor.execute("ROLLBACK TO SAVEPOINT bulk_merge; RELEASE SAVEPOINT bulk_merge")
+                self.cursor.execute(
+                    sql.SQL("SELECT min(stage_seq), max(stage_seq) FROM {stage}").format(
+                        stage=sql.Identifier(self.stage_table)
+                    )
+                )
+                lo, hi = self.cursor.fetchone()
+                counts = self._merge_range(lo, hi)
+
+        distinct_count, inserted, updated = counts
+        result = UpsertResult(
+            staged=self.staged_count,
+            inserted=inserted,
+            updated=updated,
+            unchanged=distinct_count - inserted - updated,
+            rejected=self.rejected_count
+        )
+
+        elapsed = time.monotonic() - self._started
+        rate = self.staged_count / elapsed if elapsed > 0 else 0
+        log_summary(
+            logger, f"Upserted {self.staged_count} rows into {self.table}",
+            table=self.table, source_key=self.source_key, seconds=round(elapsed, 3),
+            rows_per_sec=round(rate), **result._asdict()
+        )
+        return result
+
+
+def bulk_upsert(cursor, table, columns, conflict_columns, rows,
+                update_columns=None, batch_size=None, source_key=None, lookups=()):
+    """
+    Convenience wrapper: stages every row from the iterable and merges them.
+    Returns an UpsertResult.
+    """
+    upsert = BulkUpsert(cursor, table, columns, conflict_columns,
+                        update_columns=update_columns, batch_size=batch_size,
+                        source_key=source_key, lookups=lookups)
+    upsert.extend(rows)
+    return upsert.merge()
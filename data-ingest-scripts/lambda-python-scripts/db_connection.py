@@ -0,0 +1,163 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg2
+from psycopg2 import extensions
+
+from aws_clients import get_db_password
+from ingest_logging import get_logger
+
+# Seconds a connection may sit idle before it is health-checked again.
+HEALTH_CHECK_INTERVAL = float(os.environ.get('DB_HEALTH_CHECK_SECONDS', '30'))
+CONNECT_TIMEOUT = int(os.environ.get('DB_CONNECT_TIMEOUT', '10'))
+
+logger = get_logger(__name__)
+
+# Extra libpq options: TCP keepalives let a frozen Lambda notice dead sockets,
+# and application_name makes the loaders visible in pg_stat_activity.
+_CONNECT_OPTIONS = {
+    'connect_timeout': CONNECT_TIMEOUT,
+    'keepalives': 1,
+    'keepalives_idle': 30,
+    'keepalives_interval': 10,
+    'keepalives_count': 3,
+    'application_name': os.environ.get('AWS_LAMBDA_FUNCTION_NAME', 'cabi-loader')
+}
+
+# Idle connections kept for reuse. Module-level state survives between warm
+# invocations of the same container; the lock lets parallel ingest workers
+# each check out their own connection.
+MAX_IDLE_CONNECTIONS = int(os.environ.get('DB_POOL_SIZE', '4'))
+_idle = []
+_lock = threading.Lock()
+
+
+def _is_healthy(conn):
+    """
+    Returns True if the connection can still run a query. Leaves the
+    connection idle (no open transaction) so a transaction-mode pooler such
+    as PgBouncer or RDS Proxy can hand the server connection to someone else.
+    """
+    try:
+        if conn.get_transaction_status() != extensions.TRANSACTION_STATUS_IDLE:
+            conn.rollback()
+        with conn.cursor() as cursor:
+            cursor.execute("SELECT 1")
+        conn.rollback()
+        return True
+    except psycopg2.Error as e:
+        logger.warning(f"Database connection is stale, reconnecting: {e}")
+        return False
+
+
+def _close(conn):
+    try:
+        conn.close()
+    except psycopg2.Error:
+        pass
+
+
+def close_connections():
+    """
+    Closes every idle pooled connection.
+    """
+    with _lock:
+        idle = [conn for conn, _ in _idle]
+        del _idle[:]
+    for conn in idle:
+        _close(conn)
+    if idle:
+        logger.info(f"Closed {len(idle)} database connections.")
+
+
+def get_connection(config):
+    """
+    Checks out a pooled connection, reconnecting when none is idle or the
+    idle one fails its health check. Only connections idle for longer than
+    DB_HEALTH_CHECK_SECONDS are checked, so back-to-back files pay nothing.
+    Return it with release_connection().
+    """
+    while True:
+        with _lock:
+            if not _idle:
+                break
+            conn, last_used = _idle.pop()
+        if conn.closed:
+            continue
+        if time.monotonic() - last_used < HEALTH_CHECK_INTERVAL or _is_healthy(conn):
+            return conn
+        _close(conn)
+
+    logger.info("Opening database connection.")
+    return _connect(config)
+
+
+def _is_auth_failure(error):
+    # Authentication errors arrive before a session exists, often without a pgcode.
+    return error.pgcode == '28P01' or 'password authentication failed' in str(error)
+
+
+def _connect(config):
+    """
+    Opens a connection. A config with 'secret_name' instead of 'password'
+    reads the password from Secrets Manager through the secret cache; if the
+    database rejects it (the secret was rotated), the secret is read again
+    and the connection retried once.
+    """
+    config = dict(config)
+    secret_name = config.pop('secret_name', None)
+    if secret_name is None:
+        return psycopg2.connect(**{**_CONNECT_OPTIONS, **config})
+
+    config['password'] = get_db_password(secret_name)
+    try:
+        return psycopg2.connect(**{**_CONNECT_OPTIONS, **config})
+    except psycopg2.OperationalError as e:
+        if not _is_auth_failure(e):
+            raise
+        logger.warning("Database rejected the cached password, refreshing the secret.")
+    config['password'] = get_db_password(secret_name, refresh=True)
+    return psycopg2.connect(**{**_CONNECT_OPTIONS, **config})
+
+
+def release_connection(conn):
+    """
+    Returns a connection to the idle pool, or closes it if the pool is full
+    or the connection is no longer usable.
+    """
+    if conn.closed:
+        return
+    with _lock:
+        if len(_idle) < MAX_IDLE_CONNECTIONS:
+            _idle.append((conn, time.monotonic()))
+            return
+    _close(conn)
+
+
+@contextmanager
+def transaction(config):
+    """
+    Yields a cursor on a pooled connection inside one transaction that is
+    committed on success and rolled back on any exception. Each file is
+    loaded in its own transaction; no session state (SET, prepared
+    statements, session temp tables) is kept between transactions, so this
+    also works behind a transaction-pooling proxy.
+    """
+    conn = get_connection(config)
+    cursor = conn.cursor()
+    try:
+        yield cursor
+        conn.commit()
+    except Exception:
+        try:
+            conn.rollback()
+        except psycopg2.Error:
+            pass
+        raise
+    finally:
+        if not cursor.closed:
+            cursor.close()
+        # A dropped connection is discarded here and replaced on next use.
+        release_connection(conn)
@@ -0,0 +1,232 @@
+import os
+from datetime import datetime
+
+from psycopg2 import sql
+
+from ingest_logging import get_logger, log_summary
+
+# Months of history kept; older monthly partitions are detached (and dropped
+# unless HISTORY_KEEP_DETACHED is set, e.g. to archive them first). 0 keeps all.
+RETENTION_MONTHS = int(os.environ.get('HISTORY_RETENTION_MONTHS', '24'))
+KEEP_DETACHED = os.environ.get('HISTORY_KEEP_DETACHED', 'false').lower() == 'true'
+
+# Versions opened or closed by one load above which the month's partition is
+# analyzed in the same transaction. A partition filled by a single load has
+# no statistics until autovacuum reaches it, and the next load's joins are
+# then planned as if it were empty (nested loops over every version).
+ANALYZE_THRESHOLD = int(os.environ.get('HISTORY_ANALYZE_THRESHOLD', '1000'))
+
+logger = get_logger(__name__)
+
+# History partitions already known to exist in this container.
+_ready_partitions = set()
+
+
+def history_table(table):
+    return f"{table}_history"
+
+
+def _month_start(moment):
+    return datetime(moment.year, moment.month, 1)
+
+
+def _add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def _partition_name(table, month):
+    return f"{history_table(table)}_p{month:%Y%m}"
+
+
+def _ensure_partition(cursor, table, columns, month):
+    """
+    Creates the partition for month if needed. Opening a new month carries
+    the versions still open in earlier months into it, keeping their
+    valid_from, closes the earlier copies at the month boundary and applies
+    retention. Returns True when the partition was created.
+    """
+    name = _partition_name(table, month)
+    if name in _ready_partitions:
+        return False
+    cursor.execute("SELECT to_regclass(%s)", (name,))
+    if cursor.fetchone()[0] is not None:
+        _ready_partitions.add(name)
+        return False
+
+    logger.info(f"Creating history partition {name}.")
+    history = sql.Identifier(history_table(table))
+    cursor.execute(
+        sql.SQL(
+            "CREATE TABLE IF NOT EXISTS {partition} PARTITION OF {history} "
+            "FOR VALUES FROM (%s) TO (%s)"
+        ).format(partition=sql.Identifier(name), history=history),
+        (month.date(), _add_months(month, 1).date())
+    )
+    carried_columns = sql.SQL(', ').join(map(sql.Identifier, list(columns) + ['row_hash', 'valid_from']))
+    cursor.execute(
+        sql.SQL(
+            "WITH carried AS ("
+            "UPDATE {history} SET valid_to = %(month_start)s "
+            "WHERE period_month < %(month)s AND valid_to IS NULL "
+            "RETURNING {columns}) "
+            "INSERT INTO {history} (period_month, {columns}) "
+            "SELECT %(month)s, {columns} FROM carried"
+        ).format(history=history, columns=carried_columns),
+        {'month': month.date(), 'month_start': month}
+    )
+    logger.info(f"Carried {cursor.rowcount} open versions into {name}.")
+    detach_expired_partitions(cursor, table, month)
+    return True
+
+
+def detach_expired_partitions(cursor, table, current_month, retention_months=None):
+    """
+    Detaches history partitions older than retention_months before
+    current_month, then drops them unless HISTORY_KEEP_DETACHED is set.
+    """
+    retention_months = RETENTION_MONTHS if retention_months is None else retention_months
+    if retention_months <= 0:
+        return
+    oldest_kept = _partition_name(table, _add_months(current_month, -retention_months))
+    cursor.execute("""
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = %s::regclass
+        ORDER BY c.relname
+    """, (history_table(table),))
+    # Partition names end in _pYYYYMM, so name order is month order.
+    expired = [name for (name,) in cursor.fetchall() if name < oldest_kept]
+
+    history = sql.Identifier(history_table(table))
+    for name in expired:
+        logger.info(f"Detaching expired history partition {name}.")
+        cursor.execute(
+            sql.SQL("ALTER TABLE {history} DETACH PARTITION {partition}").format(
+                history=history, partition=sql.Identifier(name)
+            )
+        )
+        if not KEEP_DETACHED:
+            cursor.execute(sql.SQL("DROP TABLE {partition}").format(partition=sql.Identifier(name)))
+        _ready_partitions.discard(name)
+
+
+def record_history(cursor, upsert, snapshot_time=None):
+    """
+    Records SCD2 versions of the rows an upsert just merged into
+    <table>_history (see pam_schema), in the partition of the snapshot's
+    month.
+
+    Only keys present in the upsert's staging table are touched. A version
+    is closed (valid_to = snapshot_time) when the current row's row_hash
+    differs from it, and a new open version is added for keys without one.
+    Each month's partition starts with the versions still open when the
+    month began (see _ensure_partition), so an "as of" query only needs to
+    read one partition.
+    Must run in the same transaction as upsert.merge().
+    """
+    snapshot_time = snapshot_time or datetime.utcnow()
+    month = _month_start(snapshot_time)
+    table = upsert.table
+    _ensure_partition(cursor, table, upsert.columns, month)
+
+    history = sql.Identifier(history_table(table))
+    current = sql.Identifier(table)
+    keys = sql.SQL(', ').join(map(sql.Identifier, upsert.conflict_columns))
+    staged_keys = sql.SQL("({current_keys}) IN (SELECT {keys} FROM {stage})").format(
+        current_keys=sql.SQL(', ').join(
+            sql.SQL("c.{column}").format(column=sql.Identifier(column))
+            for column in upsert.conflict_columns
+        ),
+        keys=keys,
+        stage=sql.Identifier(upsert.stage_table)
+    )
+
+    def join_on(left, right):
+        return sql.SQL(' AND ').join(
+            sql.SQL("{left}.{column} = {right}.{column}").format(
+                left=sql.Identifier(left), right=sql.Identifier(right),
+                column=sql.Identifier(column)
+            )
+            for column in upsert.conflict_columns
+        )
+
+    params = {
+        'month': month.date(),
+        'snapshot_time': snapshot_time,
+    }
+
+    cursor.execute(
+        sql.SQL(
+            "UPDATE {history} h SET valid_to = %(snapshot_time)s "
+            "FROM {current} c "
+            "WHERE h.period_month = %(month)s AND h.valid_to IS NULL AND {join} "
+            "AND h.row_hash IS DISTINCT FROM c.row_hash AND {staged_keys}"
+        ).format(
+            history=history, current=current, join=join_on('h', 'c'), staged_keys=staged_keys
+        ),
+        params
+    )
+    closed = cursor.rowcount
+
+    cursor.execute(
+        sql.SQL(
+            "INSERT INTO {history} (period_month, {columns}, row_hash, valid_from) "
+            "SELECT %(month)s, {current_columns}, c.row_hash, %(snapshot_time)s "
+            "FROM {current} c "
+            "WHERE {staged_keys} AND NOT EXISTS ("
+            "SELECT 1 FROM {history} h WHERE h.period_month = %(month)s "
+            "AND h.valid_to IS NULL AND {open_join})"
+        ).format(
+            history=history,
+            current=current,
+            columns=sql.SQL(', ').join(map(sql.Identifier, upsert.columns)),
+            current_columns=sql.SQL(', ').join(
+                sql.SQL("c.{column}").format(column=sql.Identifier(column))
+                for column in upsert.columns
+            ),
+            staged_keys=staged_keys,
+            open_join=join_on('h', 'c')
+        ),
+        params
+    )
+    opened = cursor.rowcount
+
+    if opened + closed >= ANALYZE_THRESHOLD:
+        cursor.execute(
+            sql.SQL("ANALYZE {partition}").format(partition=sql.Identifier(_partition_name(table, month)))
+        )
+
+    log_summary(logger, f"Recorded history for {table}", table=history_table(table),
+                period_month=f"{month:%Y-%m}", opened=opened, closed=closed)
+    return opened, closed
+
+
+def close_retired_versions(cursor, table, conflict_columns, keys_table, snapshot_time=None):
+    """
+    Closes (valid_to = snapshot_time) the open versions of the rows listed
+    in keys_table, e.g. the rows a snapshot sweep just retired, so an "as of"
+    query stops returning them from that time on. Returns the versions closed.
+    """
+    snapshot_time = snapshot_time or datetime.utcnow()
+    month = _month_start(snapshot_time)
+    # Open versions live in the newest partition, which is an earlier
+    # month's until this month's is created.
+    cursor.execute(
+        sql.SQL(
+            "UPDATE {history} h SET valid_to = %s FROM {keys} r "
+            "WHERE h.period_month <= %s AND h.valid_to IS NULL AND {join}"
+        ).format(
+            history=sql.Identifier(history_table(table)),
+            keys=sql.Identifier(keys_table),
+            join=sql.SQL(' AND ').join(
+                sql.SQL("h.{column} = r.{column}").format(column=sql.Identifier(column))
+                for column in conflict_columns
+            )
+        ),
+        (snapshot_time, month.date())
+    )
+    closed = cursor.rowcount
+    log_summary(logger, f"Closed history of retired {table} rows", table=history_table(table),
+                period_month=f"{month:%Y-%m}", closed=closed)
+    return closed
@@ -0,0 +1,230 @@
+import time
+
+from batch_normalize import is_columnar, iter_batches, normalize_batch
+from bulk_upsert import BulkUpsert
+from entity_history import close_retired_versions, record_history
+from ingest_logging import RecordLog, get_logger, log_summary
+from ingest_metrics import current_metrics
+from ingest_scheduler import export_timestamp
+from json_stream import EXPORT_SUFFIXES, load_records
+from parquet_snapshots import open_snapshot
+from snapshot_sweep import swept_table, sweep_snapshot
+
+# Registered loaders by name, in registration order (which is also the
+# order parents must be loaded in, e.g. platforms and safes before accounts).
+LOADERS = {}
+
+logger = get_logger(__name__)
+record_log = RecordLog(logger)
+
+
+class ChildTable:
+    """
+    Rows derived from a nested array of each record, e.g. the accounts
+    listed inside a safe. extract(record) returns the nested items and each
+    field extractor is called as fn(record, item).
+    """
+
+    def __init__(self, table, fields, conflict_columns, extract, update_columns=None, lookups=()):
+        self.table = table
+        self.fields = fields
+        self.columns = [column for column, _ in fields]
+        self.conflict_columns = conflict_columns
+        self.extract = extract
+        self.update_columns = update_columns
+        self.lookups = list(lookups)
+
+    def rows(self, record):
+        for item in self.extract(record):
+            yield tuple(fn(record, item) for _, fn in self.fields)
+
+
+class EntityLoader:
+    """
+    Declares how one CyberArk export maps onto a table.
+
+    prefix        S3 key prefix of the exports, e.g. 'accounts-'. JSON and
+                  NDJSON exports are read, compressed or not (EXPORT_SUFFIXES).
+    records_key   Top-level JSON array holding the records ('value', 'Platforms').
+    table         Target table; conflict_columns is its natural key.
+    fields        (column, extractor) pairs; extractor(record) returns the value.
+                  When every extractor is a batch_normalize.Field, records are
+                  normalized a batch at a time, column by column.
+                  The first field is the record key: records where it is empty
+                  are skipped.
+    validate      Optional hook called with each accepted record.
+    children      ChildTable definitions loaded after the parent table.
+    lookups       bulk_upsert.KeyLookups filling foreign surrogate keys.
+    depends_on    Names of loaders whose files are loaded before this one's
+                  in the same run, so the keys it looks up already exist.
+    history       Also keep SCD2 versions of the table in <table>_history,
+                  which a pam_schema migration creates.
+    soft_delete   Retire rows (and child rows) a complete full export no
+                  longer lists by setting deleted_at; see snapshot_sweep.
+    summaries     Hooks keeping derived tables current, called as
+                  before_merge(cursor, upsert), after_sweep(cursor, retired)
+                  and after_merge(cursor).
+    """
+
+    def __init__(self, name, prefix, records_key, table, fields, conflict_columns,
+                 validate=None, children=(), history=False, soft_delete=False,
+                 summaries=(), lookups=(), depends_on=()):
+        self.name = name
+        self.prefix = prefix
+        # Where earlier versions renamed loaded files; skipped when listing.
+        self.processed_prefix = f"{name}-processed-"
+        # Scheduled runs list each of these from its own watermark; the keys
+        # under each one must sort by their export timestamp.
+        self.listing_prefixes = [prefix]
+        self.suffix = EXPORT_SUFFIXES
+        self.records_key = records_key
+        self.table = table
+        self.fields = fields
+        self.columns = [column for column, _ in fields]
+        self.columnar = is_columnar(fields)
+        self.conflict_columns = conflict_columns
+        self.validate = validate
+        self.children = list(children)
+        self.history = history
+        self.soft_delete = soft_delete
+        self.summaries = list(summaries)
+        self.lookups = list(lookups)
+        self.depends_on = list(depends_on)
+        # Every export is a full snapshot or a delta, so pending exports
+        # older than the newest full snapshot are skipped (supersede_snapshots).
+        self.snapshots = True
+
+    def handles(self, key):
+        return (key.startswith(self.prefix)
+                and not key.startswith(self.processed_prefix)
+                and key.endswith(self.suffix))
+
+    def read_records(self, body, key, export=None):
+        return load_records(body, self.records_key, object_key=key, export=export)
+
+    def rows(self, record):
+        return tuple(fn(record) for _, fn in self.fields)
+
+    def process(self, records, cursor, source_key=None, export=None):
+        """
+        Bulk upserts every record into the table and its child tables in a
+        single pass. `export` is the file's export metadata, filled in while
+        the records are read. Returns the parent table's UpsertResult.
+        """
+        logger.info(f"Starting {self.name} data processing...")
+        metrics = current_metrics()
+        upsert = BulkUpsert(cursor, self.table, self.columns, self.conflict_columns,
+                            source_key=source_key, lookups=self.lookups)
+        child_upserts = [
+            BulkUpsert(cursor, child.table, child.columns, child.conflict_columns,
+                       update_columns=child.update_columns, source_key=source_key,
+                       lookups=child.lookups)
+            for child in self.children
+        ]
+        # Optional Parquet copies of the normalized rows for analytics
+        # (a no-op unless PARQUET_SNAPSHOT_URI is set).
+        snapshot = open_snapshot(cursor, self.name, self.table, self.columns, source_key)
+        child_snapshots = [
+            open_snapshot(cursor, child.table.replace('pam_', '', 1), child.table,
+                          child.columns, source_key)
+            for child in self.children
+        ]
+
+        try:
+            transform_seconds = 0.0
+            for batch in iter_batches(records):
+                # Transform: field extraction, conversions and validation;
+                # staging round trips are timed separately by BulkUpsert.
+                started = time.perf_counter()
+                if self.columnar:
+                    rows = normalize_batch(self.fields, batch)
+                else:
+                    rows = [self.rows(record) for record in batch]
+                accepted = []
+                for record, row in zip(batch, rows):
+                    if not row[0]:
+                        record_log.warning("Skipping %s record with missing %s: %s",
+                                           self.name, self.columns[0], record)
+                        continue
+                    record_log.debug("Processing %s record: %s", self.name, row[0])
+                    if self.validate:
+                        self.validate(record)
+                    accepted.append((row, [list(child.rows(record)) for child in self.children]))
+                transform_seconds += time.perf_counter() - started
+
+                for row, child_rows in accepted:
+                    upsert.add(row)
+                    snapshot.add(row)
+                    for rows_of_child, child_upsert, child_snapshot in zip(
+                            child_rows, child_upserts, child_snapshots):
+                        for child_row in rows_of_child:
+                            child_upsert.add(child_row)
+                            child_snapshot.add(child_row)
+            metrics.add_time('Transform', transform_seconds)
+
+            # Summaries see the staged rows before the merge overwrites the old values.
+            for each in [upsert] + child_upserts:
+                each.flush()
+            with metrics.timer('Summaries'):
+                for summary in self.summaries:
+                    summary.before_merge(cursor, upsert)
+
+            # Parents are merged first so child rows always reference an existing parent.
+            with metrics.timer('Merge'):
+                result = upsert.merge()
+                for child_upsert in child_upserts:
+                    child_upsert.merge()
+            # Versions and deletions are stamped with the export time, not the load time.
+            snapshot_time = export_timestamp(source_key or '')
+            if self.history:
+                with metrics.timer('History'):
+                    record_history(cursor, upsert, snapshot_time)
+            if self.soft_delete:
+                with metrics.timer('Sweep'):
+                    retired = sweep_snapshot(cursor, self.name, [upsert] + child_upserts, export,
+                                             source_key, snapshot_time)
+                if retired.get(self.table) and self.history:
+                    with metrics.timer('History'):
+                        close_retired_versions(cursor, self.table, self.conflict_columns,
+                                               swept_table(self.table), snapshot_time)
+                with metrics.timer('Summaries'):
+                    for summary in self.summaries:
+                        summary.after_sweep(cursor, retired)
+            with metrics.timer('Summaries'):
+                for summary in self.summaries:
+                    summary.after_merge(cursor)
+        except Exception:
+            for each in [snapshot] + child_snapshots:
+                each.abort()
+            raise
+
+        # Snapshots are only published once the rows have been merged.
+        with metrics.timer('Snapshot'):
+            for each in [snapshot] + child_snapshots:
+                each.close()
+        metrics.count('RowsInserted', result.inserted)
+        metrics.count('RowsUpdated', result.updated)
+        metrics.count('RowsUnchanged', result.unchanged)
+        metrics.count('RowsRejected', result.rejected)
+
+        log_summary(logger, f"Completed processing {result.staged} {self.name}",
+                    entity=self.name, source_key=source_key, **result._asdict())
+        return result
+
+
+def register_loader(loader):
+    """
+    Adds a loader to the registry and returns it.
+    """
+    LOADERS[loader.name] = loader
+    return loader
+
+
+def loader_for_key(key, loaders=None):
+    """
+    Returns the registered loader that handles an S3 key, or None.
+    """
+    for loader in (loaders or LOADERS.values()):
+        if loader.handles(key):
+            return loader
+    return None
@@ -0,0 +1,285 @@
+import json
+import os
+import time
+from botocore.exceptions import ClientError
+from psycopg2.errors import LockNotAvailable
+from db_connection import transaction
+from entity_registry import LOADERS, loader_for_key
+from ingest_logging import get_logger, log_summary
+from ingest_metrics import StageMetrics, dump_profile, file_metrics, profile_call
+from ingest_scheduler import export_timestamp, fetch_body, run_ingest, supersede_snapshots
+from pam_schema import migrate
+from s3_discovery import (
+    is_backfill, list_event_objects, list_new_objects, mark_failed, mark_processed,
+    mark_superseded, newest_processed_export
+)
+
+# Importing the entity definitions registers the accounts/safes/platforms
+# loaders, and psm_logs the PSM log loader.
+import pam_entities  # noqa: F401
+import psm_logs  # noqa: F401
+
+# Tag loaded objects (e.g. for lifecycle rules); the manifest stays the
+# source of truth for what has been processed.
+TAG_PROCESSED = os.environ.get('TAG_PROCESSED_OBJECTS', 'true').lower() == 'true'
+PROCESSED_TAG = 'pam-ingest-state'
+
+logger = get_logger(__name__)
+
+# How long a load waits for another invocation loading the same entity.
+# Past it the file is deferred, not failed: it stays out of the manifest and
+# the next scheduled run (or the event's retry) loads it.
+ENTITY_LOCK_TIMEOUT_MS = int(os.environ.get('ENTITY_LOCK_TIMEOUT_MS', '60000'))
+
+# False after the first invocation in this container.
+_cold_start = True
+
+
+class EntityBusyError(Exception):
+    pass
+
+
+def select_loaders(names=None):
+    """
+    Returns the registered loaders with the given names, or all of them.
+    """
+    if not names:
+        return list(LOADERS.values())
+    return [LOADERS[name] for name in names]
+
+
+def discover_new_files(s3, bucket, rds_config, event, loaders):
+    """
+    Returns (objects, superseded): the new exports to process, each tagged
+    with its loader's entity, and those skipped because a newer full export
+    of the same entity is pending too or already loaded. Objects are exactly those named in
+    an S3 event, or found by a prefix scan per loader (per listing prefix)
+    for scheduled runs
+    ({"mode": "backfill"} rescans each prefix from the start). Superseded
+    exports are marked in the manifest without being downloaded.
+    """
+    with transaction(rds_config) as cursor:
+        migrate(cursor)
+        if not is_backfill(event):
+            def route(key):
+                loader = loader_for_key(key, loaders)
+                return loader.name if loader else None
+            objects = list_event_objects(s3, event, bucket, cursor, route)
+        else:
+            objects = []
+            full_scan = (event or {}).get('mode') == 'backfill'
+            for loader in loaders:
+                for prefix in [loader.prefix] if full_scan else loader.listing_prefixes:
+                    objects.extend(list_new_objects(
+                        s3, bucket, loader.name, prefix, cursor, suffix=loader.suffix,
+                        skip_prefix=loader.processed_prefix, full_scan=full_scan
+                    ))
+
+        loaded = {}
+        for entity in {obj['Entity'] for obj in objects}:
+            loader = LOADERS[entity]
+            if not loader.snapshots:
+                continue
+            newest = newest_processed_export(cursor, entity, loader.prefix, full_only=True)
+            if newest and export_timestamp(newest):
+                loaded[entity] = export_timestamp(newest)
+        objects, superseded = supersede_snapshots(
+            objects, lambda obj: obj['Entity'] if LOADERS[obj['Entity']].snapshots else None,
+            loaded
+        )
+        mark_superseded(cursor, superseded)
+
+    if superseded:
+        log_summary(logger, f"Skipping {len(superseded)} exports superseded by newer full exports",
+                    superseded=len(superseded),
+                    entities=sorted({obj['Entity'] for obj in superseded}))
+        for obj in superseded:
+            tag_processed_file(s3, bucket, obj['Key'], 'superseded')
+    return objects, superseded
+
+
+def tag_processed_file(s3, bucket, key, state='processed'):
+    """
+    Tags a loaded (or superseded) object with its state, keeping its other
+    tags. Two small requests whatever the object size, unlike copying it to
+    a new key.
+    """
+    if not TAG_PROCESSED:
+        return
+    try:
+        tags = s3.get_object_tagging(Bucket=bucket, Key=key)['TagSet']
+        tags = [tag for tag in tags if tag['Key'] != PROCESSED_TAG]
+        tags.append({'Key': PROCESSED_TAG, 'Value': state})
+        s3.put_object_tagging(Bucket=bucket, Key=key, Tagging={'TagSet': tags})
+    except ClientError as e:
+        logger.warning(f"Error tagging file {key}: {e}")
+
+
+def record_failure(rds_config, loader, obj, error):
+    """
+    Records a failed load in the manifest so the file is retried next run.
+    """
+    try:
+        with transaction(rds_config) as cursor:
+            attempts = mark_failed(cursor, loader.name, obj['Key'], obj['ETag'], error)
+        logger.info(f"Recorded failed attempt {attempts} for file: {obj['Key']}")
+    except Exception as e:
+        logger.error(f"Error recording failure for file {obj['Key']}: {e}")
+
+
+def load_file(s3, bucket, rds_config, obj, body):
+    """
+    Loads one export with its entity loader in its own transaction and marks
+    it processed, or superseded when a newer export of a snapshot entity was
+    loaded meanwhile. A failed file is recorded for retry and the error re-raised.
+    """
+    loader = LOADERS[obj['Entity']]
+    key = obj['Key']
+    logger.info(f"Processing file: {key}")
+
+    with file_metrics(Entity=loader.name) as metrics:
+        metrics.add_time('Download', obj.get('FetchSeconds', 0))
+        try:
+            state = _load_file(rds_config, loader, obj, metrics.count_bytes(body), metrics)
+            metrics.count('FilesLoaded' if state == 'processed' else 'FilesSuperseded')
+        except EntityBusyError:
+            metrics.count('FilesDeferred')
+            raise
+        except Exception:
+            metrics.count('FilesFailed')
+            raise
+
+    tag_processed_file(s3, bucket, key, state)
+
+
+def report_transfer(key, metrics):
+    """
+    Logs what reading a file cost: bytes transferred from S3, bytes after
+    decompression and parse time. For compressed exports the difference
+    is counted as TransferSavedBytes.
+    """
+    transferred = int(metrics.counts.get('Bytes', 0))
+    decoded = int(metrics.counts.get('DecodedBytes', 0))
+    if decoded > transferred:
+        metrics.count('TransferSavedBytes', decoded - transferred)
+    name = key.rsplit('/', 1)[-1]
+    log_summary(logger, f"Read {key}", source_key=key,
+                file_format=name.split('.', 1)[1] if '.' in name else '',
+                bytes=transferred, decoded_bytes=decoded,
+                parse_seconds=round(metrics.timings.get('Parse', 0.0), 3),
+                records=int(metrics.counts.get('Records', 0)))
+
+
+def superseding_export(cursor, loader, key):
+    """
+    Serializes the loads of a snapshot entity across concurrent invocations
+    (the lock is held until the load commits) and returns the newer export
+    already loaded that makes key obsolete, or None. Within one invocation
+    the lanes already load oldest first; this keeps S3 events for the same
+    entity, handled in parallel, from applying an older export last. The
+    parts of one export therefore load one at a time, whichever invocations
+    they arrive in. Raises EntityBusyError after ENTITY_LOCK_TIMEOUT_MS.
+    """
+    # Only the wait for this lock is bounded; the rest of the load keeps
+    # the session's lock_timeout.
+    cursor.execute("SET LOCAL lock_timeout = %s", (f"{ENTITY_LOCK_TIMEOUT_MS}ms",))
+    try:
+        cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (loader.name,))
+    except LockNotAvailable:
+        raise EntityBusyError(f"another invocation is loading {loader.name}") from None
+    cursor.execute("SET LOCAL lock_timeout TO DEFAULT")
+    moment = export_timestamp(key)
+    newest = newest_processed_export(cursor, loader.name, loader.prefix)
+    newest_time = export_timestamp(newest) if newest else None
+    if moment is None or newest_time is None or newest_time <= moment:
+        return None
+    return newest
+
+
+def _load_file(rds_config, loader, obj, body, metrics):
+    key = obj['Key']
+    try:
+        with transaction(rds_config) as cursor:
+            newer = superseding_export(cursor, loader, key) if loader.snapshots else None
+            if newer:
+                logger.warning(f"Skipping {key}: the newer export {newer} is already loaded.")
+                mark_superseded(cursor, [obj])
+                return 'superseded'
+            # Parse covers reading the body too when it is streamed from S3.
+            export = {}
+            records = metrics.timed_iter(loader.read_records(body, key, export), 'Parse', 'Records')
+            loader.process(records, cursor, source_key=key, export=export)
+            mark_processed(cursor, loader.name, key, obj['ETag'])
+            commit_started = time.perf_counter()
+        metrics.add_time('Commit', time.perf_counter() - commit_started)
+        logger.info(f"Transaction committed for file: {key}")
+        report_transfer(key, metrics)
+        return 'processed'
+    except EntityBusyError as e:
+        logger.warning(f"Deferring {key}: {e}.")
+        raise
+    except ValueError as e:
+        # JSONDecodeError up front, malformed JSON found while streaming
+        # records, a truncated export, or a log that cannot be decompressed.
+        logger.error(f"Error parsing file {key}: {e}")
+        record_failure(rds_config, loader, obj, e)
+        raise
+    except Exception as e:
+        logger.exception(f"Error during processing: {e}")
+        record_failure(rds_config, loader, obj, e)
+        raise
+
+
+def handle_event(event, s3, bucket, rds_config, loader_names=None):
+    """
+    Shared Lambda entry point: discovers new exports for the selected loaders
+    (all registered loaders by default) and loads them, one lane per entity.
+    """
+    logger.info("Lambda execution started.")
+    logger.info(f"Received event: {json.dumps(event)}")
+    invocation = StageMetrics()
+    global _cold_start
+    if _cold_start:
+        # Lambda's REPORT line has the init duration; this marks which
+        # invocation's metrics include the first client and connection setup.
+        invocation.count('ColdStart')
+        _cold_start = False
+
+    def fetch(obj, prefetch):
+        started = time.perf_counter()
+        body = fetch_body(s3, bucket, obj['Key'], prefetch)
+        # Prefetches run on the download pool; load_file reports the time.
+        obj['FetchSeconds'] = time.perf_counter() - started
+        return body
+
+    try:
+        loaders = select_loaders(loader_names)
+        with invocation.timer('Discovery'):
+            objects, superseded = discover_new_files(s3, bucket, rds_config, event, loaders)
+        invocation.count('FilesFound', len(objects) + len(superseded))
+        invocation.count('FilesSuperseded', len(superseded))
+        if not objects:
+            logger.info("No new files found in the S3 bucket.")
+            return
+
+        # Each entity's files load oldest first; entities load in parallel.
+        with invocation.timer('Ingest'):
+            results = run_ingest(
+                objects,
+                fetch=fetch,
+                load=lambda obj, body: profile_call(load_file, s3, bucket, rds_config, obj, body),
+                lane_of=lambda obj: obj['Entity'],
+                # Parents first, so lookups of their surrogate keys succeed.
+                lane_after={loader.name: loader.depends_on for loader in loaders},
+                # A failed export is retried before anything newer is applied.
+                stop_on_error=True
+            )
+        errors = [error for _, error in results if error is not None]
+        invocation.count('FilesDeferred', sum(1 for error in errors if isinstance(error, EntityBusyError)))
+        invocation.count('FilesFailed', sum(1 for error in errors if not isinstance(error, EntityBusyError)))
+
+    except Exception as e:
+        logger.exception(f"Error processing data: {e}")
+    finally:
+        invocation.emit()
+        dump_profile()
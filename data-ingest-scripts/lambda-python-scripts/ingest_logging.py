@@ -0,0 +1,140 @@
+import json
+import logging
+import os
+import random
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+
+# DEBUG, INFO, WARNING or ERROR.
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'INFO').upper()
+
+# 'json' (one object per line, queryable with CloudWatch Logs Insights) or 'text'.
+LOG_FORMAT = os.environ.get('LOG_FORMAT', 'json').lower()
+
+# Fraction of records that get a per-record DEBUG line (needs LOG_LEVEL=DEBUG).
+# 0 keeps per-record output off, which is the production default.
+RECORD_SAMPLE_RATE = float(os.environ.get('LOG_RECORD_SAMPLE_RATE', '0'))
+
+# Per-record lines (debug and data-quality warnings) allowed per second per
+# logger; the rest are counted and reported with the next line let through.
+RECORD_RATE_LIMIT = float(os.environ.get('LOG_RECORD_RATE_LIMIT', '20'))
+
+_configured = False
+_configure_lock = threading.Lock()
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats each record as a single JSON object. Fields passed as
+    extra={'fields': {...}} become top-level keys.
+    """
+
+    def format(self, record):
+        entry = {
+            'timestamp': datetime.fromtimestamp(record.created, tz=timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        # Set by the Lambda runtime's log handler.
+        if getattr(record, 'aws_request_id', None):
+            entry['aws_request_id'] = record.aws_request_id
+        entry.update(getattr(record, 'fields', None) or {})
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s %(name)s %(message)s')
+
+    def format(self, record):
+        line = super().format(record)
+        fields = getattr(record, 'fields', None)
+        if fields:
+            line += ' ' + json.dumps(fields, default=str)
+        return line
+
+
+def configure_logging():
+    """
+    Applies LOG_LEVEL and LOG_FORMAT to the root logger once per container,
+    reusing the Lambda runtime's handler when there is one.
+    """
+    global _configured
+    with _configure_lock:
+        if _configured:
+            return
+        root = logging.getLogger()
+        root.setLevel(getattr(logging, LOG_LEVEL, logging.INFO))
+        if not root.handlers:
+            root.addHandler(logging.StreamHandler(sys.stdout))
+        formatter = JsonFormatter() if LOG_FORMAT == 'json' else TextFormatter()
+        for handler in root.handlers:
+            handler.setFormatter(formatter)
+        # Keep the AWS SDK quiet unless it is being debugged explicitly.
+        for name in ('boto3', 'botocore', 's3transfer', 'urllib3'):
+            logging.getLogger(name).setLevel(logging.WARNING)
+        _configured = True
+
+
+def get_logger(name):
+    configure_logging()
+    return logging.getLogger(name)
+
+
+def log_summary(logger, message, level=logging.INFO, **fields):
+    """
+    Logs one structured summary line, e.g. the counts for a merged batch.
+    """
+    logger.log(level, message, extra={'fields': fields})
+
+
+class RecordLog:
+    """
+    Logging for hot per-record loops. debug() lines are sampled at
+    RECORD_SAMPLE_RATE and skipped outright unless DEBUG is enabled;
+    debug() and warning() lines are both rate limited to RECORD_RATE_LIMIT
+    per second. Pass %-style arguments so skipped lines are never formatted.
+    """
+
+    def __init__(self, logger):
+        self.logger = logger
+        self._lock = threading.Lock()
+        self._tokens = RECORD_RATE_LIMIT
+        self._refilled = time.monotonic()
+        self._suppressed = 0
+
+    def _allow(self):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(RECORD_RATE_LIMIT,
+                               self._tokens + (now - self._refilled) * RECORD_RATE_LIMIT)
+            self._refilled = now
+            if self._tokens < 1:
+                self._suppressed += 1
+                return None
+            self._tokens -= 1
+            suppressed, self._suppressed = self._suppressed, 0
+            return suppressed
+
+    def _log(self, level, message, args):
+        suppressed = self._allow()
+        if suppressed is None:
+            return
+        fields = {'suppressed': suppressed} if suppressed else {}
+        self.logger.log(level, message, *args, extra={'fields': fields})
+
+    def debug(self, message, *args):
+        if RECORD_SAMPLE_RATE <= 0 or not self.logger.isEnabledFor(logging.DEBUG):
+            return
+        if RECORD_SAMPLE_RATE < 1 and random.random() >= RECORD_SAMPLE_RATE:
+            return
+        self._log(logging.DEBUG, message, args)
+
+    def warning(self, message, *args):
+        if self.logger.isEnabledFor(logging.WARNING):
+            self._log(logging.WARNING, message, args)
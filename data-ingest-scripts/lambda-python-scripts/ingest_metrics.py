@@ -0,0 +1,227 @@
+import cProfile
+import io
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from ingest_logging import get_logger
+
+# CloudWatch namespace for the Embedded Metric Format lines; METRICS_ENABLED=false
+# stops emitting them.
+METRICS_NAMESPACE = os.environ.get('METRICS_NAMESPACE', 'PamIngest')
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() == 'true'
+
+# INGEST_PROFILE=true profiles every file load with cProfile, one load at a
+# time; the merged stats are written to PROFILE_PATH and the top
+# PROFILE_TOP_N functions logged.
+PROFILE_ENABLED = os.environ.get('INGEST_PROFILE', 'false').lower() == 'true'
+PROFILE_PATH = os.environ.get('PROFILE_PATH', '/tmp/ingest-profile.pstats')
+PROFILE_TOP_N = int(os.environ.get('PROFILE_TOP_N', '25'))
+
+logger = get_logger(__name__)
+
+_current = threading.local()
+_profile_lock = threading.Lock()
+_profile_stats = None
+# Held while a profiler is active: Python 3.12+ allows only one at a time.
+_profiling = threading.Lock()
+
+
+class CountingReader:
+    """
+    Wraps a readable body and counts the bytes read through it.
+    """
+
+    def __init__(self, body, metrics):
+        self._body = body
+        self._metrics = metrics
+
+    def read(self, *args):
+        data = self._body.read(*args)
+        self._metrics.count('Bytes', len(data))
+        return data
+
+    def close(self):
+        if hasattr(self._body, 'close'):
+            self._body.close()
+
+
+class StageMetrics:
+    """
+    Accumulates per-stage wall time and counters for one unit of work (a
+    file or an invocation) and emits them as one CloudWatch EMF line.
+    """
+
+    def __init__(self, dimensions=None):
+        self.dimensions = dict(dimensions or {})
+        self.timings = defaultdict(float)
+        self.counts = defaultdict(float)
+        self._started = time.perf_counter()
+
+    @contextmanager
+    def timer(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[stage] += time.perf_counter() - started
+
+    def add_time(self, stage, seconds):
+        self.timings[stage] += seconds
+
+    def count(self, name, value=1):
+        self.counts[name] += value
+
+    def count_bytes(self, body):
+        return CountingReader(body, self)
+
+    def timed_iter(self, iterable, stage, counter=None):
+        """
+        Yields from iterable, charging the time spent producing each item
+        to stage and counting items under counter.
+        """
+        iterator = iter(iterable)
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                self.timings[stage] += time.perf_counter() - started
+                return
+            self.timings[stage] += time.perf_counter() - started
+            if counter:
+                self.counts[counter] += 1
+            yield item
+
+    def emit(self):
+        """
+        Writes the metrics as an Embedded Metric Format line, which
+        CloudWatch turns into metrics without any API calls.
+        """
+        total = time.perf_counter() - self._started
+        values = {f"{stage}Time": round(seconds * 1000, 3) for stage, seconds in self.timings.items()}
+        values['TotalTime'] = round(total * 1000, 3)
+        values.update(self.counts)
+        if total > 0 and 'Records' in self.counts:
+            values['RecordsPerSecond'] = round(self.counts['Records'] / total, 1)
+        if total > 0 and 'Bytes' in self.counts:
+            values['BytesPerSecond'] = round(self.counts['Bytes'] / total, 1)
+
+        def unit(name):
+            if name.endswith('Time'):
+                return 'Milliseconds'
+            if name == 'BytesPerSecond':
+                return 'Bytes/Second'
+            if name.endswith('PerSecond'):
+                return 'Count/Second'
+            if name.endswith('Bytes'):
+                return 'Bytes'
+            return 'Count'
+
+        if not METRICS_ENABLED:
+            return values
+        entry = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': METRICS_NAMESPACE,
+                    'Dimensions': [list(self.dimensions)],
+                    'Metrics': [{'Name': name, 'Unit': unit(name)} for name in values],
+                }],
+            },
+            **self.dimensions,
+            **values,
+        }
+        # Written straight to stdout: EMF lines must not be wrapped by the log formatter.
+        sys.stdout.write(json.dumps(entry) + '\n')
+        sys.stdout.flush()
+        return values
+
+
+class _NoMetrics(StageMetrics):
+    """
+    Stand-in used outside file_metrics(), so instrumented code never has to
+    check whether metrics are being collected.
+    """
+
+    @contextmanager
+    def timer(self, stage):
+        yield
+
+    def add_time(self, stage, seconds):
+        pass
+
+    def count(self, name, value=1):
+        pass
+
+    def emit(self):
+        return {}
+
+
+_NO_METRICS = _NoMetrics()
+
+
+def current_metrics():
+    """
+    Returns the StageMetrics of the file being loaded on this thread.
+    """
+    return getattr(_current, 'metrics', None) or _NO_METRICS
+
+
+@contextmanager
+def file_metrics(**dimensions):
+    """
+    Collects the metrics of one file load on the current thread and emits
+    them when the block exits, whether or not it succeeded.
+    """
+    metrics = StageMetrics(dimensions)
+    _current.metrics = metrics
+    try:
+        yield metrics
+    finally:
+        _current.metrics = None
+        metrics.emit()
+
+
+def profile_call(fn, *args, **kwargs):
+    """
+    Calls fn, under cProfile when INGEST_PROFILE is set. Profiled calls run
+    one at a time, so the loads are serial whatever INGEST_WORKERS is (Python
+    3.12+ refuses a second active profiler); the stats of each call are
+    merged for dump_profile().
+    """
+    if not PROFILE_ENABLED:
+        return fn(*args, **kwargs)
+    global _profile_stats
+    profiler = cProfile.Profile()
+    try:
+        with _profiling:
+            return profiler.runcall(fn, *args, **kwargs)
+    finally:
+        with _profile_lock:
+            if _profile_stats is None:
+                _profile_stats = pstats.Stats(profiler)
+            else:
+                _profile_stats.add(profiler)
+
+
+def dump_profile():
+    """
+    Writes the merged profile to PROFILE_PATH, logs the hottest functions by
+    cumulative time, and resets the stats for the next invocation.
+    """
+    global _profile_stats
+    with _profile_lock:
+        stats, _profile_stats = _profile_stats, None
+    if stats is None:
+        return
+    stats.dump_stats(PROFILE_PATH)
+    report = io.StringIO()
+    stats.stream = report
+    stats.sort_stats('cumulative').print_stats(PROFILE_TOP_N)
+    logger.info(f"Profile written to {PROFILE_PATH}:\n{report.getvalue()}")
@@ -0,0 +1,264 @@
+import os
+import re
+import tempfile
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from datetime import datetime
+
+from ingest_logging import get_logger, log_summary
+
+# Files loaded concurrently (one database connection each) and S3 downloads
+# in flight. Keep at or below DB_POOL_SIZE so connections are reused.
+INGEST_WORKERS = int(os.environ.get('INGEST_WORKERS', '4'))
+
+# Files downloaded ahead of the one being loaded, per lane. The file being
+# loaded is always streamed straight from S3 as it is parsed; 0 streams
+# every file.
+PREFETCH_DEPTH = int(os.environ.get('INGEST_PREFETCH_DEPTH', '1'))
+
+# Only files up to this size (from the listing) are prefetched; larger ones,
+# and files of unknown size, are streamed when their turn comes. A lane keeps
+# at most PREFETCH_DEPTH of them, so /tmp needs room for about
+# INGEST_WORKERS * PREFETCH_DEPTH * PREFETCH_MAX_BYTES (Lambda's default
+# /tmp is 512 MB).
+PREFETCH_MAX_BYTES = int(os.environ.get('INGEST_PREFETCH_MAX_BYTES', str(64 * 1024 * 1024)))
+
+# Prefetched objects stay in memory up to this size, then spill to /tmp.
+SPOOL_MAX_BYTES = int(os.environ.get('INGEST_SPOOL_MAX_BYTES', str(32 * 1024 * 1024)))
+
+# The exporters name files <entity>-yyyyMMdd_HHmmss.json.
+_TIMESTAMP_PATTERN = re.compile(r'(\d{8}_\d{6})')
+
+# Delta exports add -delta after the timestamp: <entity>-yyyyMMdd_HHmmss-delta-part0001.json.
+_DELTA_PATTERN = re.compile(r'\d{8}_\d{6}-delta\b')
+
+logger = get_logger(__name__)
+
+
+def export_timestamp(key):
+    """
+    Returns the export time embedded in an S3 key, or None if it has none.
+    """
+    match = _TIMESTAMP_PATTERN.search(key)
+    if not match:
+        return None
+    try:
+        return datetime.strptime(match.group(1), '%Y%m%d_%H%M%S')
+    except ValueError:
+        return None
+
+
+def export_order(obj):
+    """
+    Sort key that puts older exports first; keys without a timestamp go first
+    and fall back to key order.
+    """
+    return (export_timestamp(obj['Key']) or datetime.min, obj['Key'])
+
+
+def is_delta_export(key):
+    """
+    True for the files of a delta export, which only hold changed records.
+    """
+    return _DELTA_PATTERN.search(key) is not None
+
+
+def supersede_snapshots(objects, lane_of, loaded=None):
+    """
+    Splits pending objects into (to_load, superseded). Within each lane
+    (lane_of(obj), or None for objects that are never coalesced), every
+    export older than the newest full snapshot is superseded by it: older
+    full snapshots and the deltas between them carry nothing the newest
+    snapshot does not. loaded maps lanes to the export time of the newest
+    full snapshot already loaded, which supersedes older pending exports
+    the same way. All parts of the newest snapshot, the deltas after it
+    and keys without a timestamp are kept.
+    """
+    newest_full = dict(loaded or {})
+    for obj in objects:
+        lane = lane_of(obj)
+        moment = export_timestamp(obj['Key'])
+        if lane is None or moment is None or is_delta_export(obj['Key']):
+            continue
+        if lane not in newest_full or moment > newest_full[lane]:
+            newest_full[lane] = moment
+
+    to_load, superseded = [], []
+    for obj in objects:
+        lane = lane_of(obj)
+        moment = export_timestamp(obj['Key'])
+        if lane in newest_full and moment is not None and moment < newest_full[lane]:
+            superseded.append(obj)
+        else:
+            to_load.append(obj)
+    return to_load, superseded
+
+
+def download_object(s3, bucket, key):
+    """
+    Downloads an object into a spooled temporary file (memory first, then
+    /tmp) using the S3 transfer manager's concurrent ranged GETs.
+    Returns the file rewound to the start; the caller closes it.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+    try:
+        s3.download_fileobj(bucket, key, spool)
+    except Exception:
+        spool.close()
+        raise
+    spool.seek(0)
+    return spool
+
+
+def fetch_body(s3, bucket, key, prefetch=False):
+    """
+    Returns the body to parse for a key: a local copy when prefetching,
+    otherwise the S3 StreamingBody itself.
+    """
+    if prefetch:
+        return download_object(s3, bucket, key)
+    return s3.get_object(Bucket=bucket, Key=key)['Body']
+
+
+def should_prefetch(obj):
+    """
+    True for objects small enough to download ahead of their turn.
+    """
+    size = obj.get('Size')
+    return PREFETCH_DEPTH > 0 and size is not None and size <= PREFETCH_MAX_BYTES
+
+
+def _run_lane(lane, objects, fetch, load, downloads, stop_on_error=False):
+    """
+    Loads one lane's objects strictly oldest first, streaming the current
+    one, while up to PREFETCH_DEPTH of the next (see should_prefetch) are
+    downloaded on the shared download pool. fetch(obj, prefetch) returns
+    the body. With
+    stop_on_error the rest of the lane is skipped after a failure, so a
+    newer export is never applied before an older one that is to be retried.
+    Returns a list of (obj, error) pairs; error is None on success.
+    """
+    results = []
+    pending = deque(objects)
+    in_flight = deque()
+
+    def submit_next():
+        if pending:
+            obj = pending.popleft()
+            future = downloads.submit(fetch, obj, True) if should_prefetch(obj) else None
+            in_flight.append((obj, future))
+
+    # The first file is streamed; nothing would overlap its download.
+    if pending:
+        in_flight.append((pending.popleft(), None))
+    for _ in range(max(PREFETCH_DEPTH, 0)):
+        submit_next()
+
+    while in_flight:
+        obj, future = in_flight.popleft()
+        submit_next()
+        try:
+            # Files not prefetched are fetched here and streamed.
+            body = future.result() if future else fetch(obj, False)
+        except Exception as e:
+            logger.error(f"[{lane}] Error downloading {obj['Key']}: {e}")
+            results.append((obj, e))
+            if stop_on_error:
+                break
+            continue
+        try:
+            load(obj, body)
+            results.append((obj, None))
+        except Exception as e:
+            logger.error(f"[{lane}] Error loading {obj['Key']}: {e}")
+            results.append((obj, e))
+            if stop_on_error:
+                break
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+
+    if pending or in_flight:
+        skipped = list(in_flight) + [(obj, None) for obj in pending]
+        logger.warning(f"[{lane}] Skipping {len(skipped)} newer files until {results[-1][0]['Key']} loads.")
+        for obj, future in skipped:
+            if future:
+                # Close prefetched copies that will not be loaded.
+                try:
+                    body = future.result()
+                    if hasattr(body, 'close'):
+                        body.close()
+                except Exception:
+                    pass
+    return results
+
+
+def _lane_order(lanes, lane_after):
+    """
+    Returns the lane names with every lane after the lanes it waits for.
+    """
+    ordered = []
+
+    def visit(lane, path):
+        if lane in ordered or lane not in lanes:
+            return
+        if lane in path:
+            raise ValueError(f"Lane dependency cycle at {lane}")
+        for dependency in lane_after.get(lane, ()):
+            visit(dependency, path | {lane})
+        ordered.append(lane)
+
+    for lane in lanes:
+        visit(lane, frozenset())
+    return ordered
+
+
+def _run_lane_after(waits, *args):
+    # Started in dependency order, so the lanes waited for already hold a
+    # worker and this cannot deadlock the pool.
+    wait(waits)
+    return _run_lane(*args)
+
+
+def run_ingest(objects, fetch, load, lane_of=None, workers=None, stop_on_error=False,
+               lane_after=None):
+    """
+    Loads objects with a bounded pool of workers.
+
+    Objects are grouped into lanes by lane_of(obj) (a single lane by default)
+    and each lane is loaded serially in export-timestamp order, so a newer
+    export is always applied after an older one for the same entity. Lanes
+    run in parallel, and up to PREFETCH_DEPTH downloads of small files per
+    lane overlap with parsing and database writes. fetch(obj, prefetch)
+    returns a readable body (a local copy when prefetch is set) and
+    load(obj, body) loads it in its own transaction. With stop_on_error a
+    failed file ends its lane for this run. lane_after maps a lane to the
+    lanes that must finish first, e.g. accounts after platforms and safes.
+    Returns a list of (obj, error) pairs, grouped by lane; skipped files
+    are not included.
+    """
+    workers = max(1, workers or INGEST_WORKERS)
+    lane_after = lane_after or {}
+    lanes = defaultdict(list)
+    for obj in objects:
+        lanes[lane_of(obj) if lane_of else 'default'].append(obj)
+    for lane_objects in lanes.values():
+        lane_objects.sort(key=export_order)
+
+    logger.info(f"Ingesting {len(objects)} files in {len(lanes)} lanes with {workers} workers.")
+    results = []
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='download') as downloads, \
+            ThreadPoolExecutor(max_workers=min(workers, len(lanes) or 1),
+                               thread_name_prefix='lane') as lane_pool:
+        futures = {}
+        for lane in _lane_order(lanes, lane_after):
+            waits = [futures[dependency] for dependency in lane_after.get(lane, ()) if dependency in futures]
+            futures[lane] = lane_pool.submit(_run_lane_after, waits, lane, lanes[lane],
+                                             fetch, load, downloads, stop_on_error)
+        for future in futures.values():
+            results.extend(future.result())
+
+    failed = sum(1 for _, error in results if error is not None)
+    log_summary(logger, "Ingest finished", files=len(objects), loaded=len(results) - failed,
+                failed=failed, skipped=len(objects) - len(results))
+    return results
@@ -0,0 +1,317 @@
+import codecs
+import json
+import os
+import zlib
+
+from ingest_metrics import current_metrics
+
+# Bytes read from the S3 StreamingBody per chunk while walking a JSON export.
+DEFAULT_CHUNK_SIZE = int(os.environ.get('STREAM_CHUNK_SIZE', str(1024 * 1024)))
+
+# Set STREAM_JSON=false to fall back to json.loads on the whole object.
+STREAM_JSON = os.environ.get('STREAM_JSON', 'true').lower() == 'true'
+
+# Export files the loaders read: one JSON document ({"value": [...]}) or
+# newline-delimited JSON, one record per line, either optionally compressed.
+EXPORT_SUFFIXES = ('.json', '.json.gz', '.ndjson', '.ndjson.gz', '.ndjson.zst')
+
+# Metadata the exporters write alongside the records: recordsKey, count,
+# exportMode ('full' or 'delta'), part, parts, generation and since.
+EXPORT_METADATA = ('recordsKey', 'count', 'exportMode', 'part', 'parts', 'generation', 'since')
+
+_decoder = json.JSONDecoder()
+_WHITESPACE = ' \t\n\r'
+
+_GZIP_MAGIC = b'\x1f\x8b'
+_ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+def export_format(key):
+    """
+    Returns the format of an export from its key: 'json' or 'ndjson'.
+    """
+    return 'ndjson' if '.ndjson' in key else 'json'
+
+
+def _gunzip(chunks):
+    # Several concatenated gzip members are one valid gzip file.
+    decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+    for chunk in chunks:
+        while chunk:
+            if decompressor.eof:
+                decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+            yield decompressor.decompress(chunk)
+            chunk = decompressor.unused_data
+    yield decompressor.flush()
+    if not decompressor.eof:
+        raise ValueError("Truncated gzip stream")
+
+
+def _unzstd(chunks):
+    try:
+        import zstandard
+    except ImportError:
+        raise ValueError("zstd-compressed export, but the zstandard package is not installed")
+    decompressor = zstandard.ZstdDecompressor().decompressobj()
+    for chunk in chunks:
+        yield decompressor.decompress(chunk)
+
+
+class DecodedReader:
+    """
+    Readable view of a body that decompresses it on the fly when it starts
+    with the gzip or zstd magic bytes, whatever the key or Content-Encoding
+    says; anything else passes through unchanged. Decompressed bytes are
+    counted as DecodedBytes. read() may return less than asked for, and
+    returns b'' only at the end.
+    """
+
+    def __init__(self, body, chunk_size=None):
+        self.body = body
+        self.chunk_size = chunk_size or DEFAULT_CHUNK_SIZE
+        self.encoding = None
+        # Opened on the first read, so the first chunk counts as parse time.
+        self._decoded = None
+        self._buffer = b''
+        self._metrics = current_metrics()
+
+    def _open(self):
+        first = self.body.read(self.chunk_size)
+        chunks = self._chunks(first)
+        if first[:2] == _GZIP_MAGIC:
+            self.encoding = 'gzip'
+            chunks = _gunzip(chunks)
+        elif first[:4] == _ZSTD_MAGIC:
+            self.encoding = 'zstd'
+            chunks = _unzstd(chunks)
+        return chunks
+
+    def _chunks(self, first):
+        chunk = first
+        while chunk:
+            yield chunk
+            chunk = self.body.read(self.chunk_size)
+
+    def read(self, size=-1):
+        if self._decoded is None:
+            self._decoded = self._open()
+        while not self._buffer:
+            chunk = next(self._decoded, None)
+            if chunk is None:
+                return b''
+            self._buffer = chunk
+        if size is None or size < 0:
+            data, self._buffer = self._buffer + b''.join(self._decoded), b''
+        else:
+            data, self._buffer = self._buffer[:size], self._buffer[size:]
+        self._metrics.count('DecodedBytes', len(data))
+        return data
+
+    def close(self):
+        if hasattr(self.body, 'close'):
+            self.body.close()
+
+
+class _StreamReader:
+    """
+    Incrementally decodes a binary stream and hands out JSON tokens/values.
+    Only the unconsumed tail of the text is buffered, so memory stays bounded
+    by the chunk size plus the largest single value being decoded.
+    """
+
+    def __init__(self, stream, chunk_size):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        # utf-8-sig also strips the BOM PowerShell may write with Out-File.
+        self.decoder = codecs.getincrementaldecoder('utf-8-sig')()
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        """
+        Appends the next chunk to the buffer. Returns False at end of stream.
+        """
+        if self.eof:
+            return False
+        chunk = self.stream.read(self.chunk_size)
+        if chunk:
+            text = self.decoder.decode(chunk)
+        else:
+            text = self.decoder.decode(b'', final=True)
+            self.eof = True
+        self.buffer = self.buffer[self.pos:] + text
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """
+        Returns the next non-whitespace character without consuming it,
+        or an empty string at end of stream.
+        """
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, chars):
+        char = self.peek()
+        if not char or char not in chars:
+            raise ValueError(f"Malformed JSON: expected one of {chars!r}, found {char!r}")
+        self.pos += 1
+        return char
+
+    def value(self):
+        """
+        Decodes and consumes the next complete JSON value.
+        """
+        self.peek()
+        while True:
+            try:
+                obj, end = _decoder.raw_decode(self.buffer, self.pos)
+                # A value ending exactly at the buffer edge may be a truncated
+                # number, so only trust it once more data (or EOF) follows.
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return obj
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._fill()
+
+
+def _iter_array(reader):
+    reader.expect('[')
+    if reader.peek() == ']':
+        reader.pos += 1
+        return
+    while True:
+        yield reader.value()
+        if reader.expect(',]') == ']':
+            return
+
+
+def iter_json_array(stream, key, chunk_size=None, export=None):
+    """
+    Yields the elements of the top-level array stored under `key`
+    (e.g. 'value' or 'Platforms') one at a time from a binary stream.
+    A bare top-level array is also accepted. Yields nothing if the key is absent.
+    When an `export` dict is given, the document's EXPORT_METADATA keys are
+    copied into it, which means reading past the array to the end.
+    """
+    reader = _StreamReader(stream, chunk_size or DEFAULT_CHUNK_SIZE)
+
+    if reader.peek() == '[':
+        yield from _iter_array(reader)
+        return
+
+    reader.expect('{')
+    if reader.peek() == '}':
+        return
+    found = False
+    while True:
+        name = reader.value()
+        reader.expect(':')
+        if name == key and not found and reader.peek() == '[':
+            yield from _count_records(_iter_array(reader), export)
+            if export is None:
+                return
+            found = True
+        else:
+            # Small sibling values such as "count" or "nextLink"; only the
+            # export metadata is kept.
+            value = reader.value()
+            if export is not None and name in EXPORT_METADATA:
+                export[name] = value
+        if reader.expect(',}') == '}':
+            break
+    _check_count(export)
+
+
+def iter_ndjson(stream, chunk_size=None, export=None):
+    """
+    Yields the records of a newline-delimited JSON stream, one per line.
+    Blank lines are skipped, and so is the {"_export": {...}} header line
+    the exporters write first; its metadata is copied into `export` when
+    a dict is given.
+    """
+    chunk_size = chunk_size or DEFAULT_CHUNK_SIZE
+    export = {} if export is None else export
+    pending = b''
+    first = True
+    while True:
+        chunk = stream.read(chunk_size)
+        data = pending + chunk
+        if chunk:
+            # Up to the last line break; a newline byte never splits a UTF-8 character.
+            end = data.rfind(b'\n') + 1
+            data, pending = data[:end], data[end:]
+        if data:
+            lines = [line for line in data.decode('utf-8-sig' if first else 'utf-8').split('\n')
+                     if line.strip()]
+            if first and lines and lines[0].lstrip().startswith('{"_export"'):
+                export.update(json.loads(lines[0])['_export'])
+                lines = lines[1:]
+            first = False
+            # One parse of the whole chunk as an array is several times
+            # faster than json.loads per line.
+            if lines:
+                records = json.loads(f"[{','.join(lines)}]")
+                export['recordsRead'] = export.get('recordsRead', 0) + len(records)
+                yield from records
+        if not chunk:
+            break
+    _check_count(export)
+
+
+def _count_records(records, export):
+    if export is None:
+        yield from records
+        return
+    count = 0
+    for record in records:
+        count += 1
+        yield record
+    export['recordsRead'] = count
+
+
+def _check_count(export):
+    """
+    Raises ValueError when an exporter-written part holds fewer records
+    than its metadata says, e.g. an NDJSON part cut off at a line break.
+    """
+    if not export or 'part' not in export or 'count' not in export:
+        return
+    records = export.get('recordsRead', 0)
+    if records != export['count']:
+        raise ValueError(f"Truncated export: {records} of {export['count']} records")
+
+
+def load_records(body, key, streaming=None, object_key='', export=None):
+    """
+    Returns an iterable of records under `key` from an S3 object body.
+    Compressed bodies are decompressed as they are read, and NDJSON exports
+    (recognized by object_key) are read a line at a time. JSON documents
+    are streamed when STREAM_JSON is enabled, otherwise parsed whole.
+    The export's metadata is copied into `export`, if given, once every
+    record has been read.
+    """
+    if streaming is None:
+        streaming = STREAM_JSON
+    body = DecodedReader(body)
+    if export_format(object_key) == 'ndjson':
+        return iter_ndjson(body, export=export)
+    if streaming:
+        return iter_json_array(body, key, export=export)
+    data = json.loads(body.read().decode('utf-8-sig'))
+    if isinstance(data, list):
+        return data
+    records = data.get(key, [])
+    if export is not None:
+        export.update((name, data[name]) for name in EXPORT_METADATA if name in data)
+        export['recordsRead'] = len(records)
+        _check_count(export)
+    return records
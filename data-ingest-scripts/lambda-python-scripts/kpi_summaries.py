@@ -0,0 +1,210 @@
+import os
+
+from psycopg2 import sql
+
+from ingest_logging import get_logger
+from snapshot_sweep import swept_table
+
+# Set KPI_SUMMARIES=false to stop maintaining the summary tables.
+KPI_ENABLED = os.environ.get('KPI_SUMMARIES', 'true').lower() == 'true'
+
+# Summary table -> pam_accounts column it is grouped by. The tables are
+# created by a pam_schema migration. Each summary row counts the accounts of
+# one platform (or safe) whose password change falls due on due_date (NULL
+# when the platform sets no change interval), so the KPIs need no join with
+# pam_accounts, e.g.:
+#
+#     SELECT platform_id,
+#            sum(account_count) FILTER (WHERE due_date < current_date) AS overdue,
+#            sum(auto_managed_count)::float / sum(account_count) AS auto_managed_rate,
+#            sum(psm_required_count)::float / sum(account_count) AS psm_coverage
+#     FROM pam_kpi_platform_daily GROUP BY platform_id;
+SUMMARY_TABLES = {
+    'pam_kpi_platform_daily': 'platform_id',
+    'pam_kpi_safe_daily': 'safe_name',
+}
+
+# Serializes refreshes from concurrent entity lanes (accounts and
+# platforms both touch the platform summary).
+_REFRESH_LOCK_KEY = 'pam_kpi_refresh'
+
+# Set once the summary tables are known to be seeded in this container.
+_kpi_seeded = False
+
+logger = get_logger(__name__)
+
+
+def _needs_seed(cursor):
+    """
+    True when the summary tables are still empty while pam_accounts is
+    not (e.g. right after the migration on an existing database), so every
+    group is computed once.
+    """
+    global _kpi_seeded
+    if _kpi_seeded:
+        return False
+    cursor.execute("""
+        SELECT NOT EXISTS (SELECT 1 FROM pam_kpi_safe_daily)
+           AND EXISTS (SELECT 1 FROM pam_accounts WHERE deleted_at IS NULL)
+    """)
+    if cursor.fetchone()[0]:
+        return True
+    _kpi_seeded = True
+    return False
+
+
+def _create_touched_table(cursor):
+    cursor.execute("""
+        CREATE TEMP TABLE IF NOT EXISTS kpi_touched (
+            group_column text NOT NULL,
+            group_key text NOT NULL
+        ) ON COMMIT DROP
+    """)
+
+
+def _capture_all_groups(cursor):
+    # One-off seed when the summary tables are still empty.
+    for group_column in SUMMARY_TABLES.values():
+        cursor.execute(
+            sql.SQL(
+                "INSERT INTO kpi_touched (group_column, group_key) "
+                "SELECT DISTINCT %s, {column} FROM pam_accounts WHERE {column} IS NOT NULL"
+            ).format(column=sql.Identifier(group_column)),
+            (group_column,)
+        )
+
+
+def _capture_account_groups(cursor, upsert):
+    # Both the incoming and the stored platform/safe of each staged account,
+    # so moving an account updates the group it left as well.
+    for group_column in SUMMARY_TABLES.values():
+        cursor.execute(
+            sql.SQL(
+                "INSERT INTO kpi_touched (group_column, group_key) "
+                "SELECT %s, {column} FROM {stage} WHERE {column} IS NOT NULL "
+                "UNION "
+                "SELECT %s, a.{column} FROM pam_accounts a "
+                "JOIN {stage} s ON s.account_name = a.account_name "
+                "WHERE a.{column} IS NOT NULL"
+            ).format(column=sql.Identifier(group_column), stage=sql.Identifier(upsert.stage_table)),
+            (group_column, group_column)
+        )
+
+
+def _capture_platform_groups(cursor, upsert):
+    # A changed platform policy moves the due dates of all its accounts,
+    # and with them the summaries of the safes holding those accounts.
+    _capture_platforms(cursor, upsert.stage_table)
+
+
+def _capture_platforms(cursor, source_table):
+    cursor.execute(
+        sql.SQL(
+            "INSERT INTO kpi_touched (group_column, group_key) "
+            "SELECT DISTINCT 'platform_id', platform_id FROM {source} WHERE platform_id IS NOT NULL"
+        ).format(source=sql.Identifier(source_table))
+    )
+    cursor.execute("""
+        INSERT INTO kpi_touched (group_column, group_key)
+        SELECT DISTINCT 'safe_name', a.safe_name FROM pam_accounts a
+        WHERE a.platform_id IN (SELECT group_key FROM kpi_touched WHERE group_column = 'platform_id')
+          AND a.safe_name IS NOT NULL
+    """)
+
+
+def _capture_retired_accounts(cursor, retired):
+    # Accounts a snapshot sweep retired leave their platform and safe.
+    if not retired.get('pam_accounts'):
+        return
+    retired_table = swept_table('pam_accounts')
+    for group_column in SUMMARY_TABLES.values():
+        cursor.execute(
+            sql.SQL(
+                "INSERT INTO kpi_touched (group_column, group_key) "
+                "SELECT DISTINCT %s, a.{column} FROM pam_accounts a "
+                "JOIN {retired} r ON r.account_name = a.account_name "
+                "WHERE a.{column} IS NOT NULL"
+            ).format(column=sql.Identifier(group_column), retired=sql.Identifier(retired_table)),
+            (group_column,)
+        )
+
+
+def _capture_retired_platforms(cursor, retired):
+    # The accounts of a platform a snapshot sweep retired lose its policy.
+    if retired.get('pam_platforms'):
+        _capture_platforms(cursor, swept_table('pam_platforms'))
+
+
+def refresh_touched_kpis(cursor):
+    """
+    Recomputes the summary rows of every platform and safe recorded in
+    kpi_touched, reading only those groups' accounts that are not deleted.
+    A deleted platform's policy no longer applies: its accounts count with
+    no due date and no PSM requirement.
+    """
+    cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (_REFRESH_LOCK_KEY,))
+    for table, group_column in SUMMARY_TABLES.items():
+        params = {'group_column': group_column}
+        cursor.execute(
+            sql.SQL(
+                "DELETE FROM {table} WHERE {column} IN ("
+                "SELECT group_key FROM kpi_touched WHERE group_column = %(group_column)s)"
+            ).format(table=sql.Identifier(table), column=sql.Identifier(group_column)),
+            params
+        )
+        cursor.execute(
+            sql.SQL(
+                "INSERT INTO {table} ({column}, due_date, account_count, "
+                "auto_managed_count, psm_required_count) "
+                "SELECT a.{column}, "
+                "CASE WHEN p.require_password_change_days > 0 THEN "
+                "(a.last_modified_time + make_interval(days => p.require_password_change_days::int))::date "
+                "END, "
+                "count(*), "
+                "count(*) FILTER (WHERE a.automatic_management_enabled), "
+                "count(*) FILTER (WHERE p.require_psm) "
+                "FROM pam_accounts a "
+                "LEFT JOIN pam_platforms p ON p.platform_id = a.platform_id "
+                "AND p.deleted_at IS NULL "
+                "WHERE a.{column} IN ("
+                "SELECT group_key FROM kpi_touched WHERE group_column = %(group_column)s) "
+                "AND a.deleted_at IS NULL "
+                "GROUP BY 1, 2"
+            ).format(table=sql.Identifier(table), column=sql.Identifier(group_column)),
+            params
+        )
+        logger.info(f"Refreshed {cursor.rowcount} rows of {table}.")
+    cursor.execute("TRUNCATE kpi_touched")
+
+
+class KpiRefresh:
+    """
+    Loader hook that keeps the KPI summary tables current: before_merge
+    records which platforms/safes the staged rows affect, after_sweep those
+    of rows a snapshot sweep retired, and after_merge recomputes just those
+    groups in the same transaction.
+    """
+
+    def __init__(self, capture, capture_retired=None):
+        self.capture = capture
+        self.capture_retired = capture_retired
+
+    def before_merge(self, cursor, upsert):
+        if not KPI_ENABLED:
+            return
+        _create_touched_table(cursor)
+        if _needs_seed(cursor):
+            _capture_all_groups(cursor)
+        self.capture(cursor, upsert)
+
+    def after_sweep(self, cursor, retired):
+        if KPI_ENABLED and self.capture_retired:
+            self.capture_retired(cursor, retired)
+
+    def after_merge(self, cursor):
+        if KPI_ENABLED:
+            refresh_touched_kpis(cursor)
+
+
+ACCOUNT_KPIS = KpiRefresh(_capture_account_groups, _capture_retired_accounts)
+PLATFORM_KPIS = KpiRefresh(_capture_platform_groups, _capture_retired_platforms)
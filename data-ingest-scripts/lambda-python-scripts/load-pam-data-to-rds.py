@@ -0,0 +1,24 @@
+from aws_clients import lazy_client
+from ingest_handler import handle_event
+
+# AWS clients and configuration. The S3 client is created on first use, so
+# importing this module stays cheap on a cold start.
+s3 = lazy_client('s3')
+bucket_name = 'S3BucketName'
+secret_name = 'RDSSecretName'
+
+# RDS connection configuration
+rds_config = {
+    'host': 'RDSPostgresEndpoint',
+    'database': 'postgres',
+    'user': 'postgres',
+    'password': 'password'
+    # If using Secrets Manager, replace 'password' with the line below. The
+    # password is cached between warm invocations and re-read when rejected.
+    # 'secret_name': secret_name
+}
+
+def lambda_handler(event, context):
+    # Routes every key by prefix to its registered entity loader (accounts,
+    # safes, platforms, ...), listing and connecting once for all of them.
+    handle_event(event, s3, bucket_name, rds_config)
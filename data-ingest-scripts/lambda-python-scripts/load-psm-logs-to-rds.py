@@ -0,0 +1,24 @@
+from aws_clients import lazy_client
+from ingest_handler import handle_event
+
+# AWS clients and configuration. The S3 client is created on first use, so
+# importing this module stays cheap on a cold start.
+s3 = lazy_client('s3')
+bucket_name = 'S3BucketName'
+secret_name = 'RDSSecretName'
+
+# RDS connection configuration
+rds_config = {
+    'host': 'RDSPostgresEndpoint',
+    'database': 'postgres',
+    'user': 'postgres',
+    'password': 'password'
+    # If using Secrets Manager, replace 'password' with the line below. The
+    # password is cached between warm invocations and re-read when rejected.
+    # 'secret_name': secret_name
+}
+
+def lambda_handler(event, context):
+    # PSM session logs only, uploaded under logs/ by local-logs-to-s3.ps1 and
+    # remote-logs-to-s3.ps1. Parsing and the hourly rollups live in psm_logs.py.
+    handle_event(event, s3, bucket_name, rds_config, loader_names=['psm_logs'])
@@ -0,0 +1,150 @@
+from batch_normalize import Field, epoch_s_column, epoch_us_column, none_if_empty_column
+from bulk_upsert import KeyLookup
+from entity_registry import ChildTable, EntityLoader, register_loader
+from ingest_logging import RecordLog, get_logger
+from kpi_summaries import ACCOUNT_KPIS, PLATFORM_KPIS
+
+logger = get_logger(__name__)
+record_log = RecordLog(logger)
+
+
+# -----------------------------------
+# Platforms (GET /Platforms -> "Platforms")
+# -----------------------------------
+PLATFORMS = register_loader(EntityLoader(
+    name='platforms',
+    prefix='platforms-',
+    records_key='Platforms',
+    table='pam_platforms',
+    conflict_columns=['platform_id'],
+    history=True,
+    soft_delete=True,
+    summaries=[PLATFORM_KPIS],
+    fields=[
+        ('platform_id', Field(('general', 'id'))),
+        ('platform_name', Field(('general', 'name'), '')),
+        ('system_type', Field(('general', 'systemType'), '')),
+        ('active', Field(('general', 'active'), True)),
+        ('description', Field(('general', 'description'), '')),
+        ('platform_base_id', Field(('general', 'platformBaseID'), '')),
+        ('platform_type', Field(('general', 'platformType'), '')),
+        ('require_password_change_days',
+         Field(('credentialsManagement', 'requirePasswordChangeEveryXDays'), 0)),
+        ('require_verification_days',
+         Field(('credentialsManagement', 'requirePasswordVerificationEveryXDays'), 0)),
+        ('automatic_reconcile',
+         Field(('credentialsManagement', 'automaticReconcileWhenUnsynched'), False)),
+        ('require_psm',
+         Field(('sessionManagement', 'requirePrivilegedSessionMonitoringAndIsolation'), False)),
+        ('record_session_activity',
+         Field(('sessionManagement', 'recordAndSaveSessionActivity'), False)),
+    ]
+))
+
+
+# -----------------------------------
+# Safes (GET /Safes -> "value"), with nested accounts
+# -----------------------------------
+def log_missing_fields(safe):
+    missing_fields = []
+    required_fields = ['safeName', 'creator', 'creationTime', 'lastModificationTime', 'managingCPM']
+    for field in required_fields:
+        if not safe.get(field):
+            missing_fields.append(field)
+    if missing_fields:
+        record_log.warning("Safe '%s' is missing fields: %s",
+                           safe.get('safeName', 'N/A'), ', '.join(missing_fields))
+
+
+def validate_safe(safe):
+    log_missing_fields(safe)
+
+    managing_cpm = safe.get('managingCPM', '')
+    # NOTE: If managing_cpm can exceed 255 characters, consider ALTER TABLE pam_safes
+    #       ALTER COLUMN managing_cpm TYPE text;
+    #       otherwise the row is rejected to pam_ingest_rejects.
+    if len(managing_cpm) > 255:
+        record_log.warning("managing_cpm of safe '%s' exceeds 255 chars. (Length=%s)",
+                           safe.get('safeName'), len(managing_cpm))
+
+    record_log.debug(
+        "Extracted values for safe '%s': lastModificationTime=%s, creator=%s, "
+        "managing_cpm=%s, safe_number=%s",
+        safe.get('safeName'), safe.get('lastModificationTime'),
+        safe.get('creator', {}).get('name'), managing_cpm, safe.get('safeNumber', 0)
+    )
+
+
+SAFES = register_loader(EntityLoader(
+    name='safes',
+    prefix='safes-',
+    records_key='value',
+    table='pam_safes',
+    conflict_columns=['safe_name'],
+    history=True,
+    soft_delete=True,
+    fields=[
+        ('safe_name', Field('safeName')),
+        ('description', Field('description', '')),
+        ('olac_enabled', Field('olacEnabled', False)),
+        ('managing_cpm', Field('managingCPM', '')),
+        ('safe_number', Field('safeNumber', 0)),
+        ('creator_id', Field(('creator', 'id'), convert=none_if_empty_column)),
+        ('creator_name', Field(('creator', 'name'), convert=none_if_empty_column)),
+        ('location', Field('location', '\\')),
+        # creationTime is in SECONDS
+        ('creation_date', Field('creationTime', convert=epoch_s_column)),
+        # lastModificationTime is in MICROSECONDS
+        ('last_modification_time', Field('lastModificationTime', convert=epoch_us_column)),
+    ],
+    validate=validate_safe,
+    children=[
+        ChildTable(
+            table='pam_safe_accounts',
+            fields=[
+                ('safe_name', lambda s, a: s.get('safeName')),
+                ('account_id', lambda s, a: a.get('accountId') or None),
+                ('account_name', lambda s, a: a.get('accountName') or None),
+            ],
+            conflict_columns=['safe_name', 'account_id'],
+            extract=lambda s: s.get('accounts', []),
+            update_columns=[],
+            lookups=[KeyLookup('safe_key', 'pam_safes', 'safe_name')]
+        )
+    ]
+))
+
+
+# -----------------------------------
+# Accounts (GET /Accounts -> "value")
+# -----------------------------------
+ACCOUNTS = register_loader(EntityLoader(
+    name='accounts',
+    prefix='accounts-',
+    records_key='value',
+    table='pam_accounts',
+    conflict_columns=['account_name'],
+    history=True,
+    soft_delete=True,
+    summaries=[ACCOUNT_KPIS],
+    # platform_key/safe_key reference the platforms and safes loaded first.
+    lookups=[
+        KeyLookup('platform_key', 'pam_platforms', 'platform_id'),
+        KeyLookup('safe_key', 'pam_safes', 'safe_name'),
+    ],
+    depends_on=['platforms', 'safes'],
+    fields=[
+        ('account_name', Field('name')),
+        ('address', Field('address', '')),
+        ('user_name', Field('userName', '')),
+        ('safe_name', Field('safeName', '')),
+        ('platform_id', Field('platformId', '')),
+        ('secret_type', Field('secretType', '')),
+        ('automatic_management_enabled',
+         Field(('secretManagement', 'automaticManagementEnabled'), False)),
+        # Since the JSON shows createdTime and lastModifiedTime in SECONDS,
+        # convert as epoch seconds (no /1000).
+        ('last_modified_time', Field(('secretManagement', 'lastModifiedTime'), convert=epoch_s_column)),
+        ('creation_time', Field('createdTime', convert=epoch_s_column)),
+    ]
+))
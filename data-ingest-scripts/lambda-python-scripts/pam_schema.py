@@ -0,0 +1,480 @@
+import os
+import sys
+
+from ingest_logging import get_logger
+
+# Set SCHEMA_MIGRATIONS=false when the DDL is managed outside the loaders;
+# `python pam_schema.py` prints it. The loaders need at least migration 11.
+MIGRATIONS_ENABLED = os.environ.get('SCHEMA_MIGRATIONS', 'true').lower() == 'true'
+
+# Serializes migrations between concurrently starting Lambdas.
+_MIGRATION_LOCK_KEY = 'pam_schema_migrations'
+
+logger = get_logger(__name__)
+
+# Highest version known to be applied in this container.
+_applied_version = 0
+
+# (version, description, statements), applied in order, each exactly once.
+# Never edit an applied migration; add a new one.
+MIGRATIONS = [
+    (1, 'base tables', [
+        # The tables the loaders write to, with the natural keys their
+        # upserts conflict on. Existing tables are left as they are.
+        """
+        CREATE TABLE IF NOT EXISTS pam_platforms (
+            platform_id varchar(255) PRIMARY KEY,
+            platform_name varchar(255),
+            system_type varchar(255),
+            active boolean,
+            description text,
+            platform_base_id varchar(255),
+            platform_type varchar(255),
+            require_password_change_days integer,
+            require_verification_days integer,
+            automatic_reconcile boolean,
+            require_psm boolean,
+            record_session_activity boolean
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS pam_safes (
+            safe_name varchar(255) PRIMARY KEY,
+            description text,
+            olac_enabled boolean,
+            managing_cpm varchar(255),
+            safe_number integer,
+            creator_id varchar(255),
+            creator_name varchar(255),
+            location varchar(255),
+            creation_date timestamp,
+            last_modification_time timestamp
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS pam_safe_accounts (
+            safe_name varchar(255) NOT NULL,
+            account_id varchar(255) NOT NULL,
+            account_name varchar(255),
+            PRIMARY KEY (safe_name, account_id)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS pam_accounts (
+            account_name varchar(255) PRIMARY KEY,
+            address varchar(255),
+            user_name varchar(255),
+            safe_name varchar(255),
+            platform_id varchar(255),
+            secret_type varchar(50),
+            automatic_management_enabled boolean,
+            last_modified_time timestamp,
+            creation_time timestamp
+        )
+        """,
+    ]),
+    (2, 'surrogate keys and foreign keys', [
+        # Integer keys for joins. The natural keys stay, as the exports
+        # reference each other by name and the upserts conflict on them.
+        "ALTER TABLE pam_platforms ADD COLUMN IF NOT EXISTS platform_key bigint GENERATED BY DEFAULT AS IDENTITY",
+        "ALTER TABLE pam_platforms ADD CONSTRAINT pam_platforms_platform_key_key UNIQUE (platform_key)",
+        "ALTER TABLE pam_safes ADD COLUMN IF NOT EXISTS safe_key bigint GENERATED BY DEFAULT AS IDENTITY",
+        "ALTER TABLE pam_safes ADD CONSTRAINT pam_safes_safe_key_key UNIQUE (safe_key)",
+        "ALTER TABLE pam_accounts ADD COLUMN IF NOT EXISTS account_key bigint GENERATED BY DEFAULT AS IDENTITY",
+        "ALTER TABLE pam_accounts ADD CONSTRAINT pam_accounts_account_key_key UNIQUE (account_key)",
+        # References to a platform or safe missing from its export stay NULL
+        # rather than rejecting the row; the next load fills them in.
+        """
+        ALTER TABLE pam_accounts
+            ADD COLUMN IF NOT EXISTS platform_key bigint
+                REFERENCES pam_platforms (platform_key) ON DELETE SET NULL,
+            ADD COLUMN IF NOT EXISTS safe_key bigint
+                REFERENCES pam_safes (safe_key) ON DELETE SET NULL
+        """,
+        """
+        ALTER TABLE pam_safe_accounts
+            ADD COLUMN IF NOT EXISTS safe_key bigint
+                REFERENCES pam_safes (safe_key) ON DELETE SET NULL
+        """,
+        """
+        UPDATE pam_accounts a SET platform_key = p.platform_key
+        FROM pam_platforms p WHERE p.platform_id = a.platform_id
+        """,
+        """
+        UPDATE pam_accounts a SET safe_key = s.safe_key
+        FROM pam_safes s WHERE s.safe_name = a.safe_name
+        """,
+        """
+        UPDATE pam_safe_accounts sa SET safe_key = s.safe_key
+        FROM pam_safes s WHERE s.safe_name = sa.safe_name
+        """,
+    ]),
+    (3, 'dashboard indexes', [
+        # Foreign keys, with the filter columns QuickSight slices by so the
+        # usual filter combinations are answered from the index alone.
+        """
+        CREATE INDEX IF NOT EXISTS pam_accounts_platform_filter_idx
+            ON pam_accounts (platform_key, automatic_management_enabled, last_modified_time)
+            INCLUDE (safe_key)
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS pam_accounts_safe_filter_idx
+            ON pam_accounts (safe_key, automatic_management_enabled, last_modified_time)
+            INCLUDE (platform_key)
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS pam_accounts_last_modified_idx
+            ON pam_accounts (last_modified_time)
+            INCLUDE (automatic_management_enabled, platform_key, safe_key)
+        """,
+        # Name joins still used by older datasets and the KPI refresh.
+        "CREATE INDEX IF NOT EXISTS pam_accounts_platform_id_idx ON pam_accounts (platform_id)",
+        "CREATE INDEX IF NOT EXISTS pam_accounts_safe_name_idx ON pam_accounts (safe_name)",
+        "CREATE INDEX IF NOT EXISTS pam_safe_accounts_safe_key_idx ON pam_safe_accounts (safe_key)",
+        """
+        CREATE OR REPLACE VIEW pam_account_details AS
+        SELECT a.account_key, a.account_name, a.address, a.user_name, a.secret_type,
+               a.automatic_management_enabled, a.last_modified_time, a.creation_time,
+               a.platform_key, p.platform_id, p.platform_name, p.system_type,
+               p.require_password_change_days, p.require_psm,
+               a.safe_key, s.safe_name, s.managing_cpm, s.olac_enabled
+        FROM pam_accounts a
+        LEFT JOIN pam_platforms p ON p.platform_key = a.platform_key
+        LEFT JOIN pam_safes s ON s.safe_key = a.safe_key
+        """,
+        "ANALYZE pam_platforms",
+        "ANALYZE pam_safes",
+        "ANALYZE pam_safe_accounts",
+        "ANALYZE pam_accounts",
+    ]),
+    (4, 'psm session events and hourly rollups', [
+        # Raw PSM log events, one row per parsed line, range-partitioned by
+        # month; psm_logs.py creates the partitions as months appear.
+        # event_hash identifies a line within its log file, so a log uploaded
+        # again (or after it grew) only adds its new lines.
+        """
+        CREATE TABLE IF NOT EXISTS pam_psm_events (
+            event_time timestamp NOT NULL,
+            event_hash text NOT NULL,
+            log_source varchar(50),
+            log_file varchar(255),
+            line_number integer,
+            severity varchar(20),
+            message_code varchar(50),
+            event_type varchar(50) NOT NULL,
+            user_name varchar(255),
+            target varchar(255),
+            session_id varchar(255),
+            message text,
+            PRIMARY KEY (event_time, event_hash)
+        ) PARTITION BY RANGE (event_time)
+        """,
+        # What the dashboards read: events per hour, type and target.
+        """
+        CREATE TABLE IF NOT EXISTS pam_psm_hourly (
+            event_hour timestamp NOT NULL,
+            event_type varchar(50) NOT NULL,
+            target varchar(255),
+            event_count integer NOT NULL,
+            user_count integer NOT NULL,
+            session_count integer NOT NULL,
+            refreshed_at timestamptz NOT NULL DEFAULT now()
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS pam_psm_hourly_hour_idx ON pam_psm_hourly (event_hour, event_type)",
+    ]),
+    (5, 'soft deletes and snapshot sweeps', [
+        # Set when a complete full export no longer lists the row, cleared
+        # when a later export lists it again (snapshot_sweep.py).
+        "ALTER TABLE pam_platforms ADD COLUMN IF NOT EXISTS deleted_at timestamp",
+        "ALTER TABLE pam_safes ADD COLUMN IF NOT EXISTS deleted_at timestamp",
+        "ALTER TABLE pam_accounts ADD COLUMN IF NOT EXISTS deleted_at timestamp",
+        "ALTER TABLE pam_safe_accounts ADD COLUMN IF NOT EXISTS deleted_at timestamp",
+        # Small partial indexes, so reviving rows only looks at deleted ones.
+        """
+        CREATE INDEX IF NOT EXISTS pam_platforms_deleted_idx
+            ON pam_platforms (platform_id) WHERE deleted_at IS NOT NULL
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS pam_safes_deleted_idx
+            ON pam_safes (safe_name) WHERE deleted_at IS NOT NULL
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS pam_accounts_deleted_idx
+            ON pam_accounts (account_name) WHERE deleted_at IS NOT NULL
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS pam_safe_accounts_deleted_idx
+            ON pam_safe_accounts (safe_name, account_id) WHERE deleted_at IS NOT NULL
+        """,
+        # The parts of a multi-part full export loaded so far, and the keys
+        # they listed; both are emptied once the generation is swept.
+        """
+        CREATE TABLE IF NOT EXISTS pam_snapshot_parts (
+            entity text NOT NULL,
+            generation bigint NOT NULL,
+            part integer NOT NULL,
+            parts integer NOT NULL,
+            source_key text NOT NULL,
+            rejected integer NOT NULL DEFAULT 0,
+            loaded_at timestamptz NOT NULL DEFAULT now(),
+            PRIMARY KEY (entity, generation, part)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS pam_snapshot_keys (
+            entity text NOT NULL,
+            generation bigint NOT NULL,
+            table_name text NOT NULL,
+            key_values text[] NOT NULL,
+            PRIMARY KEY (entity, generation, table_name, key_values)
+        )
+        """,
+        # One row per table and swept generation.
+        """
+        CREATE TABLE IF NOT EXISTS pam_snapshot_sweeps (
+            entity text NOT NULL,
+            generation bigint NOT NULL,
+            table_name text NOT NULL,
+            listed integer NOT NULL,
+            retired integer NOT NULL,
+            swept_at timestamptz NOT NULL DEFAULT now(),
+            PRIMARY KEY (entity, generation, table_name)
+        )
+        """,
+        """
+        CREATE OR REPLACE VIEW pam_account_details AS
+        SELECT a.account_key, a.account_name, a.address, a.user_name, a.secret_type,
+               a.automatic_management_enabled, a.last_modified_time, a.creation_time,
+               a.platform_key, p.platform_id, p.platform_name, p.system_type,
+               p.require_password_change_days, p.require_psm,
+               a.safe_key, s.safe_name, s.managing_cpm, s.olac_enabled
+        FROM pam_accounts a
+        LEFT JOIN pam_platforms p ON p.platform_key = a.platform_key
+        LEFT JOIN pam_safes s ON s.safe_key = a.safe_key
+        WHERE a.deleted_at IS NULL
+        """,
+    ]),
+    (6, 'psm event byte offsets', [
+        # Where each event's line starts in its log file. Logs are shipped in
+        # chunks, so line numbers are only known for whole files.
+        "ALTER TABLE pam_psm_events ADD COLUMN IF NOT EXISTS byte_offset bigint",
+    ]),
+    (7, 'ingest manifest', [
+        # One small row per S3 object processed, superseded or failed
+        # (s3_discovery.py). Loaders before this migration created it on
+        # first use; an existing manifest is left as it is.
+        """
+        CREATE TABLE IF NOT EXISTS pam_ingest_manifest (
+            object_key text PRIMARY KEY,
+            etag text NOT NULL,
+            entity text NOT NULL,
+            processed_at timestamptz NOT NULL DEFAULT now(),
+            status text NOT NULL DEFAULT 'processed',
+            attempts integer NOT NULL DEFAULT 1,
+            last_error text
+        )
+        """,
+        # Manifests created before failures were tracked.
+        """
+        ALTER TABLE pam_ingest_manifest
+            ADD COLUMN IF NOT EXISTS status text NOT NULL DEFAULT 'processed',
+            ADD COLUMN IF NOT EXISTS attempts integer NOT NULL DEFAULT 1,
+            ADD COLUMN IF NOT EXISTS last_error text
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS pam_ingest_manifest_entity_key_idx
+            ON pam_ingest_manifest (entity, object_key)
+        """,
+    ]),
+    (8, 'ingest rejects', [
+        # Dead letters of rows the database refused (bulk_upsert.py).
+        """
+        CREATE TABLE IF NOT EXISTS pam_ingest_rejects (
+            id bigserial PRIMARY KEY,
+            target_table text NOT NULL,
+            source_key text,
+            record jsonb NOT NULL,
+            error text NOT NULL,
+            rejected_at timestamptz NOT NULL DEFAULT now()
+        )
+        """,
+    ]),
+    (9, 'entity history', [
+        # SCD2 versions of the tracked columns, range-partitioned by month;
+        # entity_history.py creates the partitions as months appear.
+        """
+        CREATE TABLE IF NOT EXISTS pam_platforms_history (
+            period_month date NOT NULL,
+            platform_id varchar(255),
+            platform_name varchar(255),
+            system_type varchar(255),
+            active boolean,
+            description text,
+            platform_base_id varchar(255),
+            platform_type varchar(255),
+            require_password_change_days integer,
+            require_verification_days integer,
+            automatic_reconcile boolean,
+            require_psm boolean,
+            record_session_activity boolean,
+            row_hash text,
+            valid_from timestamp NOT NULL,
+            valid_to timestamp
+        ) PARTITION BY RANGE (period_month)
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS pam_platforms_history_key_idx
+            ON pam_platforms_history (platform_id, period_month)
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS pam_safes_history (
+            period_month date NOT NULL,
+            safe_name varchar(255),
+            description text,
+            olac_enabled boolean,
+            managing_cpm varchar(255),
+            safe_number integer,
+            creator_id varchar(255),
+            creator_name varchar(255),
+            location varchar(255),
+            creation_date timestamp,
+            last_modification_time timestamp,
+            row_hash text,
+            valid_from timestamp NOT NULL,
+            valid_to timestamp
+        ) PARTITION BY RANGE (period_month)
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS pam_safes_history_key_idx
+            ON pam_safes_history (safe_name, period_month)
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS pam_accounts_history (
+            period_month date NOT NULL,
+            account_name varchar(255),
+            address varchar(255),
+            user_name varchar(255),
+            safe_name varchar(255),
+            platform_id varchar(255),
+            secret_type varchar(50),
+            automatic_management_enabled boolean,
+            last_modified_time timestamp,
+            creation_time timestamp,
+            row_hash text,
+            valid_from timestamp NOT NULL,
+            valid_to timestamp
+        ) PARTITION BY RANGE (period_month)
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS pam_accounts_history_key_idx
+            ON pam_accounts_history (account_name, period_month)
+        """,
+    ]),
+    (10, 'kpi summaries', [
+        # Accounts per platform (or safe) and password due date, kept
+        # current by kpi_summaries.py; the pam_accounts indexes the refresh
+        # reads by are part of migration 3.
+        """
+        CREATE TABLE IF NOT EXISTS pam_kpi_platform_daily (
+            platform_id text NOT NULL,
+            due_date date,
+            account_count integer NOT NULL,
+            auto_managed_count integer NOT NULL,
+            psm_required_count integer NOT NULL,
+            refreshed_at timestamptz NOT NULL DEFAULT now()
+        )
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS pam_kpi_platform_daily_group_idx
+            ON pam_kpi_platform_daily (platform_id, due_date)
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS pam_kpi_safe_daily (
+            safe_name text NOT NULL,
+            due_date date,
+            account_count integer NOT NULL,
+            auto_managed_count integer NOT NULL,
+            psm_required_count integer NOT NULL,
+            refreshed_at timestamptz NOT NULL DEFAULT now()
+        )
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS pam_kpi_safe_daily_group_idx
+            ON pam_kpi_safe_daily (safe_name, due_date)
+        """,
+    ]),
+    (11, 'row hashes', [
+        # md5 of each row's updatable columns, written by bulk_upsert.py so
+        # records that did not change are not rewritten.
+        "ALTER TABLE pam_platforms ADD COLUMN IF NOT EXISTS row_hash text",
+        "ALTER TABLE pam_safes ADD COLUMN IF NOT EXISTS row_hash text",
+        "ALTER TABLE pam_accounts ADD COLUMN IF NOT EXISTS row_hash text",
+    ]),
+]
+
+
+_MIGRATIONS_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS pam_schema_migrations (
+        version integer PRIMARY KEY,
+        description text NOT NULL,
+        applied_at timestamptz NOT NULL DEFAULT now()
+    )
+"""
+_RECORD_MIGRATION_SQL = "INSERT INTO pam_schema_migrations (version, description) VALUES (%s, %s)"
+
+
+def migrate(cursor):
+    """
+    Applies the migrations this database has not seen yet, in order, in the
+    caller's transaction. After the first call in a container this costs
+    nothing unless the code ships a newer migration.
+    Returns the versions applied.
+    """
+    global _applied_version
+    latest = MIGRATIONS[-1][0]
+    if not MIGRATIONS_ENABLED or _applied_version >= latest:
+        return []
+
+    cursor.execute("SELECT to_regclass('pam_schema_migrations')")
+    if cursor.fetchone()[0] is not None:
+        cursor.execute("SELECT coalesce(max(version), 0) FROM pam_schema_migrations")
+        if cursor.fetchone()[0] >= latest:
+            _applied_version = latest
+            return []
+
+    cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (_MIGRATION_LOCK_KEY,))
+    cursor.execute(_MIGRATIONS_TABLE_SQL)
+    # Read again under the lock: another Lambda may have just migrated.
+    cursor.execute("SELECT version FROM pam_schema_migrations")
+    done = {row[0] for row in cursor.fetchall()}
+
+    applied = []
+    for version, description, statements in MIGRATIONS:
+        if version in done:
+            continue
+        logger.info(f"Applying schema migration {version}: {description}")
+        for statement in statements:
+            cursor.execute(statement)
+        cursor.execute(_RECORD_MIGRATION_SQL, (version, description))
+        applied.append(version)
+    # Not cached yet: the migrations only stick if this transaction commits.
+    return applied
+
+
+def schema_sql():
+    """
+    Returns every migration as one SQL script, for applying them by hand.
+    The script records the versions too, so migrate() can take over later.
+    """
+    parts = ['BEGIN;', f"{' '.join(_MIGRATIONS_TABLE_SQL.split())};"]
+    for version, description, statements in MIGRATIONS:
+        parts.append(f"-- {version}: {description}")
+        parts.extend(f"{' '.join(statement.split())};" for statement in statements)
+        parts.append(_RECORD_MIGRATION_SQL.replace('%s', '{}').format(version, f"'{description}'") + ';')
+    parts.append('COMMIT;')
+    return '\n'.join(parts) + '\n'
+
+
+if __name__ == '__main__':
+    sys.stdout.write(schema_sql())
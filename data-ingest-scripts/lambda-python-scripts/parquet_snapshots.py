@@ -0,0 +1,194 @@
+import os
+import tempfile
+from datetime import datetime
+from aws_clients import get_client
+from ingest_logging import get_logger
+from ingest_scheduler import export_timestamp, is_delta_export
+from json_stream import EXPORT_SUFFIXES
+
+# Where snapshots go: s3://bucket/prefix/ or a local directory. Unset disables them.
+SNAPSHOT_URI = os.environ.get('PARQUET_SNAPSHOT_URI', '')
+ROW_GROUP_SIZE = int(os.environ.get('PARQUET_ROW_GROUP_SIZE', '50000'))
+COMPRESSION = os.environ.get('PARQUET_COMPRESSION', 'snappy')
+
+# pyarrow is optional: it is only needed when PARQUET_SNAPSHOT_URI is set
+# (e.g. via the AWS SDK for pandas Lambda layer, which bundles it), and only
+# imported then, as importing it takes a noticeable share of a cold start.
+pa = None
+pq = None
+if SNAPSHOT_URI:
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        pass
+
+_warned_missing_pyarrow = False
+
+logger = get_logger(__name__)
+
+
+def _pg_to_arrow(data_type):
+    return {
+        'boolean': pa.bool_(),
+        'smallint': pa.int16(),
+        'integer': pa.int32(),
+        'bigint': pa.int64(),
+        'real': pa.float32(),
+        'double precision': pa.float64(),
+        'numeric': pa.float64(),
+        'date': pa.date32(),
+        'timestamp without time zone': pa.timestamp('us'),
+        'timestamp with time zone': pa.timestamp('us', tz='UTC'),
+    }.get(data_type, pa.string())
+
+
+def snapshots_enabled():
+    global _warned_missing_pyarrow
+    if not SNAPSHOT_URI:
+        return False
+    if pa is None:
+        if not _warned_missing_pyarrow:
+            logger.warning("PARQUET_SNAPSHOT_URI is set but pyarrow is not installed; skipping snapshots.")
+            _warned_missing_pyarrow = True
+        return False
+    return True
+
+
+def arrow_schema(cursor, table, columns):
+    """
+    Builds the Arrow schema for the given columns from the table's Postgres
+    column types, so every file of an entity has the same schema.
+    """
+    cursor.execute("""
+        SELECT column_name, data_type FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = %s
+    """, (table,))
+    pg_types = dict(cursor.fetchall())
+    return pa.schema([(column, _pg_to_arrow(pg_types.get(column))) for column in columns])
+
+
+def export_stem(key):
+    """
+    Returns the file name of an export without its whole suffix, e.g.
+    accounts-20261001_000000-part0001 for ...-part0001.ndjson.gz.
+    """
+    name = os.path.basename(key)
+    # Longest first, so .ndjson.gz is not taken for .gz or .ndjson for .json.
+    for suffix in sorted(EXPORT_SUFFIXES, key=len, reverse=True):
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return os.path.splitext(name)[0]
+
+
+class _NoSnapshot:
+    def add(self, row):
+        pass
+
+    def close(self):
+        pass
+
+    def abort(self):
+        pass
+
+
+class ParquetSnapshot:
+    """
+    Writes the normalized rows of one export as a Parquet file partitioned by
+    entity and snapshot date (entity=<name>/snapshot_date=<yyyy-mm-dd>/),
+    one row group per ROW_GROUP_SIZE rows so memory stays bounded.
+    A snapshot failure is logged and never fails the database load.
+    """
+
+    def __init__(self, cursor, entity, table, columns, source_key):
+        snapshot_time = export_timestamp(source_key or '') or datetime.utcnow()
+        stem = export_stem(source_key or entity)
+        self.relative_path = (f"entity={entity}/snapshot_date={snapshot_time:%Y-%m-%d}/"
+                              f"{stem}.parquet")
+        self.schema = arrow_schema(cursor, table, columns)
+        self.row_count = 0
+        self._columns = [[] for _ in columns]
+        self._failed = False
+
+        fd, self._local_path = tempfile.mkstemp(suffix='.parquet')
+        os.close(fd)
+        try:
+            self._writer = pq.ParquetWriter(self._local_path, self.schema, compression=COMPRESSION)
+        except Exception:
+            os.remove(self._local_path)
+            raise
+
+    def add(self, row):
+        if self._failed:
+            return
+        for values, value in zip(self._columns, row):
+            values.append(value)
+        if len(self._columns[0]) >= ROW_GROUP_SIZE:
+            self._flush()
+
+    def _flush(self):
+        if not self._columns[0]:
+            return
+        try:
+            batch = pa.record_batch(
+                [pa.array(values, type=field.type) for values, field in zip(self._columns, self.schema)],
+                schema=self.schema
+            )
+            self._writer.write_batch(batch)
+            self.row_count += batch.num_rows
+        except (pa.ArrowException, TypeError, ValueError) as e:
+            logger.error(f"Error writing Parquet snapshot {self.relative_path}: {e}")
+            self.abort()
+        finally:
+            self._columns = [[] for _ in self._columns]
+
+    def close(self):
+        """
+        Writes the remaining rows and publishes the file to SNAPSHOT_URI.
+        Re-loading the same export overwrites the same file.
+        """
+        self._flush()
+        if self._failed:
+            return
+        self._writer.close()
+        try:
+            if SNAPSHOT_URI.startswith('s3://'):
+                bucket, _, prefix = SNAPSHOT_URI[len('s3://'):].partition('/')
+                key = f"{prefix.rstrip('/')}/{self.relative_path}".lstrip('/')
+                get_client('s3').upload_file(self._local_path, bucket, key)
+                logger.info(f"Wrote {self.row_count} rows to s3://{bucket}/{key}")
+            else:
+                path = os.path.join(SNAPSHOT_URI, self.relative_path)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(self._local_path, path)
+                logger.info(f"Wrote {self.row_count} rows to {path}")
+        except Exception as e:
+            logger.error(f"Error publishing Parquet snapshot {self.relative_path}: {e}")
+        finally:
+            if os.path.exists(self._local_path):
+                os.remove(self._local_path)
+
+    def abort(self):
+        self._failed = True
+        try:
+            self._writer.close()
+        except Exception:
+            pass
+        if os.path.exists(self._local_path):
+            os.remove(self._local_path)
+
+
+def open_snapshot(cursor, entity, table, columns, source_key):
+    """
+    Returns a ParquetSnapshot for one export, or a no-op stand-in when
+    snapshots are disabled, the export is a delta (it only holds changed
+    records, so it is no snapshot of the entity) or the snapshot cannot be
+    started (e.g. /tmp is full or PARQUET_COMPRESSION names an unknown codec).
+    """
+    if not snapshots_enabled() or is_delta_export(source_key or ''):
+        return _NoSnapshot()
+    try:
+        return ParquetSnapshot(cursor, entity, table, columns, source_key)
+    except Exception as e:
+        logger.error(f"Error starting Parquet snapshot of {entity} for {source_key}: {e}")
+        return _NoSnapshot()
@@ -0,0 +1,457 @@
+import codecs
+import hashlib
+import os
+import posixpath
+import re
+from datetime import datetime
+
+from psycopg2 import sql
+
+from bulk_upsert import BulkUpsert
+from entity_registry import register_loader
+from ingest_logging import get_logger, log_summary
+from ingest_metrics import current_metrics
+from json_stream import DEFAULT_CHUNK_SIZE, DecodedReader
+
+# Where local-logs-to-s3.ps1 and remote-logs-to-s3.ps1 upload the PSM logs,
+# and which of the uploaded files are parsed (gzip-compressed or not).
+LOG_PREFIX = os.environ.get('PSM_LOG_PREFIX', 'logs/')
+LOG_SUFFIXES = tuple(os.environ.get('PSM_LOG_SUFFIXES', '.log,.log.gz,.txt,.txt.gz').split(','))
+
+# Key prefixes under LOG_PREFIX of the two uploaders (logs-<timestamp>-... and
+# remote-logs-<timestamp>-...). Scheduled runs list each from its own
+# watermark; other files under LOG_PREFIX are only loaded from S3 events or
+# a {"mode": "backfill"} run.
+LOG_SOURCES = os.environ.get('PSM_LOG_SOURCES', 'logs-,remote-logs-').split(',')
+
+# Date formats tried in order on the start of each line; PSM writes the
+# server's local time in its regional date format, then HH:MM:SS[.fff].
+DATE_FORMATS = os.environ.get('PSM_LOG_DATE_FORMATS', '%m/%d/%Y,%Y-%m-%d').split(',')
+
+# Months of raw events kept; older monthly partitions are dropped when a new
+# month's partition is created. The hourly rollups are kept. 0 keeps all.
+RETENTION_MONTHS = int(os.environ.get('PSM_EVENT_RETENTION_MONTHS', '13'))
+
+# Longer messages are cut to this many characters.
+MAX_MESSAGE_LENGTH = 2000
+
+EVENTS_TABLE = 'pam_psm_events'
+ROLLUP_TABLE = 'pam_psm_hourly'
+EVENT_COLUMNS = [
+    'event_time', 'event_hash', 'log_source', 'log_file', 'byte_offset', 'line_number', 'severity',
+    'message_code', 'event_type', 'user_name', 'target', 'session_id', 'message'
+]
+
+# Serializes rollup refreshes between concurrent invocations.
+_ROLLUP_LOCK_KEY = 'pam_psm_rollup'
+
+# <date> <time>[.fff] then the rest of the line, e.g.
+# "03/14/2024 09:26:53.412 [4312] :: PSMSR169I Session started ..."
+_LINE_PATTERN = re.compile(
+    r'^\s*(\d{1,4}[/.-]\d{1,2}[/.-]\d{1,4})[ T](\d{1,2}:\d{2}:\d{2})(?:[.,](\d{1,6}))?\s*(.*)$'
+)
+# CyberArk message codes end in their severity: I(nfo), W(arning), E(rror).
+_CODE_PATTERN = re.compile(r'\b([A-Z]{2,10}\d{3,5}([IWEDC]))\b')
+_SEVERITIES = {'I': 'info', 'W': 'warning', 'E': 'error', 'D': 'debug', 'C': 'critical'}
+
+# (event_type, keywords, pattern) checked in order against the message; the
+# first match wins, otherwise the event type is the line's severity. The
+# pattern only runs on messages containing one of the lowercase keywords.
+EVENT_RULES = [
+    ('login_failed', ('log', 'sign', 'auth', 'credential'), re.compile(
+        r'(fail\w*|denied|invalid|reject\w*)\W+(?:\w+\W+){0,4}?(log ?on|log ?in|sign ?in|authenticat\w*|credentials?)'
+        r'|(log ?on|log ?in|authentication)\W+(?:\w+\W+){0,4}?(fail\w*|denied|reject\w*)',
+        re.IGNORECASE)),
+    ('session_start', ('session',), re.compile(
+        r'session\W+(?:\w+\W+){0,4}?(start\w*|began|begun|initiated|opened|established)'
+        r'|(start\w*|open\w*|establish\w*)\W+(?:\w+\W+){0,2}?session',
+        re.IGNORECASE)),
+    ('session_end', ('session',), re.compile(
+        r'session\W+(?:\w+\W+){0,4}?(end\w*|terminat\w*|closed|disconnect\w*|finished)'
+        r'|(end\w*|terminat\w*|clos\w*|disconnect\w*)\W+(?:\w+\W+){0,2}?session',
+        re.IGNORECASE)),
+]
+
+
+def _field_pattern(names):
+    # Values written as "User [jdoe]", "user=jdoe" or "User: jdoe".
+    return re.compile(
+        r'\b(?:' + names + r')\s*(?:\[([^\]\r\n]+)\]|[:=]\s*\[?([^\s,;\]]+))',
+        re.IGNORECASE
+    )
+
+
+# Column -> (keywords, pattern), gated like EVENT_RULES.
+FIELD_PATTERNS = {
+    'user_name': (('user',), _field_pattern(r'user ?name|vault ?user|user')),
+    'target': (('target', 'address', 'machine', 'host'), _field_pattern(
+        r'target(?: machine| address| server)?|remote machine|address|machine|host')),
+    'session_id': (('session',), _field_pattern(r'session ?id|session')),
+}
+
+# "logs-20240314_092653-PSMConsole.log" or "remote-logs-...": the uploader
+# adds a run timestamp to the name of the file it copied, and LogShipper.psm1
+# the byte offset its chunk starts at ("logs-20240314_092653-b1048576-...").
+_KEY_PATTERN = re.compile(r'^(?:(remote)-)?logs-\d{8}_\d{6}-(?:b(\d+)-)?(.+)$')
+
+logger = get_logger(__name__)
+
+# Event partitions already known to exist in this container.
+_ready_partitions = set()
+
+# Parsed dates by their text; a log holds a handful of distinct dates.
+_dates = {}
+
+_BOMS = (codecs.BOM_UTF8, codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)
+
+
+def iter_log_lines(body, offset=0):
+    """
+    Yields (byte_offset, line) for the text lines of a log body, reading it
+    a chunk at a time; byte_offset is where the line starts in the log file,
+    given the offset the body starts at. gzip or zstd input is decompressed
+    as it is read, and UTF-16 text (as some Windows tools write it) is
+    recognized by its byte order mark; anything else is read as UTF-8,
+    replacing undecodable bytes.
+    """
+    reader = DecodedReader(body)
+    first = reader.read(DEFAULT_CHUNK_SIZE)
+    rest = iter(lambda: reader.read(DEFAULT_CHUNK_SIZE), b'')
+    bom = next((bom for bom in _BOMS if first.startswith(bom)), b'')
+    # LogShipper.psm1 repeats the UTF-16 byte order mark at the start of
+    # every later chunk; it is only part of the file at offset 0.
+    position = offset + len(bom) if offset == 0 else offset
+    if bom in (codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE):
+        yield from _iter_utf16_lines(_prepend(first, rest), bom, position)
+        return
+    chunks = _prepend(first[len(bom):], rest)
+
+    pending = b''
+    for chunk in chunks:
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            yield position, line.decode('utf-8', 'replace').rstrip('\r')
+            position += len(line) + 1
+    if pending:
+        yield position, pending.decode('utf-8', 'replace').rstrip('\r')
+
+
+def _iter_utf16_lines(chunks, bom, position):
+    encoding = 'utf-16-le' if bom == codecs.BOM_UTF16_LE else 'utf-16-be'
+    decoder = codecs.getincrementaldecoder('utf-16')(errors='replace')
+    pending = ''
+    for chunk in chunks:
+        lines = (pending + decoder.decode(chunk)).split('\n')
+        pending = lines.pop()
+        for line in lines:
+            yield position, line.rstrip('\r')
+            position += len(line.encode(encoding)) + 2
+    pending += decoder.decode(b'', final=True)
+    if pending:
+        yield position, pending.rstrip('\r')
+
+
+def _prepend(first, chunks):
+    yield first
+    yield from chunks
+
+
+def _parse_date(date_text):
+    if date_text not in _dates:
+        parsed = None
+        for date_format in DATE_FORMATS:
+            try:
+                parsed = datetime.strptime(date_text, date_format)
+                break
+            except ValueError:
+                continue
+        _dates[date_text] = parsed
+    return _dates[date_text]
+
+
+def _parse_time(date_text, time_text, fraction):
+    # strptime per line would cost more than the rest of the parsing.
+    day = _parse_date(date_text)
+    if day is None:
+        return None
+    hour, minute, second = time_text.split(':')
+    try:
+        return day.replace(hour=int(hour), minute=int(minute), second=int(second),
+                           microsecond=int(fraction.ljust(6, '0')) if fraction else 0)
+    except ValueError:
+        return None
+
+
+def _field(name, message, lowered):
+    keywords, pattern = FIELD_PATTERNS[name]
+    if not any(keyword in lowered for keyword in keywords):
+        return None
+    match = pattern.search(message)
+    if not match:
+        return None
+    return (match.group(1) or match.group(2)).strip()[:255] or None
+
+
+def classify(message, severity, lowered=None):
+    """
+    Returns the event type of a log message, e.g. 'login_failed'.
+    """
+    lowered = lowered or message.lower()
+    for event_type, keywords, pattern in EVENT_RULES:
+        if any(keyword in lowered for keyword in keywords) and pattern.search(message):
+            return event_type
+    return severity or 'info'
+
+
+def parse_log_file(lines, log_source, log_file, metrics=None, line_numbers=True):
+    """
+    Yields one pam_psm_events row per timestamped line of (byte_offset, line)
+    pairs. Lines without a timestamp (wrapped messages, stack traces) are
+    counted and skipped.
+
+    event_hash is derived from the log file, the line's byte offset in it
+    and the line itself, so identical lines stay distinct while a log
+    uploaded again, after it grew or in chunks, produces the same hashes.
+    line_number is only known when the lines start at the top of the file;
+    otherwise it is left NULL.
+    """
+    unparsed = 0
+    for line_number, (byte_offset, line) in enumerate(lines, start=1):
+        match = _LINE_PATTERN.match(line)
+        event_time = match and _parse_time(*match.group(1, 2, 3))
+        if not event_time:
+            if line.strip():
+                unparsed += 1
+            continue
+        message = match.group(4).strip()
+        event_hash = hashlib.md5(
+            f"{log_source}\n{log_file}\n{byte_offset}\n{line}".encode('utf-8'), usedforsecurity=False
+        ).hexdigest()
+
+        code = _CODE_PATTERN.search(message)
+        severity = _SEVERITIES[code.group(2)] if code else None
+        lowered = message.lower()
+        yield (
+            event_time, event_hash, log_source, log_file, byte_offset,
+            line_number if line_numbers else None, severity,
+            code.group(1) if code else None, classify(message, severity, lowered),
+            _field('user_name', message, lowered), _field('target', message, lowered),
+            _field('session_id', message, lowered), message[:MAX_MESSAGE_LENGTH]
+        )
+    if unparsed:
+        (metrics or current_metrics()).count('LinesUnparsed', unparsed)
+        logger.info(f"Skipped {unparsed} lines without a timestamp in {log_file}.")
+
+
+def log_file_of(key):
+    """
+    Returns (log_source, log_file, offset) for an uploaded log: 'local' or
+    'remote', the name of the file on the PSM server and the byte offset in
+    it the upload starts at (0 for whole files).
+    """
+    name = posixpath.basename(key)
+    if name.endswith('.gz'):
+        name = name[:-len('.gz')]
+    match = _KEY_PATTERN.match(name)
+    if not match:
+        return 'local', name, 0
+    return ('remote' if match.group(1) else 'local'), match.group(3), int(match.group(2) or 0)
+
+
+def _month_start(moment):
+    return datetime(moment.year, moment.month, 1)
+
+
+def _add_months(month, count):
+    index = month.year * 12 + month.month - 1 + count
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+def _partition_name(month):
+    return f"{EVENTS_TABLE}_p{month:%Y%m}"
+
+
+def _ensure_partitions(cursor, stage_table):
+    """
+    Creates the monthly partitions the staged events fall into, after
+    dropping staged events older than the retention window. Creating a new
+    month's partition drops the expired ones.
+    """
+    if RETENTION_MONTHS > 0:
+        oldest_kept = _add_months(_month_start(datetime.utcnow()), -RETENTION_MONTHS)
+        cursor.execute(
+            sql.SQL("DELETE FROM {stage} WHERE event_time < %s").format(stage=sql.Identifier(stage_table)),
+            (oldest_kept,)
+        )
+        if cursor.rowcount:
+            logger.info(f"Dropped {cursor.rowcount} events older than {oldest_kept:%Y-%m}.")
+
+    cursor.execute(
+        sql.SQL("SELECT DISTINCT date_trunc('month', event_time) FROM {stage}").format(
+            stage=sql.Identifier(stage_table)
+        )
+    )
+    created = False
+    for (month,) in cursor.fetchall():
+        name = _partition_name(month)
+        if name in _ready_partitions:
+            continue
+        cursor.execute("SELECT to_regclass(%s)", (name,))
+        if cursor.fetchone()[0] is not None:
+            _ready_partitions.add(name)
+            continue
+        logger.info(f"Creating event partition {name}.")
+        cursor.execute(
+            sql.SQL(
+                "CREATE TABLE IF NOT EXISTS {partition} PARTITION OF {events} "
+                "FOR VALUES FROM (%s) TO (%s)"
+            ).format(partition=sql.Identifier(name), events=sql.Identifier(EVENTS_TABLE)),
+            (month, _add_months(month, 1))
+        )
+        created = True
+    if created:
+        _drop_expired_partitions(cursor)
+
+
+def _drop_expired_partitions(cursor):
+    if RETENTION_MONTHS <= 0:
+        return
+    oldest_kept = _partition_name(_add_months(_month_start(datetime.utcnow()), -RETENTION_MONTHS))
+    cursor.execute("""
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = %s::regclass
+        ORDER BY c.relname
+    """, (EVENTS_TABLE,))
+    # Partition names end in _pYYYYMM, so name order is month order.
+    for (name,) in cursor.fetchall():
+        if name >= oldest_kept:
+            break
+        logger.info(f"Dropping expired event partition {name}.")
+        cursor.execute(sql.SQL("DROP TABLE {partition}").format(partition=sql.Identifier(name)))
+        _ready_partitions.discard(name)
+
+
+def _capture_new_hours(cursor, stage_table):
+    """
+    Records in psm_touched_hours the hours of staged events that are not in
+    pam_psm_events yet. A log uploaded again touches only the hours of its
+    new lines, or none at all.
+    """
+    cursor.execute("""
+        CREATE TEMP TABLE IF NOT EXISTS psm_touched_hours (
+            event_hour timestamp PRIMARY KEY
+        ) ON COMMIT DROP
+    """)
+    cursor.execute(
+        sql.SQL(
+            "INSERT INTO psm_touched_hours "
+            "SELECT DISTINCT date_trunc('hour', s.event_time) FROM {stage} s "
+            "WHERE NOT EXISTS (SELECT 1 FROM {events} e "
+            "WHERE e.event_time = s.event_time AND e.event_hash = s.event_hash) "
+            "ON CONFLICT DO NOTHING"
+        ).format(stage=sql.Identifier(stage_table), events=sql.Identifier(EVENTS_TABLE))
+    )
+
+
+def refresh_hourly_rollups(cursor):
+    """
+    Recomputes the pam_psm_hourly rows of every hour in psm_touched_hours
+    from that hour's events. Returns the number of rollup rows written.
+    """
+    cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (_ROLLUP_LOCK_KEY,))
+    cursor.execute(
+        sql.SQL("DELETE FROM {rollup} WHERE event_hour IN (SELECT event_hour FROM psm_touched_hours)").format(
+            rollup=sql.Identifier(ROLLUP_TABLE)
+        )
+    )
+    # The range on event_time lets the planner prune to the touched months
+    # and use the primary key; the join keeps only the touched hours.
+    cursor.execute(
+        sql.SQL(
+            "INSERT INTO {rollup} (event_hour, event_type, target, event_count, user_count, session_count) "
+            "SELECT date_trunc('hour', e.event_time), e.event_type, e.target, count(*), "
+            "count(DISTINCT e.user_name), count(DISTINCT e.session_id) "
+            "FROM {events} e "
+            "JOIN psm_touched_hours t ON t.event_hour = date_trunc('hour', e.event_time) "
+            "WHERE e.event_time >= (SELECT min(event_hour) FROM psm_touched_hours) "
+            "AND e.event_time < (SELECT max(event_hour) FROM psm_touched_hours) + interval '1 hour' "
+            "GROUP BY 1, 2, 3"
+        ).format(rollup=sql.Identifier(ROLLUP_TABLE), events=sql.Identifier(EVENTS_TABLE))
+    )
+    written = cursor.rowcount
+    cursor.execute("TRUNCATE psm_touched_hours")
+    return written
+
+
+class PsmLogLoader:
+    """
+    Loads PSM log files uploaded under LOG_PREFIX into pam_psm_events and
+    keeps the pam_psm_hourly rollups current.
+
+    Each file is read line by line as it streams in, parsed into event rows
+    (see parse_log_file) and staged with COPY. The merge skips events that
+    are already loaded, and only the hours that gained events are rolled up
+    again, in the same transaction. Dashboards read the rollups, e.g.:
+
+        SELECT event_hour, target, event_count FROM pam_psm_hourly
+        WHERE event_type = 'login_failed' AND event_hour >= now() - interval '7 days';
+
+    Registered under the same interface as EntityLoader, so the scheduler
+    and manifest treat log files like any other export.
+    """
+
+    def __init__(self, name='psm_logs', prefix=LOG_PREFIX, suffix=LOG_SUFFIXES):
+        self.name = name
+        self.prefix = prefix
+        self.suffix = suffix
+        self.processed_prefix = f"{prefix}{name}-processed-"
+        self.listing_prefixes = [f"{prefix}{source}" for source in LOG_SOURCES]
+        self.table = EVENTS_TABLE
+        self.depends_on = []
+        # Every log chunk holds lines no other file has; none is ever skipped.
+        self.snapshots = False
+
+    def handles(self, key):
+        return (key.startswith(self.prefix)
+                and not key.startswith(self.processed_prefix)
+                and key.endswith(self.suffix))
+
+    def read_records(self, body, key, export=None):
+        # Logs carry no export metadata; `export` is left empty.
+        log_source, log_file, offset = log_file_of(key)
+        return parse_log_file(iter_log_lines(body, offset), log_source, log_file,
+                              line_numbers=offset == 0)
+
+    def process(self, records, cursor, source_key=None, export=None):
+        """
+        Bulk loads the parsed events of one log file and refreshes the
+        rollups of the hours it added events to. Returns the UpsertResult.
+        """
+        logger.info(f"Starting {self.name} data processing...")
+        metrics = current_metrics()
+        # No update columns: an event already loaded is left as it is.
+        upsert = BulkUpsert(cursor, EVENTS_TABLE, EVENT_COLUMNS, ['event_time', 'event_hash'],
+                            update_columns=[], source_key=source_key)
+        upsert.extend(records)
+        upsert.flush()
+
+        with metrics.timer('Summaries'):
+            _ensure_partitions(cursor, upsert.stage_table)
+            _capture_new_hours(cursor, upsert.stage_table)
+        with metrics.timer('Merge'):
+            result = upsert.merge()
+        with metrics.timer('Summaries'):
+            rollup_rows = refresh_hourly_rollups(cursor) if result.inserted else 0
+
+        metrics.count('RowsInserted', result.inserted)
+        metrics.count('RowsUnchanged', result.unchanged)
+        metrics.count('RowsRejected', result.rejected)
+        log_summary(logger, f"Completed processing {result.staged} {self.name}",
+                    entity=self.name, source_key=source_key, rollup_rows=rollup_rows,
+                    **result._asdict())
+        return result
+
+
+PSM_LOGS = register_loader(PsmLogLoader())
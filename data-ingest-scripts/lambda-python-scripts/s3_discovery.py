@@ -0,0 +1,300 @@
+import os
+from datetime import timedelta
+from urllib.parse import unquote_plus
+
+from botocore.exceptions import ClientError
+from psycopg2.extras import execute_values
+from ingest_logging import get_logger
+from ingest_scheduler import export_timestamp
+
+# Keys looked up in the manifest per query when filtering a listing.
+MANIFEST_LOOKUP_BATCH = int(os.environ.get('MANIFEST_LOOKUP_BATCH', '1000'))
+
+# A file that fails this many times is left alone until it is re-uploaded
+# (new ETag) or its manifest row is deleted.
+MAX_ATTEMPTS = int(os.environ.get('INGEST_MAX_ATTEMPTS', '3'))
+
+# Scheduled runs list from this long before the newest processed export,
+# so late-arriving files with slightly older timestamps are still found.
+LISTING_LOOKBACK_HOURS = int(os.environ.get('LISTING_LOOKBACK_HOURS', '24'))
+
+# A scheduled listing that returns more processed objects than this is
+# logged as a warning.
+LISTING_WARN_PROCESSED = int(os.environ.get('LISTING_WARN_PROCESSED', '1000'))
+
+# Sorts after every other character, so StartAfter=prefix + _KEY_MAX skips
+# the whole key range under that prefix.
+_KEY_MAX = '\U0010FFFF'
+
+logger = get_logger(__name__)
+
+
+def mark_processed(cursor, entity, key, etag):
+    """
+    Records an object as processed. Call inside the same transaction as the
+    data load so the manifest and the tables commit (or roll back) together.
+    """
+    cursor.execute("""
+        INSERT INTO pam_ingest_manifest (object_key, etag, entity, status)
+        VALUES (%s, %s, %s, 'processed')
+        ON CONFLICT (object_key)
+        DO UPDATE SET
+            etag = EXCLUDED.etag,
+            entity = EXCLUDED.entity,
+            processed_at = now(),
+            status = 'processed',
+            last_error = NULL
+    """, (key, etag, entity))
+
+
+def mark_superseded(cursor, objects):
+    """
+    Records objects that were never loaded because a newer full export
+    replaces them, so later listings skip them like processed ones.
+    """
+    if not objects:
+        return
+    execute_values(cursor, """
+        INSERT INTO pam_ingest_manifest (object_key, etag, entity, status)
+        VALUES %s
+        ON CONFLICT (object_key)
+        DO UPDATE SET
+            etag = EXCLUDED.etag,
+            entity = EXCLUDED.entity,
+            processed_at = now(),
+            status = 'superseded',
+            last_error = NULL
+    """, [(obj['Key'], obj['ETag'], obj['Entity'], 'superseded') for obj in objects],
+        template="(%s, %s, %s, %s)")
+
+
+def mark_failed(cursor, entity, key, etag, error):
+    """
+    Records a failed load so the object is retried on later runs, up to
+    MAX_ATTEMPTS times per ETag. Call in its own transaction, after the
+    load's transaction has rolled back.
+    """
+    cursor.execute("""
+        INSERT INTO pam_ingest_manifest (object_key, etag, entity, status, attempts, last_error)
+        VALUES (%s, %s, %s, 'failed', 1, %s)
+        ON CONFLICT (object_key)
+        DO UPDATE SET
+            attempts = CASE WHEN pam_ingest_manifest.etag = EXCLUDED.etag
+                            THEN pam_ingest_manifest.attempts + 1 ELSE 1 END,
+            etag = EXCLUDED.etag,
+            entity = EXCLUDED.entity,
+            processed_at = now(),
+            status = 'failed',
+            last_error = EXCLUDED.last_error
+        RETURNING attempts
+    """, (key, etag, entity, str(error)))
+    return cursor.fetchone()[0]
+
+
+def _iter_listing(s3, bucket, prefix, start_after, skip_prefix):
+    """
+    Yields object summaries under prefix in key order, paginating past the
+    1000-key page limit and jumping over the skip_prefix range in one request.
+    """
+    paginator = s3.get_paginator('list_objects_v2')
+    while True:
+        params = {'Bucket': bucket, 'Prefix': prefix}
+        if start_after:
+            params['StartAfter'] = start_after
+
+        jumped = False
+        for page in paginator.paginate(**params):
+            for obj in page.get('Contents', []):
+                if skip_prefix and obj['Key'].startswith(skip_prefix):
+                    start_after = skip_prefix + _KEY_MAX
+                    jumped = True
+                    break
+                yield obj
+            if jumped:
+                break
+
+        if not jumped:
+            return
+        # Only jump once; anything after the skipped range is listed normally.
+        skip_prefix = None
+
+
+def _filter_processed(cursor, objects):
+    """
+    Drops objects whose key and ETag are already in the manifest as
+    processed, or as failed MAX_ATTEMPTS times.
+    """
+    new_objects = []
+    for i in range(0, len(objects), MANIFEST_LOOKUP_BATCH):
+        batch = objects[i:i + MANIFEST_LOOKUP_BATCH]
+        cursor.execute(
+            "SELECT object_key, etag, status, attempts FROM pam_ingest_manifest "
+            "WHERE object_key = ANY(%s)",
+            ([obj['Key'] for obj in batch],)
+        )
+        seen = {key: (etag, status, attempts) for key, etag, status, attempts in cursor.fetchall()}
+        for obj in batch:
+            etag, status, attempts = seen.get(obj['Key'], (None, None, 0))
+            if etag != obj['ETag']:
+                new_objects.append(obj)
+            elif status == 'failed' and attempts < MAX_ATTEMPTS:
+                logger.info(f"Retrying {obj['Key']} (failed {attempts} of {MAX_ATTEMPTS} attempts).")
+                new_objects.append(obj)
+            elif status == 'failed':
+                logger.warning(f"Skipping {obj['Key']}: failed {attempts} times; re-upload it to retry.")
+    return new_objects
+
+
+def _like_prefix(prefix):
+    return prefix.replace('%', r'\%').replace('_', r'\_') + '%'
+
+
+def newest_processed_export(cursor, entity, prefix, full_only=False):
+    """
+    Returns the key of the newest export of the entity loaded so far (the
+    newest full snapshot with full_only), or None. Keys sort by their
+    export timestamp, so this is the greatest processed key.
+    """
+    cursor.execute("""
+        SELECT max(object_key) FROM pam_ingest_manifest
+        WHERE entity = %s AND status = 'processed' AND object_key LIKE %s
+          AND (NOT %s OR object_key !~ '[0-9]{8}_[0-9]{6}-delta')
+    """, (entity, _like_prefix(prefix), full_only))
+    return cursor.fetchone()[0]
+
+
+def listing_watermark(cursor, entity, prefix):
+    """
+    Returns the StartAfter key for a scheduled listing: LISTING_LOOKBACK_HOURS
+    before the newest processed export of the entity, or None to list
+    everything (no processed exports yet, or keys without timestamps).
+    """
+    newest = newest_processed_export(cursor, entity, prefix)
+    newest_time = export_timestamp(newest) if newest else None
+    if newest_time is None:
+        return None
+    return f"{prefix}{newest_time - timedelta(hours=LISTING_LOOKBACK_HOURS):%Y%m%d_%H%M%S}"
+
+
+def list_retry_objects(s3, bucket, cursor, entity, prefix):
+    """
+    Returns summaries for the entity's failed objects under prefix that
+    still have attempts left; these may sit before the listing watermark.
+    """
+    cursor.execute("""
+        SELECT object_key FROM pam_ingest_manifest
+        WHERE entity = %s AND status = 'failed' AND attempts < %s AND object_key LIKE %s
+    """, (entity, MAX_ATTEMPTS, _like_prefix(prefix)))
+    objects = []
+    for (key,) in cursor.fetchall():
+        try:
+            head = s3.head_object(Bucket=bucket, Key=key)
+        except ClientError as e:
+            logger.warning(f"Cannot retry {key}: {e}")
+            continue
+        objects.append({'Key': key, 'ETag': head['ETag'], 'Size': head.get('ContentLength'),
+                        'Entity': entity})
+    return objects
+
+
+def list_new_objects(s3, bucket, entity, prefix, cursor, suffix='.json',
+                     skip_prefix=None, full_scan=False):
+    """
+    Lists only the objects under prefix that still need processing.
+
+    Unless full_scan is set, listing starts at the watermark (just before the
+    newest processed export) and failed objects are added from the manifest.
+    Files renamed by older versions under skip_prefix are jumped over in a
+    single request and anything already in the manifest is filtered out, so
+    the cost of a run grows with the number of pending files rather than
+    bucket history.
+    Returns object summaries (Key, ETag, Size, LastModified, Entity) sorted by key.
+    """
+    start_after = None if full_scan else listing_watermark(cursor, entity, prefix)
+    after = f" after {start_after}" if start_after else ""
+    logger.info(f"Listing s3://{bucket}/{prefix}* for {entity}{after}")
+    objects = {
+        obj['Key']: dict(obj, Entity=entity)
+        for obj in _iter_listing(s3, bucket, prefix, start_after, skip_prefix)
+        if obj['Key'].endswith(suffix)
+    }
+    if start_after:
+        for obj in list_retry_objects(s3, bucket, cursor, entity, prefix):
+            objects.setdefault(obj['Key'], obj)
+    objects = list(objects.values())
+    listed_count = len(objects)
+    objects = _filter_processed(cursor, objects)
+    if start_after and listed_count - len(objects) > LISTING_WARN_PROCESSED:
+        # The watermark should leave only the lookback window's keys; many
+        # more means it sorts before the keys (e.g. a prefix mixing formats).
+        logger.warning(f"Listing {prefix} after {start_after} returned {listed_count - len(objects)} "
+                       f"processed objects; the watermark does not narrow this listing.")
+    logger.info(f"Found {len(objects)} new objects ({listed_count - len(objects)} already processed).")
+    return sorted(objects, key=lambda obj: obj['Key'])
+
+
+def keys_from_event(event):
+    """
+    Returns (bucket, key, etag) tuples for the objects named in an S3
+    notification (Records[].s3) or an EventBridge "Object Created" event.
+    Returns an empty list for scheduled or manual invocations.
+    """
+    objects = []
+    for record in (event or {}).get('Records', []):
+        s3_info = record.get('s3')
+        if not s3_info:
+            continue
+        objects.append((
+            s3_info.get('bucket', {}).get('name'),
+            # Notification keys are URL-encoded (spaces arrive as '+').
+            unquote_plus(s3_info.get('object', {}).get('key', '')),
+            s3_info.get('object', {}).get('eTag')
+        ))
+
+    detail = (event or {}).get('detail') or {}
+    if event and event.get('source') == 'aws.s3' and 'object' in detail:
+        objects.append((
+            detail.get('bucket', {}).get('name'),
+            detail['object'].get('key', ''),
+            detail['object'].get('etag')
+        ))
+    return objects
+
+
+def is_backfill(event):
+    """
+    True when the invocation should scan the whole prefix instead of
+    processing event objects: scheduled runs, manual runs, or {"mode": "backfill"}.
+    """
+    return not keys_from_event(event) or (event or {}).get('mode') == 'backfill'
+
+
+def list_event_objects(s3, event, bucket, cursor, route):
+    """
+    Returns summaries for exactly the objects named in the event that a
+    loader handles and that are not in the manifest yet, sorted by key.
+    route(key) returns the entity name of the loader for a key, or None;
+    it is stored on each summary as 'Entity'.
+    """
+    objects = []
+    for event_bucket, key, etag in keys_from_event(event):
+        if event_bucket and event_bucket != bucket:
+            logger.warning(f"Ignoring object from unexpected bucket: s3://{event_bucket}/{key}")
+            continue
+        entity = route(key)
+        if not entity:
+            logger.info(f"Ignoring object not handled by any loader: {key}")
+            continue
+        if not etag:
+            # Hand-crafted test events carry no eTag; fetch it so the manifest stays exact.
+            etag = s3.head_object(Bucket=bucket, Key=key)['ETag']
+        # Listings quote ETags while notifications do not; store one form.
+        objects.append({
+            'Key': key,
+            'ETag': etag if etag.startswith('"') else f'"{etag}"',
+            'Entity': entity
+        })
+
+    objects = _filter_processed(cursor, objects)
+    logger.info(f"Event named {len(objects)} new objects.")
+    return sorted(objects, key=lambda obj: obj['Key'])
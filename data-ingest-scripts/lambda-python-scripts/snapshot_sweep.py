@@ -0,0 +1,263 @@
+import os
+from datetime import datetime
+
+from psycopg2 import sql
+
+from ingest_logging import get_logger, log_summary
+from ingest_metrics import current_metrics
+
+# Set SNAPSHOT_SWEEP=false to stop retiring rows missing from full exports;
+# rows listed again are still revived.
+SWEEP_ENABLED = os.environ.get('SNAPSHOT_SWEEP', 'true').lower() == 'true'
+
+# A sweep that would retire more than this fraction of a table's rows is
+# refused and logged instead, in case an export lost records without
+# looking truncated. Set to 1 to allow any sweep.
+SWEEP_MAX_FRACTION = float(os.environ.get('SNAPSHOT_SWEEP_MAX_FRACTION', '0.5'))
+
+logger = get_logger(__name__)
+
+
+def swept_table(table):
+    """
+    Name of the temporary table listing the keys a sweep retired from table.
+    """
+    return f"swept_{table}"
+
+
+def _join(left, right, columns):
+    return sql.SQL(' AND ').join(
+        sql.SQL("{left}.{column} = {right}.{column}").format(
+            left=sql.Identifier(left), right=sql.Identifier(right), column=sql.Identifier(column)
+        )
+        for column in columns
+    )
+
+
+def _key_array(alias, columns):
+    return sql.SQL("ARRAY[{columns}]::text[]").format(
+        columns=sql.SQL(', ').join(
+            sql.SQL("{alias}.{column}").format(alias=sql.Identifier(alias), column=sql.Identifier(column))
+            for column in columns
+        )
+    )
+
+
+def revive_rows(cursor, upsert):
+    """
+    Clears deleted_at on the rows of upsert's staging table, as an export
+    listing a row again means it exists again. Returns the rows revived.
+    """
+    cursor.execute(
+        sql.SQL(
+            "UPDATE {table} t SET deleted_at = NULL FROM {stage} s "
+            "WHERE t.deleted_at IS NOT NULL AND {join}"
+        ).format(
+            table=sql.Identifier(upsert.table),
+            stage=sql.Identifier(upsert.stage_table),
+            join=_join('t', 's', upsert.conflict_columns)
+        )
+    )
+    return cursor.rowcount
+
+
+def _refusal(export, upserts):
+    """
+    Returns why the export cannot be swept against, or None.
+    """
+    if not export or 'exportMode' not in export:
+        return "no export metadata"
+    if export['exportMode'] != 'full':
+        return f"{export['exportMode']} export"
+    if any(export.get(name) is None for name in ('generation', 'part', 'parts')):
+        return "no snapshot generation"
+    if any(upsert.rejected_count for upsert in upserts):
+        return "rows were rejected"
+    return None
+
+
+def _last_swept_generation(cursor, entity):
+    cursor.execute("SELECT max(generation) FROM pam_snapshot_sweeps WHERE entity = %s", (entity,))
+    return cursor.fetchone()[0]
+
+
+def _record_part(cursor, entity, generation, part, parts, source_key, upserts):
+    """
+    Records one part of a multi-part full export and the keys it listed.
+    Returns (parts loaded, rows rejected) for the generation so far.
+    """
+    cursor.execute("""
+        INSERT INTO pam_snapshot_parts (entity, generation, part, parts, source_key, rejected)
+        VALUES (%s, %s, %s, %s, %s, %s)
+        ON CONFLICT (entity, generation, part)
+        DO UPDATE SET
+            parts = EXCLUDED.parts,
+            source_key = EXCLUDED.source_key,
+            rejected = EXCLUDED.rejected,
+            loaded_at = now()
+    """, (entity, generation, part, parts, source_key or '',
+          sum(upsert.rejected_count for upsert in upserts)))
+    for upsert in upserts:
+        cursor.execute(
+            sql.SQL(
+                "INSERT INTO pam_snapshot_keys (entity, generation, table_name, key_values) "
+                "SELECT DISTINCT %s, %s, %s, {keys} FROM {stage} s "
+                "ON CONFLICT DO NOTHING"
+            ).format(
+                keys=_key_array('s', upsert.conflict_columns),
+                stage=sql.Identifier(upsert.stage_table)
+            ),
+            (entity, generation, upsert.table)
+        )
+    cursor.execute("""
+        SELECT count(*), coalesce(sum(rejected), 0) FROM pam_snapshot_parts
+        WHERE entity = %s AND generation = %s AND parts = %s
+    """, (entity, generation, parts))
+    return cursor.fetchone()
+
+
+def _sweep_table(cursor, entity, upsert, generation, parts, deleted_at):
+    """
+    Retires the rows of upsert's table that the generation did not list,
+    with one anti-join against the staging table (single part) or the
+    recorded keys (several parts). The retired keys are kept in
+    swept_table(table) until commit. Returns the rows retired, or None when
+    the sweep was refused.
+    """
+    table = sql.Identifier(upsert.table)
+    swept = sql.Identifier(swept_table(upsert.table))
+    keys = sql.SQL(', ').join(map(sql.Identifier, upsert.conflict_columns))
+    params = {'entity': entity, 'generation': generation, 'table': upsert.table,
+              'deleted_at': deleted_at}
+
+    if parts == 1:
+        cursor.execute(
+            sql.SQL("SELECT count(*) FROM (SELECT DISTINCT {keys} FROM {stage}) s").format(
+                keys=keys, stage=sql.Identifier(upsert.stage_table)
+            )
+        )
+        listed_rows = sql.SQL("SELECT 1 FROM {stage} s WHERE {join}").format(
+            stage=sql.Identifier(upsert.stage_table), join=_join('s', 't', upsert.conflict_columns)
+        )
+    else:
+        cursor.execute("""
+            SELECT count(*) FROM pam_snapshot_keys
+            WHERE entity = %(entity)s AND generation = %(generation)s AND table_name = %(table)s
+        """, params)
+        listed_rows = sql.SQL(
+            "SELECT 1 FROM pam_snapshot_keys k "
+            "WHERE k.entity = %(entity)s AND k.generation = %(generation)s "
+            "AND k.table_name = %(table)s AND k.key_values = {keys}"
+        ).format(keys=_key_array('t', upsert.conflict_columns))
+    listed = cursor.fetchone()[0]
+    if listed == 0:
+        # An empty table in a full export (e.g. safes exported without their
+        # accounts) cannot be told apart from a field that was not exported.
+        logger.info(f"Not sweeping {upsert.table}: generation {generation} lists no rows.")
+        return None
+
+    cursor.execute(sql.SQL("DROP TABLE IF EXISTS {swept}").format(swept=swept))
+    cursor.execute(
+        sql.SQL("CREATE TEMP TABLE {swept} ON COMMIT DROP AS SELECT {keys} FROM {table} WITH NO DATA").format(
+            swept=swept, keys=keys, table=table
+        )
+    )
+    cursor.execute("SAVEPOINT snapshot_sweep")
+    cursor.execute(
+        sql.SQL(
+            "WITH retired AS ("
+            "UPDATE {table} t SET deleted_at = %(deleted_at)s "
+            "WHERE t.deleted_at IS NULL AND NOT EXISTS ({listed_rows}) "
+            "RETURNING {returned}"
+            ") INSERT INTO {swept} SELECT * FROM retired"
+        ).format(
+            table=table,
+            listed_rows=listed_rows,
+            returned=sql.SQL(', ').join(
+                sql.SQL("t.{column}").format(column=sql.Identifier(column))
+                for column in upsert.conflict_columns
+            ),
+            swept=swept
+        ),
+        params
+    )
+    retired = cursor.rowcount
+    if retired > SWEEP_MAX_FRACTION * (retired + listed):
+        cursor.execute("ROLLBACK TO SAVEPOINT snapshot_sweep; RELEASE SAVEPOINT snapshot_sweep")
+        logger.error(
+            f"Refusing to retire {retired} of {retired + listed} rows of {upsert.table} "
+            f"(generation {generation}); raise SNAPSHOT_SWEEP_MAX_FRACTION if this is expected."
+        )
+        current_metrics().count('SweepsRefused')
+        return None
+    cursor.execute("RELEASE SAVEPOINT snapshot_sweep")
+
+    cursor.execute("""
+        INSERT INTO pam_snapshot_sweeps (entity, generation, table_name, listed, retired)
+        VALUES (%(entity)s, %(generation)s, %(table)s, %(listed)s, %(retired)s)
+        ON CONFLICT (entity, generation, table_name) DO NOTHING
+    """, dict(params, listed=listed, retired=retired))
+    log_summary(logger, f"Swept {upsert.table}", table=upsert.table, entity=entity,
+                generation=generation, listed=listed, retired=retired)
+    return retired
+
+
+def sweep_snapshot(cursor, entity, upserts, export, source_key=None, deleted_at=None):
+    """
+    Mark and sweep for soft deletes, after the upserts have been merged.
+
+    Rows the upserts staged are revived. Then, once every part of a full
+    export's generation has been loaded, the rows of each table the
+    generation did not list get deleted_at (the export time). Nothing is
+    retired for delta exports, exports without metadata, parts with
+    rejected rows, a generation older than the last one swept, or tables
+    the generation left empty; truncated parts fail to load before this.
+    Must run in the same transaction as the merges.
+    Returns {table: rows retired} for the tables swept.
+    """
+    metrics = current_metrics()
+    for upsert in upserts:
+        metrics.count('RowsRevived', revive_rows(cursor, upsert))
+    if not SWEEP_ENABLED:
+        return {}
+
+    reason = _refusal(export, upserts)
+    if reason:
+        logger.info(f"Not sweeping {entity} after {source_key}: {reason}.")
+        return {}
+    generation, part, parts = int(export['generation']), int(export['part']), int(export['parts'])
+    # Parts loaded by concurrent invocations each commit their part row
+    # before seeing the others'; the lock makes the last one to commit see
+    # every part, so the generation is swept exactly once.
+    cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s), hashtext(%s))",
+                   (entity, str(generation)))
+    last_swept = _last_swept_generation(cursor, entity)
+    if last_swept is not None and last_swept >= generation:
+        logger.info(f"Not sweeping {entity}: generation {generation} is older than "
+                    f"generation {last_swept}, already swept.")
+        return {}
+
+    if parts > 1:
+        loaded, rejected = _record_part(cursor, entity, generation, part, parts, source_key, upserts)
+        if loaded < parts:
+            logger.info(f"Loaded {loaded} of {parts} parts of {entity} generation {generation}; "
+                        f"sweeping once all are in.")
+            return {}
+        if rejected:
+            logger.info(f"Not sweeping {entity}: {rejected} rows of generation {generation} were rejected.")
+            return {}
+
+    deleted_at = deleted_at or datetime.utcnow()
+    retired = {}
+    for upsert in upserts:
+        count = _sweep_table(cursor, entity, upsert, generation, parts, deleted_at)
+        if count is not None:
+            retired[upsert.table] = count
+            metrics.count('RowsRetired', count)
+
+    # Older generations that never completed are abandoned as well.
+    cursor.execute("DELETE FROM pam_snapshot_keys WHERE entity = %s AND generation <= %s",
+                   (entity, generation))
+    cursor.execute("DELETE FROM pam_snapshot_parts WHERE entity = %s AND generation <= %s",
+                   (entity, generation))
+    return retired
@@ -0,0 +1,130 @@
+"""
+Builds slim deployment packages for the loader Lambdas.
+
+For each loader script a function zip holds only the loader (as
+lambda_function.py, the handler the SAM templates use) and the shared
+modules it imports, with bytecode compiled ahead of time: /var/task is
+read-only, so without it every cold start compiles the modules again.
+
+The layer zip holds psycopg2-binary for python3.11/x86_64 and nothing else.
+boto3 is left out because the Lambda runtime provides it; numpy and pyarrow
+stay optional and come from their own layer when wanted. Package metadata
+and caches are dropped, and --strip strips the shared libraries' symbols.
+
+    python build_packages.py --output build/
+    python build_packages.py --output build/ --strip
+
+Run it with python3.11 so the compiled bytecode matches the runtime; other
+versions build the packages without bytecode. The packages are build output
+and are not kept in the repository; build them for each deployment.
+"""
+import argparse
+import glob
+import os
+import py_compile
+import shutil
+import subprocess
+import sys
+import tempfile
+import zipfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+LAMBDA_DIR = os.path.abspath(os.path.join(HERE, '..', 'lambda-python-scripts'))
+LAYER_REQUIREMENTS = os.path.join(HERE, 'layer-requirements.txt')
+RUNTIME = (3, 11)
+
+# Never needed at runtime.
+_PRUNE_DIRS = ('__pycache__', 'tests')
+_PRUNE_SUFFIXES = ('.dist-info', '.egg-info')
+
+
+def loader_scripts():
+    return sorted(glob.glob(os.path.join(LAMBDA_DIR, 'load-*-to-rds.py')))
+
+
+def shared_modules():
+    return sorted(path for path in glob.glob(os.path.join(LAMBDA_DIR, '*.py'))
+                  if not os.path.basename(path).startswith('load-'))
+
+
+def compile_tree(root):
+    """
+    Writes __pycache__ bytecode next to every module under root. Checked
+    against a hash of the source, not its mtime, which zips do not keep.
+    """
+    if sys.version_info[:2] != RUNTIME:
+        print(f"Skipping bytecode: running {sys.version_info[0]}.{sys.version_info[1]}, "
+              f"the runtime is {RUNTIME[0]}.{RUNTIME[1]}")
+        return
+    for directory, _, files in os.walk(root):
+        for name in files:
+            if name.endswith('.py'):
+                py_compile.compile(os.path.join(directory, name), doraise=True,
+                                   invalidation_mode=py_compile.PycInvalidationMode.UNCHECKED_HASH)
+
+
+def zip_tree(root, path):
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED, compresslevel=9) as archive:
+        for directory, _, files in os.walk(root):
+            for name in sorted(files):
+                full = os.path.join(directory, name)
+                archive.write(full, os.path.relpath(full, root))
+    return os.path.getsize(path)
+
+
+def build_function(script, output):
+    name = os.path.basename(script)[:-len('.py')]
+    with tempfile.TemporaryDirectory() as staging:
+        shutil.copy(script, os.path.join(staging, 'lambda_function.py'))
+        for module in shared_modules():
+            shutil.copy(module, staging)
+        compile_tree(staging)
+        return name, zip_tree(staging, os.path.join(output, f"{name}.zip"))
+
+
+def prune(root, strip):
+    for directory, dirs, files in os.walk(root, topdown=True):
+        for name in list(dirs):
+            if name in _PRUNE_DIRS or name.endswith(_PRUNE_SUFFIXES):
+                shutil.rmtree(os.path.join(directory, name))
+                dirs.remove(name)
+        if strip:
+            for name in files:
+                if '.so' in name:
+                    subprocess.run(['strip', '--strip-unneeded', os.path.join(directory, name)], check=True)
+
+
+def build_layer(output, strip):
+    with tempfile.TemporaryDirectory() as staging:
+        target = os.path.join(staging, 'python')
+        subprocess.run([
+            sys.executable, '-m', 'pip', 'install', '--quiet', '--no-compile',
+            '--target', target, '--platform', 'manylinux2014_x86_64',
+            '--implementation', 'cp', '--python-version', f"{RUNTIME[0]}.{RUNTIME[1]}",
+            '--only-binary=:all:', '-r', LAYER_REQUIREMENTS
+        ], check=True)
+        prune(target, strip)
+        compile_tree(target)
+        return 'psycopg2-layer', zip_tree(staging, os.path.join(output, 'psycopg2-layer.zip'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--output', default=os.path.join(HERE, 'build'))
+    parser.add_argument('--strip', action='store_true', help='strip symbols from shared libraries')
+    parser.add_argument('--no-layer', action='store_true', help='only build the function zips')
+    args = parser.parse_args()
+    os.makedirs(args.output, exist_ok=True)
+
+    built = [build_function(script, args.output) for script in loader_scripts()]
+    if not args.no_layer:
+        built.append(build_layer(args.output, args.strip))
+
+    print(f"{'package':>24} {'KB':>8}")
+    for name, size in built:
+        print(f"{name:>24} {size / 1024:>8.0f}")
+
+
+if __name__ == '__main__':
+    main()
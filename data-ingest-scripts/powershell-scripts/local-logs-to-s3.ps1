@@ -8,7 +8,6 @@ $config = Get-Content -Path "./config.json" | ConvertFrom-Json
 $localLogPath = "C:\Program Files (x86)\CyberArk\PSM\Logs\"
 $s3BucketName = $config.s3BucketName
 $awsProfile = $config.awsProfile
-$timestamp = Get-Date -Format "yyyyMMdd_HHmmss"
 
 # -----------------------------------
 # AWS CLI Authentication
@@ -56,26 +55,19 @@ aws configure set profile.$awsProfile.region                $config.awsRegion
 Write-Host "AWS CLI configuration complete."
 
 # -----------------------------------
-# Upload files from last 24 hours
+# Upload new log lines
 # -----------------------------------
-Write-Host "Uploading log files from the last 24 hours..."
-$cutoffTime = (Get-Date).AddHours(-24)
-
-try {
-    # Process each file in the local log path
-    Get-ChildItem -Path $localLogPath | Where-Object {
-        $_.LastWriteTime -ge $cutoffTime
-    } | ForEach-Object {
-        # Generate a unique S3 key with a prefix and timestamp
-        $newFileName = "logs-$timestamp-$($_.Name)"
-        Write-Host "Uploading file: $($_.FullName) as $newFileName"
-
-        # Upload the file to S3 with the new name
-        aws s3 cp $_.FullName "s3://$s3BucketName/logs/$newFileName" --profile $awsProfile
-    }
-
-    Write-Host "Log file upload completed."
-} catch {
-    Write-Host "Error during log file retrieval or upload: $_" -ForegroundColor Red
+Write-Host "Importing LogShipper module..."
+Import-Module .\LogShipper.psm1
+
+# Only the lines appended since the last successful run are uploaded (see
+# LogShipper.psm1); the byte offsets are kept in logStatePath.
+Write-Host "Uploading new log lines from $localLogPath..."
+$shipped = Send-LogTails -LogPath $localLogPath -KeyPrefix "logs" `
+    -StatePath $config.logStatePath -WorkFolderPath $config.outputFolderPath `
+    -S3BucketName $s3BucketName -AwsProfile $awsProfile `
+    -MaxChunkBytes ([long]$config.logChunkMaxMB * 1MB) -InitialLookbackHours ([int]$config.logInitialLookbackHours)
+if (-not $shipped) {
     exit 1
-}
\ No newline at end of file
+}
+Write-Host "Log file upload completed."
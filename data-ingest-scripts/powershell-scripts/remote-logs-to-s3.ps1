@@ -9,7 +9,6 @@ $remoteServer = $config.remoteServer          # Remote server hostname or IP add
 $remoteShare = $config.remoteShare            # Shared folder name on the remote server
 $s3BucketName = $config.s3BucketName
 $awsProfile = $config.awsProfile
-$timestamp = Get-Date -Format "yyyyMMdd_HHmmss"
 
 # Define remote path for logs (UNC path)
 $remoteLogPath = "\\$remoteServer\$remoteShare"
@@ -70,26 +69,19 @@ if (!(Test-Path $remoteLogPath)) {
 Write-Host "Access to remote share verified."
 
 # -----------------------------------
-# Upload files from last 24 hours
+# Upload new log lines
 # -----------------------------------
-Write-Host "Uploading remote log files modified in the last 24 hours..."
-$cutoffTime = (Get-Date).AddHours(-24)
-
-try {
-    # Retrieve and upload files
-    Get-ChildItem -Path $remoteLogPath | Where-Object {
-        $_.LastWriteTime -ge $cutoffTime
-    } | ForEach-Object {
-        # Generate a unique S3 key with prefix and timestamp
-        $newFileName = "remote-logs-$timestamp-$($_.Name)"
-        Write-Host "Uploading file: $($_.FullName) as $newFileName"
-
-        # Upload the file to S3 with new name
-        aws s3 cp $_.FullName "s3://$s3BucketName/logs/$newFileName" --profile $awsProfile
-    }
-
-    Write-Host "Remote log file upload completed."
-} catch {
-    Write-Host "Error during log file retrieval or upload: $_" -ForegroundColor Red
+Write-Host "Importing LogShipper module..."
+Import-Module .\LogShipper.psm1
+
+# Only the lines appended since the last successful run are uploaded (see
+# LogShipper.psm1); the byte offsets are kept in remoteLogStatePath.
+Write-Host "Uploading new remote log lines from $remoteLogPath..."
+$shipped = Send-LogTails -LogPath $remoteLogPath -KeyPrefix "remote-logs" `
+    -StatePath $config.remoteLogStatePath -WorkFolderPath $config.outputFolderPath `
+    -S3BucketName $s3BucketName -AwsProfile $awsProfile `
+    -MaxChunkBytes ([long]$config.logChunkMaxMB * 1MB) -InitialLookbackHours ([int]$config.logInitialLookbackHours)
+if (-not $shipped) {
     exit 1
 }
+Write-Host "Remote log file upload completed."
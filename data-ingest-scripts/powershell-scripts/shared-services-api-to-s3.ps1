@@ -107,58 +107,47 @@ $headers = Get-IdentityHeader -IdentityTenantURL $identityTenantUrl -UPCreds $cr
 Write-Host "Successfully retrieved Identity headers."
 
 # -----------------------------------
-# Helper function to save and upload data
-# -----------------------------------
-function Save-And-UploadData {
-    param (
-        [string]$endpoint,
-        [string]$prefix
-    )
-
-    Write-Host "`n--- Save-And-UploadData: $prefix ---"
-    Write-Host "Querying API at endpoint: $endpoint"
-
-    # Query the API
-    $response = Invoke-RestMethod -Uri $endpoint -Method Get -Headers $headers
-    
-    # Generate a unique filename with a timestamp
-    $timestamp   = Get-Date -Format "yyyyMMdd_HHmmss"
-    $outputFile  = "$outputFolderPath\$($prefix)_$timestamp.json"
-
-    if ($response) {
-        Write-Host "API response received. Saving to file: $outputFile"
-
-        # Save the response to a JSON file with increased depth and compression
-        $response | ConvertTo-Json -Depth 10 -Compress | Out-File -FilePath $outputFile
-        Write-Host "File saved. Preparing to upload to S3..."
-
-        # Upload to S3 with the appropriate prefix
-        $s3Key = "$prefix-$timestamp.json"
-        aws s3 cp $outputFile s3://$s3BucketName/$s3Key --profile $awsProfile
-
-        Write-Host "Uploaded $s3Key to S3." -ForegroundColor Green
-    }
-    else {
-        Write-Host "Error: API response is null or empty for $prefix data." -ForegroundColor Red
-    }
+# Import the paginated export helpers
+# -----------------------------------
+Write-Host "Importing PamExport module..."
+Import-Module .\PamExport.psm1
+
+# Paging, chunking, format and delta settings (see config.json)
+$exportSettings = @{
+    ApiBaseUrl       = $apiBaseUrl
+    Headers          = $headers
+    OutputFolderPath = $outputFolderPath
+    S3BucketName     = $s3BucketName
+    AwsProfile       = $awsProfile
+    PageSize         = [int]$config.pageSize
+    Concurrency      = [int]$config.pageConcurrency
+    RecordsPerFile   = [int]$config.recordsPerFile
+    Format           = if ($config.exportFormat) { $config.exportFormat } else { "json" }
+    MaxPartMB        = if ($config.maxPartMB) { [int]$config.maxPartMB } else { 64 }
+    Delta            = ($config.exportMode -eq "delta")
+    OverlapMinutes   = [int]$config.deltaOverlapMinutes
+    StatePath        = $config.exportStatePath
 }
 
 # -----------------------------------
 # Query and upload data for accounts
 # -----------------------------------
 Write-Host "`n--- Querying and uploading 'accounts' data ---"
-Save-And-UploadData -endpoint "$apiBaseUrl/Accounts" -prefix "accounts"
+# Only accounts can be filtered by modification time; the others always export in full.
+Export-PamEntity @exportSettings -Resource "Accounts" -Prefix "accounts" -RecordsKey "value" -Paged `
+    -DeltaFilter "modificationTime gte {0}"
 
 # -----------------------------------
 # Query and upload data for platforms
 # -----------------------------------
 Write-Host "`n--- Querying and uploading 'platforms' data ---"
-Save-And-UploadData -endpoint "$apiBaseUrl/Platforms" -prefix "platforms"
+# The Platforms API returns every platform in one response.
+Export-PamEntity @exportSettings -Resource "Platforms" -Prefix "platforms" -RecordsKey "Platforms"
 
 # -----------------------------------
 # Query and upload data for safes
 # -----------------------------------
 Write-Host "`n--- Querying and uploading 'safes' data ---"
-Save-And-UploadData -endpoint "$apiBaseUrl/Safes" -prefix "safes"
+Export-PamEntity @exportSettings -Resource "Safes" -Prefix "safes" -RecordsKey "value" -Paged
 
-Write-Host "`nAll data has been retrieved and uploaded successfully!"
\ No newline at end of file
+Write-Host "`nAll data has been retrieved and uploaded successfully!"